@@ -9,9 +9,8 @@ import logging
 import os
 import tempfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-import git
-from cryptography.hazmat.primitives.serialization import SSHCertPrivateKeyTypes
 from packaging import version
 
 import lib.config as global_config
@@ -30,6 +29,8 @@ from lib.common import (
     vm_image,
     wait_for,
 )
+from lib.fixture_profile import FixtureProfiler
+from lib.history import HISTORY_ORDERS, TEST_HISTORY, TestHistoryPlugin
 from lib.host import Host
 from lib.netutil import is_ipv6
 from lib.pool import Pool
@@ -44,7 +45,10 @@ from lib.xo import xo_cli
 # need to import them in the global conftest.py so that they are recognized as fixtures.
 from pkgfixtures import formatted_and_mounted_ext4_disk, sr_disk_wiped
 
-from typing import Any, Dict, Generator, Iterable, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, Generator, Iterable, List, Optional
+
+if TYPE_CHECKING:
+    from lib.rpm_cache import RpmCacheProxy
 
 # Do we cache VMs?
 try:
@@ -101,6 +105,14 @@ def pytest_addoption(parser: pytest.Parser) -> None:
         default=20,
         help="Max lines to output in a ssh log (0 if no limit)"
     )
+    parser.addoption(
+        "--ssh-output-log-dir",
+        action="store",
+        default=None,
+        help="Write the output of the SSH and local commands to compressed logs in this directory, one per host"
+             " and per test, instead of logging each line: the debug log only gets their first lines"
+             " (see --ssh-output-max-lines)."
+    )
     parser.addoption(
         "--disks",
         action="append",
@@ -137,12 +149,104 @@ def pytest_addoption(parser: pytest.Parser) -> None:
         help="Block size to align span positions to when writing in volumes."
              " Accepts sizes like '512', '4KiB', '1MiB'. A value of 1 is equivalent to no alignment."
     )
+    parser.addoption(
+        "--sr-scale-levels",
+        action=SplitCommaAction,
+        default=[],
+        help="Numbers of VDIs to populate SRs with in SR scale benchmarks (comma-separated)."
+             " Example: 100,500,1000"
+    )
+    parser.addoption(
+        "--sr-scale-workers",
+        action="store",
+        default="8",
+        help="Max number of concurrent VDI operations when populating or cleaning SRs in SR scale benchmarks."
+    )
+    parser.addoption(
+        "--efi-key-cache",
+        action="store",
+        default=None,
+        help="Directory where Secure Boot keys are pre-generated and cached between runs. No cache if not set."
+    )
+    parser.addoption(
+        "--efi-key-pool-size",
+        action="store",
+        default="4",
+        help="Number of Secure Boot keys to keep pre-generated for each key name (see --efi-key-cache)."
+    )
+    parser.addoption(
+        "--efi-key-cache-max-age",
+        action="store",
+        default="7",
+        help="Age in days after which cached Secure Boot keys and signed data are evicted (see --efi-key-cache)."
+    )
+    parser.addoption(
+        "--efi-keys-seed",
+        action="store",
+        default=None,
+        help="Reuse the same Secure Boot keys and signing timestamps in every run with the same seed,"
+             " for reproducible runs (requires --efi-key-cache)."
+    )
+    parser.addoption(
+        "--remastered-iso-cache",
+        action="store",
+        default=None,
+        help="Directory where remastered installer ISOs are cached between runs, and deduplicated on ISO SRs."
+             " The ISOs pushed to ISO SRs are shared with the other test sessions, they are left there."
+             " No cache if not set."
+    )
+    parser.addoption(
+        "--remastered-iso-cache-size",
+        action="store",
+        default="20GiB",
+        help="Maximum size of the remastered ISO cache, least recently used ISOs are evicted first."
+             " Example: 50GiB (see --remastered-iso-cache)."
+    )
+    parser.addoption(
+        "--rpm-cache",
+        action="store",
+        default=None,
+        help="Directory where the packages downloaded by yum on the hosts are cached between hosts and runs,"
+             " through an HTTP proxy running on the test runner. No cache if not set."
+    )
+    parser.addoption(
+        "--rpm-cache-port",
+        action="store",
+        default="0",
+        help="Port of the RPM cache proxy, which must be reachable from the hosts. Any free port if 0"
+             " (see --rpm-cache)."
+    )
+    parser.addoption(
+        "--test-history",
+        action="store",
+        default=TEST_HISTORY,
+        help="SQLite database where the durations and outcomes of the tests and fixtures are recorded, to predict"
+             " the duration of the next runs and order their tests. Relative to the root directory of the tests."
+             " Disabled if empty."
+    )
+    parser.addoption(
+        "--history-order",
+        action="store",
+        default="collection",
+        choices=HISTORY_ORDERS,
+        help="Order of the modules of each package, and of the packages of each axis, based on the test history:"
+             " the order of collection, the tests that failed most often first, or the shortest tests first."
+    )
+    parser.addoption(
+        "--fixture-profile",
+        action="store",
+        default=None,
+        help="Profile the setup and teardown of the fixtures: print their durations, remote calls and the"
+             " parameters which make them be instantiated again in the same scope, and write the profile of the"
+             " run to this file, in the folded stacks format of flame graphs."
+    )
 
 def pytest_configure(config: pytest.Config) -> None:
     global_config.ignore_ssh_banner = config.getoption('--ignore-ssh-banner')
     ssh_output_max_lines = config.getoption('--ssh-output-max-lines')
     assert ssh_output_max_lines is not None
     global_config.ssh_output_max_lines = int(ssh_output_max_lines)
+    global_config.ssh_output_log_dir = config.getoption('--ssh-output-log-dir')
     volume_size = config.getoption('--volume-size')
     assert volume_size is not None
     global_config.volume_size = parse_size(volume_size)
@@ -152,6 +256,22 @@ def pytest_configure(config: pytest.Config) -> None:
     write_volume_align = config.getoption('--write-volume-align')
     assert write_volume_align is not None
     global_config.write_volume_align = parse_size(write_volume_align)
+    global_config.efi_key_cache = config.getoption('--efi-key-cache')
+    global_config.efi_key_pool_size = int(config.getoption('--efi-key-pool-size'))
+    global_config.efi_key_cache_max_age = int(config.getoption('--efi-key-cache-max-age'))
+    global_config.efi_keys_seed = config.getoption('--efi-keys-seed')
+    global_config.remastered_iso_cache = config.getoption('--remastered-iso-cache')
+    remastered_iso_cache_size = config.getoption('--remastered-iso-cache-size')
+    assert remastered_iso_cache_size is not None
+    global_config.remastered_iso_cache_size = parse_size(remastered_iso_cache_size)
+    global_config.rpm_cache = config.getoption('--rpm-cache')
+    global_config.rpm_cache_port = int(config.getoption('--rpm-cache-port'))
+    test_history = config.getoption('--test-history')
+    if test_history:
+        config.pluginmanager.register(TestHistoryPlugin(str(config.rootpath / test_history)), "test_history")
+    fixture_profile = config.getoption('--fixture-profile')
+    if fixture_profile:
+        config.pluginmanager.register(FixtureProfiler(fixture_profile), "fixture_profile")
 
 def pytest_generate_tests(metafunc: pytest.Metafunc) -> None:
     if "vm_ref" in metafunc.fixturenames:
@@ -193,6 +313,7 @@ def pytest_collection_modifyitems(items: list[pytest.Item], config: pytest.Confi
     - Automatically mark tests based on fixtures they require.
       Check pytest.ini or pytest --markers for marker descriptions.
     - Regroup tests by axis (image_format) and by package (leaf directory)
+    - Order the packages and their modules according to --history-order
     """
     markable_fixtures = [
         'uefi_vm',
@@ -252,13 +373,16 @@ def pytest_collection_modifyitems(items: list[pytest.Item], config: pytest.Confi
         assert package is not None, "all items must come from a package"
         grouped[axis_order][package].append(item)
 
+    history = config.pluginmanager.get_plugin("test_history")
+    history_order = config.getoption("--history-order")
+
     # Flatten back to a list of items
-    new_items: List[pytest.Item] = [
-        item
-        for axis_order in sorted(grouped) # apply axis_ordering here
-        for package in grouped[axis_order]
-        for item in grouped[axis_order][package]
-    ]
+    new_items: List[pytest.Item] = []
+    for axis_order in sorted(grouped): # apply axis_ordering here
+        packages = list(grouped[axis_order].values())
+        if isinstance(history, TestHistoryPlugin):
+            packages = history.order_packages(packages, history_order)
+        new_items.extend(item for package_items in packages for item in package_items)
     items[:] = new_items
 
 
@@ -287,12 +411,48 @@ def pytest_runtest_makereport(
 
 # fixtures
 
+def _wait_for_nested_host_ssh(host_vm: VM) -> None:
+    wait_for(lambda: not os.system(f"nc -zw5 {host_vm.ip} 22"),
+             "Wait for ssh up on nested host", retry_delay_secs=5)
+
+def _boot_nested_host(nest: Host, cache_key: str, nested_list: list[VM]) -> VM:
+    """ Clone a cached nested host VM, boot it, and wait for its IP address and SSH. """
+    host_vm = nest.import_vm(f"clone:{cache_key}", nest.main_sr_uuid())
+    nested_list.append(host_vm)
+
+    vif = host_vm.vifs()[0]
+    mac_address = vif.mac_address()
+    logging.info("Nested host has MAC %s", mac_address)
+
+    host_vm.start()
+    wait_for(host_vm.is_running, "Wait for nested host VM running")
+
+    # catch host-vm IP address
+    ips = pxe.wait_for_arp_addresses(mac_address,
+                                     "Wait for DHCP server to see nested host in ARP tables",
+                                     timeout_secs=10 * 60)
+    logging.info("Nested host has IPs %s", ips)
+    assert len(ips) == 1
+    host_vm.ip = ips[0]
+
+    _wait_for_nested_host_ssh(host_vm)
+    return host_vm
+
 @pytest.fixture(scope='session')
-def hosts(pytestconfig: pytest.Config) -> Generator[list[Host], None, None]:
-    nested_list = []
+def rpm_cache_proxy() -> Generator[RpmCacheProxy | None, None, None]:
+    if global_config.rpm_cache is None:
+        yield None
+        return
+    from lib.rpm_cache import RpmCacheProxy
+    proxy = RpmCacheProxy(global_config.rpm_cache, global_config.rpm_cache_port)
+    yield proxy
+    proxy.stop()
+
+@pytest.fixture(scope='session')
+def hosts(pytestconfig: pytest.Config, rpm_cache_proxy: RpmCacheProxy | None) -> Generator[list[Host], None, None]:
+    nested_list: list[VM] = []
 
     def setup_host(hostname_or_ip: str, *, config: pytest.Config | None = None) -> Host:
-        host_vm = None
         if hostname_or_ip.startswith("cache://"):
             if config is None:
                 raise RuntimeError("setup_host: a cache:// host requires --nest")
@@ -302,28 +462,8 @@ def hosts(pytestconfig: pytest.Config) -> Generator[list[Host], None, None]:
             nest = Pool(nest_hostname).master
 
             protocol, rest = hostname_or_ip.split(":", 1)
-            host_vm = nest.import_vm(f"clone:{rest}", nest.main_sr_uuid())
-            nested_list.append(host_vm)
-
-            vif = host_vm.vifs()[0]
-            mac_address = vif.mac_address()
-            logging.info("Nested host has MAC %s", mac_address)
-
-            host_vm.start()
-            wait_for(host_vm.is_running, "Wait for nested host VM running")
-
-            # catch host-vm IP address
-            wait_for(lambda: pxe.arp_addresses_for(mac_address),
-                     "Wait for DHCP server to see nested host in ARP tables",
-                     timeout_secs=10 * 60)
-            ips = pxe.arp_addresses_for(mac_address)
-            logging.info("Nested host has IPs %s", ips)
-            assert len(ips) == 1
-            host_vm.ip = ips[0]
-
-            wait_for(lambda: not os.system(f"nc -zw5 {host_vm.ip} 22"),
-                     "Wait for ssh up on nested host", retry_delay_secs=5)
-
+            host_vm = _boot_nested_host(nest, rest, nested_list)
+            assert host_vm.ip is not None
             hostname_or_ip = host_vm.ip
 
         pool = Pool(hostname_or_ip)
@@ -342,16 +482,27 @@ def hosts(pytestconfig: pytest.Config) -> Generator[list[Host], None, None]:
     hostname_list = list(itertools.chain(*hosts_split))
 
     try:
-        host_list = [setup_host(hostname_or_ip, config=pytestconfig)
-                     for hostname_or_ip in hostname_list]
+        # nested hosts are booted at the same time
+        with ThreadPoolExecutor(max_workers=max(1, len(hostname_list))) as executor:
+            host_list = list(executor.map(lambda h: setup_host(h, config=pytestconfig), hostname_list))
     except Exception:
         cleanup_hosts()
         raise
 
     if not host_list:
         pytest.fail("This test requires at least one --hosts parameter")
+
+    proxied_hosts = []
+    if rpm_cache_proxy is not None:
+        proxied_hosts = [h for master in host_list for h in master.pool.hosts]
+        for h in proxied_hosts:
+            rpm_cache_proxy.configure(h)
+
     yield host_list
 
+    if rpm_cache_proxy is not None:
+        for h in proxied_hosts:
+            rpm_cache_proxy.unconfigure(h)
     cleanup_hosts()
 
 @pytest.fixture(scope='session')
@@ -649,6 +800,7 @@ def tests_git_revision() -> Generator[str, None, None]:
     Use of this fixture means impacted tests cannot run unless all
     modifications are commited.
     """
+    import git  # GitPython is slow to import, and only needed by tests using cached VMs
     test_repo = git.Repo(".")
     assert not test_repo.is_dirty(), "test repo must not be dirty"
     yield test_repo.head.commit.hexsha
@@ -1,6 +1,9 @@
 #!/usr/bin/env -S python3 -u
 
 import argparse
+import contextlib
+import hashlib
+import io
 import json
 import os
 import subprocess
@@ -8,7 +11,10 @@ import sys
 
 from lib.commands import ssh
 
-from typing import NotRequired, TypedDict, cast
+from typing import TYPE_CHECKING, Any, Callable, NotRequired, TypedDict, cast
+
+if TYPE_CHECKING:
+    import pytest
 
 class JobData(TypedDict):
     description: str
@@ -113,7 +119,7 @@ JOBS: dict[str, JobData] = {
             "--vm": "single/small_vm",
         },
         "paths": ["tests/storage"],
-        "markers": "(small_vm or no_vm) and not reboot and not quicktest and not unused_4k_disks",
+        "markers": "(small_vm or no_vm) and not reboot and not quicktest and not unused_4k_disks and not sr_scale",
         "name_filter": "not migration and not linstor",
     },
     "storage-main-large-thin": {
@@ -132,7 +138,7 @@ JOBS: dict[str, JobData] = {
         },
         "paths": ["tests/storage"],
         "markers": "(small_vm or no_vm) and not reboot and not quicktest and not unused_4k_disks"
-                   " and not thick_provisioned and not disk_throughput_intensive",
+                   " and not thick_provisioned and not disk_throughput_intensive and not sr_scale",
         "name_filter": "not migration and not linstor and not gzip",
     },
     "storage-main-large-thick": {
@@ -151,7 +157,7 @@ JOBS: dict[str, JobData] = {
         },
         "paths": ["tests/storage"],
         "markers": "(small_vm or no_vm) and not reboot and not quicktest and not unused_4k_disks"
-                   " and not disk_throughput_intensive and thick_provisioned",
+                   " and not disk_throughput_intensive and thick_provisioned and not sr_scale",
         "name_filter": "not migration and not linstor and not gzip",
     },
     "storage-main-large-full-write": {
@@ -255,6 +261,22 @@ JOBS: dict[str, JobData] = {
         "markers": "quicktest and not unused_4k_disks",
         "name_filter": "not linstor and not zfsvol",
     },
+    "storage-scale": {
+        "description":
+            "populates SRs of all storage drivers with thousands of VDIs and measures VDI operation latencies",
+        "requirements": [
+            "A pool with at least 3 hosts.",
+            "An additional free disk on every host.",
+            "Configuration in data.py for each remote SR that will be tested.",
+            "Enough space on each SR for the largest --sr-scale-levels count of 8MiB VDIs.",
+        ],
+        "nb_pools": 1,
+        "params": {
+            "--sr-scale-levels": "100,1000,2000",
+        },
+        "paths": ["tests/storage"],
+        "markers": "sr_scale",
+    },
     "storage-benchmarks": {
         "description": "runs disk benchmark tests",
         "requirements": [
@@ -280,7 +302,7 @@ JOBS: dict[str, JobData] = {
             "--vm": "single/small_vm",
         },
         "paths": ["tests/storage/linstor"],
-        "markers": "(small_vm or no_vm) and not reboot and not quicktest",
+        "markers": "(small_vm or no_vm) and not reboot and not quicktest and not sr_scale",
         "name_filter": "not migration",
     },
     "linstor-migrations": {
@@ -337,7 +359,7 @@ JOBS: dict[str, JobData] = {
             "--vm": "single/small_vm",
         },
         "paths": ["tests/storage"],
-        "markers": "(small_vm or no_vm) and unused_4k_disks and not reboot and not quicktest",
+        "markers": "(small_vm or no_vm) and unused_4k_disks and not reboot and not quicktest and not sr_scale",
         "name_filter": "not migration",
     },
     "largeblock-migrations": {
@@ -667,6 +689,25 @@ def get_vm_or_vms_refs(handle: str, host_version: str | None = None) -> str | li
 
     return vms
 
+def join_pytest_args(arg: str | None, option: str, pytest_args: list[str]) -> str | None:
+    """ Remove the values of `option` from `pytest_args` and merge them with `arg` (logical and). """
+    cli_args: list[str] = []
+    try:
+        while True:
+            i = pytest_args.index(option)
+            value = pytest_args[i + 1]
+            del pytest_args[i + 1]
+            del pytest_args[i]
+            cli_args.append(value)
+    except ValueError:
+        pass
+    joined_cli_args = ") and (".join(cli_args)
+    if arg and joined_cli_args:
+        return f"({arg}) and ({joined_cli_args})"
+    if joined_cli_args:
+        return f"({joined_cli_args})"
+    return arg
+
 def build_pytest_cmd(job_data: JobData, hosts: str | None = None, host_version: str | None = None,
                      pytest_args: list[str] = []) -> list[str]:
     markers = job_data.get("markers", None)
@@ -682,29 +723,11 @@ def build_pytest_cmd(job_data: JobData, hosts: str | None = None, host_version:
         except Exception as e:
             print(e, file=sys.stderr)
 
-    def _join_pytest_args(arg: str | None, option: str) -> str | None:
-        cli_args: list[str] = []
-        try:
-            while True:
-                i = pytest_args.index(option)
-                value = pytest_args[i + 1]
-                del pytest_args[i + 1]
-                del pytest_args[i]
-                cli_args.append(value)
-        except ValueError:
-            pass
-        joined_cli_args = ") and (".join(cli_args)
-        if arg and joined_cli_args:
-            return f"({arg}) and ({joined_cli_args})"
-        if joined_cli_args:
-            return f"({joined_cli_args})"
-        return arg
-
     # Merge name filter
-    name_filter = _join_pytest_args(name_filter, "-k")
+    name_filter = join_pytest_args(name_filter, "-k", pytest_args)
 
     # Merge markers
-    markers = _join_pytest_args(markers, "-m")
+    markers = join_pytest_args(markers, "-m", pytest_args)
 
     # pytest_args may override job_params
     pytest_args_keys = []
@@ -745,34 +768,159 @@ def action_collect(args: argparse.Namespace) -> None:
     cmd = build_pytest_cmd(JOBS[args.job], None, args.host_version, ["--collect-only"] + args.pytest_args)
     subprocess.run(cmd)
 
+# Index of collected tests, by node ID: marker names and keywords matched by -k (lowercase)
+class IndexedTest(TypedDict):
+    markers: list[str]
+    keywords: list[str]
+
+TestIndex = dict[str, IndexedTest]
+
+TEST_INDEX_CACHE = ".pytest_cache/jobs-test-index.json"
+# Where the files that can change test collection are: directories, and extensions of the files in them and at the root
+_COLLECTION_DIRS = ["lib", "tests"]
+_COLLECTION_FILES = (".py", ".ini", ".toml", ".cfg")
+
+class _TestIndexPlugin:
+    def __init__(self) -> None:
+        self.index: TestIndex = {}
+
+    def pytest_collection_finish(self, session: "pytest.Session") -> None:
+        import pytest
+
+        for item in session.items:
+            # same names as pytest's KeywordMatcher
+            keywords = {
+                node.name for node in item.listchain()
+                if not isinstance(node, pytest.Session)
+                and not (isinstance(node, pytest.Directory) and isinstance(node.parent, pytest.Session))
+            }
+            keywords.update(item.listextrakeywords())
+            function = getattr(item, "function", None)
+            if function is not None:
+                keywords.update(function.__dict__)
+            markers = {mark.name for mark in item.iter_markers()}
+            keywords.update(markers)
+            self.index[item.nodeid] = IndexedTest(markers=sorted(markers),
+                                                  keywords=sorted(k.lower() for k in keywords))
+
+def _source_tree_hash() -> str:
+    """
+    Hash of everything that can change test collection: the python sources of the tests and of lib, and the files
+    at the root, like conftest.py, data.py and the pytest configuration.
+    """
+    import pytest
+
+    paths = sorted(name for name in os.listdir(".") if name.endswith(_COLLECTION_FILES) and os.path.isfile(name))
+    for top in _COLLECTION_DIRS:
+        for root, dirs, files in os.walk(top):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+            paths += sorted(os.path.join(root, name) for name in files if name.endswith(_COLLECTION_FILES))
+
+    sha = hashlib.sha256(f"{sys.version}\0{pytest.__version__}\0".encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            sha.update(f"{path}\0".encode() + f.read() + b"\0")
+    return sha.hexdigest()
+
+def collect_test_index() -> TestIndex:
+    """
+    Collect all the tests once, in-process, and index them.
+
+    The index is cached in TEST_INDEX_CACHE and reused as long as the source tree does not change.
+    """
+    tree_hash = _source_tree_hash()
+    try:
+        with open(TEST_INDEX_CACHE) as f:
+            cache = json.load(f)
+        if cache["tree_hash"] == tree_hash:
+            return cast(TestIndex, cache["index"])
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    index = _collect_tests([])
+    os.makedirs(os.path.dirname(TEST_INDEX_CACHE), exist_ok=True)
+    with open(f"{TEST_INDEX_CACHE}.tmp", "w") as f:
+        json.dump({"tree_hash": tree_hash, "index": index}, f)
+    os.replace(f"{TEST_INDEX_CACHE}.tmp", TEST_INDEX_CACHE)
+    return index
+
+def _collect_tests(pytest_args: list[str]) -> TestIndex:
+    """ Collect the tests selected by pytest_args, in-process, and index them. """
+    import pytest
+
+    plugin = _TestIndexPlugin()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        # --vm to collect tests that require one: the VM is only used to parametrize them
+        ret = pytest.main(["--collect-only", "-q", "--vm=a_vm"] + pytest_args, plugins=[plugin])
+    if ret not in (pytest.ExitCode.OK, pytest.ExitCode.NO_TESTS_COLLECTED):
+        print(f"ERROR: Test collection failed:\n{output.getvalue().strip()}")
+        sys.exit(1)
+    return plugin.index
+
+def _expression_class() -> Any:
+    """
+    pytest's parser of -m and -k expressions, None if this version of pytest doesn't have the one known to work.
+
+    It is not part of pytest's public API: without it, tests are selected by pytest itself, collecting them again.
+    """
+    try:
+        from _pytest.mark.expression import Expression
+    except ImportError:
+        return None
+    if not callable(getattr(Expression, "compile", None)) or not callable(getattr(Expression, "evaluate", None)):
+        return None
+    return Expression
+
+def expression_matches(expr: str | None, match: Callable[[str], bool]) -> bool:
+    """ Evaluate a pytest -m or -k expression, `match` telling whether each identifier matches. """
+    if not expr or not expr.strip():
+        return True
+
+    expression = _expression_class()
+    assert expression is not None
+    # the index has no marker arguments: `marker(arg=value)` matches any test with the marker
+    return bool(expression.compile(expr).evaluate(lambda name, /, **kwargs: match(name)))
+
+def select_tests(index: TestIndex, paths: list[str] = [], markers: str | None = None,
+                 name_filter: str | None = None) -> set[str]:
+    """ Node IDs (without parameters) selected by paths, -m and -k, as pytest would select them. """
+    if (markers or name_filter) and _expression_class() is None:
+        pytest_args = list(paths)
+        if markers:
+            pytest_args += ["-m", markers]
+        if name_filter:
+            pytest_args += ["-k", name_filter]
+        return {nodeid.split("[")[0] for nodeid in _collect_tests(pytest_args)}
+
+    prefixes = tuple(p for path in paths for p in (f"{path.rstrip('/')}/", f"{path}::", f"{path}["))
+    selected = set()
+    for nodeid, test in index.items():
+        if paths and nodeid not in paths and not nodeid.startswith(prefixes):
+            continue
+        if not expression_matches(markers, lambda name: name in test["markers"]):
+            continue
+        if not expression_matches(name_filter, lambda sub: any(sub.lower() in kw for kw in test["keywords"])):
+            continue
+        selected.add(nodeid.split("[")[0])
+    return selected
+
+def select_job_tests(index: TestIndex, job_data: JobData) -> set[str]:
+    return select_tests(index, job_data["paths"], job_data.get("markers"), job_data.get("name_filter"))
+
 def action_check(args: argparse.Namespace) -> None:
     error = False
 
-    def extract_tests(cmd: list[str]) -> set[str]:
-        tests = set()
-        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if res.returncode != 0 and res.returncode != 5: # 5 means no test found
-            print(f"""ERROR: Command failed {cmd}:
-STDERR: {res.stderr.decode().strip()}
-STDOUT: ---
-{res.stdout.decode().strip()}
----""")
-            sys.exit(1)
-        for line in res.stdout.decode().splitlines():
-            if line.startswith("tests/"):
-                tests.add(line.split("[")[0])
-        return tests
+    index = collect_test_index()
 
-    broken_tests = set()
-    for path in BROKEN_TESTS:
-        broken_tests |= extract_tests(["pytest", path, "--collect-only", "-q"])
+    broken_tests = select_tests(index, BROKEN_TESTS)
 
-    all_tests = extract_tests(["pytest", "--collect-only", "-q"]) - broken_tests
+    all_tests = select_tests(index) - broken_tests
 
     print("*** Checking that all tests are selected by at least one job... ", end="")
     job_tests = set()
     for job_data in JOBS.values():
-        job_tests |= extract_tests(build_pytest_cmd(job_data, None, None, ["--collect-only", "-q", "--vm=a_vm"]))
+        job_tests |= select_job_tests(index, job_data)
     tests_without_jobs = sorted(list(all_tests - job_tests))
     if tests_without_jobs:
         error = True
@@ -782,9 +930,9 @@ STDOUT: ---
         print("OK")
 
     print("*** Checking that all tests that use VMs have VM target markers (small_vm, etc.)... ", end="")
-    tests_missing_vm_markers = extract_tests(
-        ["pytest", "--collect-only", "-q", "-m", "not no_vm and not (small_vm or multi_vm or big_vm or debian_uefi_vm)"]
-    )
+    tests_missing_vm_markers = sorted(select_tests(
+        index, markers="not no_vm and not (small_vm or multi_vm or big_vm or debian_uefi_vm)"
+    ))
     if tests_missing_vm_markers:
         error = True
         print("FAILED")
@@ -794,12 +942,12 @@ STDOUT: ---
         print("OK")
 
     print("*** Checking that all tests marked multi_vms are selected in a job that runs on multiple VMs... ", end="")
-    multi_vm_tests = extract_tests(["pytest", "--collect-only", "-q", "-m", "multi_vms"]) - broken_tests
+    multi_vm_tests = select_tests(index, markers="multi_vms") - broken_tests
     job_tests = set()
     for job_data in JOBS.values():
         assert isinstance(job_data["params"], dict)
         if "--vm[]" in job_data["params"]:
-            job_tests |= extract_tests(build_pytest_cmd(job_data, None, None, ["--collect-only", "-q", "--vm=a_vm"]))
+            job_tests |= select_job_tests(index, job_data)
     tests_missing = sorted(list(multi_vm_tests - job_tests))
     if tests_missing:
         error = True
@@ -811,19 +959,145 @@ STDOUT: ---
     if error:
         sys.exit(1)
 
-def action_run(args: argparse.Namespace) -> None:
-    cmd = build_pytest_cmd(JOBS[args.job], args.hosts, None, args.pytest_args)
-    print(subprocess.list2cmdline(cmd))
+# Duration assumed for tests that never ran
+DEFAULT_TEST_DURATION = 60.0
+
+def load_test_durations() -> dict[str, float]:
+    """ Predicted duration of each test (node ID without parameters), from the test history of previous runs. """
+    from lib.history import TEST_HISTORY, TestHistory
+
+    if not os.path.exists(TEST_HISTORY):
+        return {}
+    with contextlib.closing(TestHistory(TEST_HISTORY)) as history:
+        return history.base_durations()
+
+def shard_tests(tests: set[str], durations: dict[str, float], nb_shards: int) -> list[tuple[float, list[str]]]:
+    """
+    Split tests into `nb_shards` lists of test files with balanced total durations, returned with their predicted
+    durations.
+
+    Tests are distributed by package (test directory), like pytest_collection_modifyitems groups them,
+    so that package and module scoped fixtures are still set up once. Packages are assigned longest first,
+    each to the least loaded shard.
+    """
+    known = sorted(durations.values())
+    default = known[len(known) // 2] if known else DEFAULT_TEST_DURATION
+
+    packages: dict[str, tuple[float, set[str]]] = {}
+    for nodeid in tests:
+        path = nodeid.split("::")[0]
+        duration, files = packages.get(os.path.dirname(path), (0.0, set()))
+        files.add(path)
+        packages[os.path.dirname(path)] = (duration + durations.get(nodeid, default), files)
+
+    shards: list[tuple[float, list[str]]] = [(0.0, []) for _ in range(nb_shards)]
+    for duration, files in sorted(packages.values(), key=lambda p: (-p[0], sorted(p[1]))):
+        i = min(range(nb_shards), key=lambda i: shards[i][0])
+        shards[i] = (shards[i][0] + duration, shards[i][1] + sorted(files))
+    return [shard for shard in shards if shard[1]]
+
+def merge_junit_reports(reports: list[str], output: str) -> None:
+    """ Merge the JUnit XML reports of the shards. """
+    import xml.etree.ElementTree as ET
+
+    merged = ET.Element("testsuites")
+    totals = dict.fromkeys(("tests", "failures", "errors", "skipped"), 0)
+    total_time = 0.0
+    for report in reports:
+        if not os.path.exists(report):
+            continue
+        for suite in ET.parse(report).getroot().iter("testsuite"):
+            merged.append(suite)
+            for key in totals:
+                totals[key] += int(suite.get(key, 0))
+            total_time += float(suite.get("time", 0))
+    merged.attrib.update({key: str(value) for key, value in totals.items()}, time=f"{total_time:.3f}")
+    ET.ElementTree(merged).write(output, encoding="utf-8", xml_declaration=True)
+
+def run_shards(args: argparse.Namespace, pool_sets: list[str]) -> None:
+    """ Run a job split in shards, concurrently, one pytest process per pool set. """
+    import signal
+    import time
+
+    job_data = JOBS[args.job]
+    pytest_args = list(args.pytest_args)
+    selection_args = list(pytest_args)
+    markers = join_pytest_args(job_data.get("markers"), "-m", selection_args)
+    name_filter = join_pytest_args(job_data.get("name_filter"), "-k", selection_args)
+    tests = select_tests(collect_test_index(), job_data["paths"], markers, name_filter)
+
+    # each shard writes its own report, merged into the one requested, if any: `--junitxml[=| ]PATH`
+    report = os.path.join(args.report_dir, "report.xml")
+    i = 0
+    while i < len(pytest_args):
+        option, sep, value = pytest_args[i].partition("=")
+        if option not in ("--junitxml", "--junit-xml"):
+            i += 1
+        elif sep:
+            report = value
+            del pytest_args[i]
+        else:
+            if i + 1 == len(pytest_args):
+                print(f"ERROR: {option} expects a path")
+                sys.exit(1)
+            report = pytest_args[i + 1]
+            del pytest_args[i:i + 2]
+
+    shards = shard_tests(tests, load_test_durations(), len(pool_sets))
+    cmds = []
+    for i, ((duration, files), hosts) in enumerate(zip(shards, pool_sets)):
+        shard_job: JobData = {**job_data, "paths": files}
+        cmds.append(build_pytest_cmd(shard_job, hosts, None,
+                                     pytest_args + [f"--junitxml={args.report_dir}/shard-{i}.xml"]))
+        print(f"[shard {i}] predicted duration {duration:.0f}s: {subprocess.list2cmdline(cmds[-1])}")
     if args.print_only:
         return
 
+    os.makedirs(args.report_dir, exist_ok=True)
+    processes = []
+    for i, cmd in enumerate(cmds):
+        with open(os.path.join(args.report_dir, f"shard-{i}.log"), "wb") as log:
+            # own session so that Ctrl-C is forwarded below, and pytest can finish its teardown
+            processes.append(subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+    print(f"Running {len(processes)} shards, logs in {args.report_dir}/shard-*.log")
+
+    start = time.monotonic()
+    try:
+        while any(p.poll() is None for p in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for p in processes:
+            if p.poll() is None:
+                p.send_signal(signal.SIGINT)
+        for p in processes:
+            p.wait()
+    for i, p in enumerate(processes):
+        print(f"[shard {i}] exit code {p.returncode}")
+    print(f"Job ran in {time.monotonic() - start:.0f}s")
+
+    merge_junit_reports([f"{args.report_dir}/shard-{i}.xml" for i in range(len(cmds))], report)
+    print(f"Merged report: {report}")
+    sys.exit(next((p.returncode for p in processes if p.returncode), 0))
+
+def action_run(args: argparse.Namespace) -> None:
+    pool_sets = args.hosts.split(";")
     # check that enough pool masters have been provided
-    nb_pools = len(args.hosts.split(","))
     job_nb_pools = JOBS[args.job]["nb_pools"]
     assert isinstance(job_nb_pools, int)
-    if nb_pools < job_nb_pools:
-        print(f"Error: only {nb_pools} master host(s) provided, {job_nb_pools} required.")
-        sys.exit(1)
+    for hosts in pool_sets:
+        nb_pools = len(hosts.split(","))
+        if nb_pools < job_nb_pools:
+            print(f"Error: only {nb_pools} master host(s) provided in {hosts!r}, {job_nb_pools} required.")
+            sys.exit(1)
+
+    if len(pool_sets) > 1:
+        run_shards(args, pool_sets)
+        return
+
+    cmd = build_pytest_cmd(JOBS[args.job], args.hosts, None, args.pytest_args)
+    print(subprocess.list2cmdline(cmd))
+    if args.print_only:
+        return
 
     # Use `execvp` instead of `subprocess.run` to avoid signal handling issues.
     # With `subprocess.run`, both the Python parent and the pytest child are in
@@ -862,7 +1136,11 @@ def main() -> None:
     run_parser.add_argument("--print-only", "-p", action="store_true",
                             help="print the command, but don't run it. Must be specified before positional arguments.")
     run_parser.add_argument("job", help="name of the job to run.", choices=JOBS.keys(), metavar="job")
-    run_parser.add_argument("hosts", help="master host(s) of pools to run the tests on, comma-separated.")
+    run_parser.add_argument("--report-dir", default="jobs-report",
+                            help="where to write the logs and merged JUnit report of sharded runs.")
+    run_parser.add_argument("hosts", help="master host(s) of pools to run the tests on, comma-separated."
+                                          " Several sets of pools separated by ';' split the job in shards that"
+                                          " run concurrently, one per set.")
     run_parser.add_argument("pytest_args", nargs=argparse.REMAINDER,
                             help="all additional arguments after the last positional argument will "
                                  "be passed to pytest and replace default job params if needed.")
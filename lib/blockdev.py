@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import json
+import re
+from dataclasses import dataclass, field
+
+from typing import Any, Iterator
+
+RAID_TYPES = {'raid0', 'raid1', 'raid4', 'raid5', 'raid6', 'raid10', 'linear'}
+USED_TYPES = RAID_TYPES | {'lvm', 'mpath', 'crypt'}
+LSBLK_FIELDS = 'NAME,KNAME,PKNAME,SIZE,LOG-SEC,TYPE,MOUNTPOINT,WWN'
+# The device major numbers we have on an xcp-ng host, except 254 (tapdev) and 202 (xvd)
+# From /dev/devices:
+#   8 sd
+#   9 md
+#  65 sd
+#  66 sd
+#  67 sd
+#  68 sd
+#  69 sd
+#  70 sd
+#  71 sd
+# 128 sd
+# 129 sd
+# 130 sd
+# 131 sd
+# 132 sd
+# 133 sd
+# 134 sd
+# 135 sd
+# 252 mdp
+# 253 device-mapper
+# 259 blkext
+LSBLK_MAJOR_NUMBERS = '8,9,65,66,67,68,69,70,71,128,129,130,131,132,133,134,135,252,253,259'
+LSBLK_ARGS = f'--bytes --output {LSBLK_FIELDS} --include {LSBLK_MAJOR_NUMBERS}'
+# A line of `lsblk --pairs`, which always quotes values and escapes quotes in them
+_PAIRS_LINE = re.compile(' '.join(f'{key}="(.*?)"' for key in LSBLK_FIELDS.split(',')) + '$', re.MULTILINE)
+
+# Data extraction is automatic, no conversion from str is done.
+@dataclass
+class BlockDeviceInfo:
+    name: str       # short kernel name: "sda", "md0", "dm-3"
+    path: str       # full device path: "/dev/sda", "/dev/md/myarray", "/dev/mapper/mpathb"
+    size: int       # bytes
+    log_sec: int    # logical sector size
+    type: str       # "disk", "md", "mpath"
+    available: bool # not mounted, not member of md/lvm/mpath/zfs
+    wwn: str = ''   # LUN WWN (hex, no 0x prefix); same LUN has same WWN across hosts
+
+@dataclass
+class BlockDevice:
+    """ A device reported by lsblk, linked to the devices it is built on and the devices built on it. """
+    kname: str
+    name: str
+    size: int
+    log_sec: int
+    type: str
+    mountpoint: str
+    wwn: str
+    # knames of the devices this one is built on: the disk of a partition, the paths of a multipath device,
+    # the members of an md array
+    parents: set[str] = field(default_factory=set)
+    # knames of the devices built on this one: partitions and holders (md, lvm, mpath, crypt)
+    children: set[str] = field(default_factory=set)
+
+def lsblk_command(device: str | None = None) -> str:
+    """
+    The lsblk command listing all the block devices, or `device` and the devices built on it.
+
+    `--json --tree` needs util-linux 2.33, older versions fall back to the `--pairs` output.
+    """
+    target = f' /dev/{device}' if device else ''
+    return f'lsblk --json --tree {LSBLK_ARGS}{target} 2>/dev/null || lsblk --pairs {LSBLK_ARGS}{target}'
+
+def _text(value: Any) -> str:
+    # lsblk >= 2.33 writes null for empty values and numbers for sizes, older versions only strings
+    return '' if value is None else str(value)
+
+def _device(entry: dict[str, Any]) -> BlockDevice:
+    return BlockDevice(
+        kname=_text(entry['kname']),
+        name=_text(entry['name']),
+        size=int(entry['size']),
+        log_sec=int(entry['log-sec']),
+        type=_text(entry['type']),
+        mountpoint=_text(entry['mountpoint']),
+        wwn=_text(entry['wwn']),
+    )
+
+def parse_lsblk(output: str) -> Iterator[tuple[BlockDevice, str | None]]:
+    """
+    Each device of an lsblk output, `--json` or `--pairs`, with the kname of its parent, in the order of the tree.
+
+    A device built on several devices appears once under each of them, with the devices built on it.
+    """
+    output = output.strip()
+    if not output.startswith('{'):
+        for name, kname, pkname, size, log_sec, dev_type, mountpoint, wwn in _PAIRS_LINE.findall(output):
+            yield BlockDevice(kname, name, int(size), int(log_sec), dev_type, mountpoint, wwn), pkname or None
+        return
+    # the roots of a tree rooted at a given device still have their parent in PKNAME
+    stack = [(entry, _text(entry.get('pkname')) or None) for entry in reversed(json.loads(output)['blockdevices'])]
+    while stack:
+        entry, parent = stack.pop()
+        device = _device(entry)
+        yield device, parent
+        stack.extend((child, device.kname) for child in reversed(entry.get('children', [])))
+
+class BlockDeviceGraph:
+    """
+    The block devices of a host, indexed by kname and WWN, built from the lsblk output.
+
+    lsblk lists a device once under each device it is built on, and all the devices built on it with each of
+    these occurrences: the graph keeps each device once, so that the availability of all devices is computed in a
+    single pass, whatever the number of paths of multipath devices.
+    """
+
+    def __init__(self) -> None:
+        self.devices: dict[str, BlockDevice] = {}
+        # knames of the devices having each WWN, disk paths of a LUN and their partitions
+        self.wwns: dict[str, set[str]] = {}
+        # position of each kname in the lsblk output when first seen, to keep its order across refreshes
+        self._order: dict[str, int] = {}
+
+    @classmethod
+    def from_lsblk(cls, output: str) -> BlockDeviceGraph:
+        graph = cls()
+        graph._add(output)
+        return graph
+
+    def _add(self, output: str) -> set[str]:
+        """ Add the devices of an lsblk output, and return their knames. """
+        seen: set[str] = set()
+        for device, parent in parse_lsblk(output):
+            seen.add(device.kname)
+            known = self.devices.get(device.kname)
+            if known is None:
+                self.devices[device.kname] = device
+                self._order.setdefault(device.kname, len(self._order))
+                self._index_wwn(device.kname, '', device.wwn)
+            else:
+                if known.wwn != device.wwn:
+                    self._index_wwn(known.kname, known.wwn, device.wwn)
+                known.name, known.size, known.log_sec = device.name, device.size, device.log_sec
+                known.type, known.mountpoint, known.wwn = device.type, device.mountpoint, device.wwn
+            if parent is not None and parent in self.devices:
+                self.devices[parent].children.add(device.kname)
+                self.devices[device.kname].parents.add(parent)
+        return seen
+
+    def _remove(self, kname: str) -> None:
+        device = self.devices.pop(kname)
+        for parent in device.parents:
+            if parent in self.devices:
+                self.devices[parent].children.discard(kname)
+        self._index_wwn(kname, device.wwn, '')
+
+    def _index_wwn(self, kname: str, old: str, new: str) -> None:
+        if old:
+            self.wwns[old].discard(kname)
+            if not self.wwns[old]:
+                del self.wwns[old]
+        if new:
+            self.wwns.setdefault(new, set()).add(kname)
+
+    def descendants(self, kname: str) -> list[str]:
+        """ `kname` and the knames of all the devices built on it, directly or not. """
+        found = {kname}
+        pending = [kname]
+        while pending:
+            for child in self.devices[pending.pop()].children:
+                if child not in found:
+                    found.add(child)
+                    pending.append(child)
+        return sorted(found, key=self._order.__getitem__)
+
+    def refresh(self, kname: str, output: str) -> None:
+        """
+        Replace `kname` and the devices built on it by the ones of `output`, the lsblk output for this device only.
+
+        The devices built on it and on other devices too, such as a multipath device when refreshing one of its
+        paths, are kept with their other parents.
+        """
+        subtree = self.descendants(kname) if kname in self.devices else []
+        for name in subtree:
+            for child in self.devices[name].children:
+                self.devices[child].parents.discard(name)
+            self.devices[name].children.clear()
+        for name in subtree:
+            if name != kname and not self.devices[name].parents:
+                self._remove(name)
+        # kname keeps its parents, which a tree rooted at it doesn't list all
+        if kname not in self._add(output) and kname in self.devices:
+            self._remove(kname)
+
+    def available(self) -> dict[str, bool]:
+        """
+        Whether each device is free: no mountpoint, not a "used" type (lvm, md, mpath, crypt member), and all the
+        devices built on it free.
+        """
+        available: dict[str, bool] = {}
+        # children first: iterative post-order walk, as chains of holders can be deep
+        for root in self.devices:
+            if root in available:
+                continue
+            stack = [(root, False)]
+            while stack:
+                kname, expanded = stack.pop()
+                device = self.devices[kname]
+                if expanded:
+                    available[kname] = (not device.mountpoint and device.type not in USED_TYPES
+                                        and all(available[c] for c in device.children))
+                elif kname not in available:
+                    stack.append((kname, True))
+                    stack.extend((c, False) for c in device.children if c not in available)
+        return available
+
+    def devices_info(self) -> list[BlockDeviceInfo]:
+        """
+        Local disks, mdadm arrays, and multipath devices, largest first.
+
+        Handled device scenarios and their effect on `available`:
+
+        - Plain disk, no children: available unless the disk itself has a
+          mountpoint.
+        - Partitioned disk: available if no partition is mounted and no partition
+          has a used child (lvm, md, mpath, crypt); unavailable otherwise.
+        - Disk member of an mdadm array: the disk itself is unavailable; the md
+          array is added as a separate entry (type 'md'), once whatever its number
+          of members, and available if it has no mountpoint and no used children.
+        - LUN with multipath configured: each path appears as a 'disk' entry and
+          a shared 'mpath' entry as its child. The path disks are unavailable
+          (mpath child); the mpath device is added once (type 'mpath').
+        - LUN accessible through multiple paths without multipath configured:
+          multiple 'disk' entries with no children but sharing the same WWN.
+          Deduplicated to a single entry (first path seen) based on WWN.
+        """
+        available = self.available()
+
+        def _children_available(device: BlockDevice) -> bool:
+            return not device.mountpoint and all(available[c] for c in device.children)
+
+        devices: list[BlockDeviceInfo] = []
+        seen_wwns: set[str] = set()
+        for device in sorted(self.devices.values(), key=lambda d: self._order[d.kname]):
+            if device.type == 'disk' and not device.parents:
+                if device.wwn:
+                    if device.wwn in seen_wwns:
+                        continue
+                    seen_wwns.add(device.wwn)
+                devices.append(BlockDeviceInfo(
+                    name=device.name,
+                    path=f'/dev/{device.name}',
+                    size=device.size,
+                    log_sec=device.log_sec,
+                    type='disk',
+                    available=available[device.kname],
+                    wwn=device.wwn.removeprefix('0x'),
+                ))
+            elif device.type in RAID_TYPES:
+                devices.append(BlockDeviceInfo(
+                    name=device.name,
+                    path=f'/dev/{device.name}',
+                    size=device.size,
+                    log_sec=device.log_sec,
+                    type='md',
+                    available=_children_available(device),
+                ))
+            elif device.type == 'mpath':
+                devices.append(BlockDeviceInfo(
+                    name=device.kname,
+                    path=f'/dev/mapper/{device.name}',
+                    size=device.size,
+                    log_sec=device.log_sec,
+                    type='mpath',
+                    available=_children_available(device),
+                    wwn=device.name[1:17] if re.fullmatch(r'3[0-9a-f]{32}', device.name) else '',
+                ))
+        return sorted(devices, key=lambda d: d.size, reverse=True)
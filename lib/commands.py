@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 import base64
+import gzip
 import logging
 import os
 import platform
+import re
 import subprocess
 import tempfile
+import threading
+import time
 
 import lib.config as config
 from lib.netutil import wrap_ip
@@ -63,30 +67,78 @@ class LocalCommandResult(BaseCmdResult[ResultOutputT]):
     def __init__(self, returncode: int, stdout: ResultOutputT):
         super(LocalCommandResult, self).__init__(returncode, stdout)
 
-def _ellide_log_lines(log: str) -> str:
-    if log == '':
-        return log
+# Number of remote commands run so far, see remote_call_count()
+_remote_calls = 0
+_remote_calls_lock = threading.Lock()
 
-    if config.ssh_output_max_lines < 1:
-        return "\n{}".format(log)
+def count_remote_call() -> None:
+    global _remote_calls
+    with _remote_calls_lock:
+        _remote_calls += 1
 
-    reduced_message = log.split("\n")
-    if len(reduced_message) > config.ssh_output_max_lines:
-        reduced_message = reduced_message[:config.ssh_output_max_lines - 1]
-        reduced_message.append("(...)")
-    return "\n{}".format("\n".join(reduced_message))
+def remote_call_count() -> int:
+    """
+    Number of remote commands (ssh, scp, sftp, XO calls) run so far, for profiling.
 
-def _ssh(
-    hostname_or_ip: str,
-    cmd: str,
-    check: bool,
-    simple_output: bool,
-    suppress_fingerprint_warnings: bool,
-    background: bool,
-    decode: bool,
-    options: list[str],
-    multiplexing: bool,
-) -> SSHResult[str] | SSHResult[bytes] | SSHCommandFailed | str | bytes | None:
+    The count is for the whole process: the difference between two calls includes the commands of all the threads.
+    """
+    return _remote_calls
+
+def _ellide_log_lines(log: bytes, full_log: str | None = None) -> str:
+    """ The first lines of a command output, for the logs. Only these lines are split and decoded. """
+    log = log.strip()
+    if not log:
+        return ''
+
+    if config.ssh_output_max_lines < 1:
+        lines = [log]
+    else:
+        lines = log.split(b"\n", config.ssh_output_max_lines)
+        if len(lines) > config.ssh_output_max_lines:
+            lines = lines[:config.ssh_output_max_lines - 1]
+            lines.append(b"(...)")
+    message = "\n{}".format(b"\n".join(lines).decode(errors='replace'))
+    if full_log is not None:
+        message += f"\n(full output in {full_log})"
+    return message
+
+# Output logs are named after the test running the command, and written in one piece per command
+_output_log_lock = threading.Lock()
+_OUTPUT_LOG_NAME_RE = re.compile(r"[^\w.\[\]=-]+")
+
+def _write_output_log(hostname_or_ip: str, cmd: str, returncode: int, output: bytes) -> str:
+    """
+    Append the output of a command to the compressed output log of the host for the current test, and return
+    its path.
+
+    Each command is compressed as a separate gzip member: the log is read with zcat or zless.
+    """
+    assert config.ssh_output_log_dir is not None
+    # PYTEST_CURRENT_TEST: "<nodeid> (<phase>)"
+    test = os.environ.get("PYTEST_CURRENT_TEST", "session").rsplit(" (", 1)[0]
+    directory = os.path.join(config.ssh_output_log_dir, _OUTPUT_LOG_NAME_RE.sub("_", str(hostname_or_ip)))
+    path = os.path.join(directory, _OUTPUT_LOG_NAME_RE.sub("_", test)[-200:] + ".log.gz")
+    header = f"### {time.strftime('%Y-%m-%d %H:%M:%S')} {cmd} (exit code {returncode})\n".encode()
+    data = gzip.compress(header + output, compresslevel=6)
+    os.makedirs(directory, exist_ok=True)
+    with _output_log_lock, open(path, "ab") as f:
+        f.write(data)
+    return path
+
+def _log_output(hostname_or_ip: str, cmd: str, returncode: int, output: bytes) -> None:
+    """
+    Write the output of a command to the output logs if enabled, and its first lines to the debug log.
+
+    Nothing is done with the output when there is no output log and the debug level is disabled.
+    """
+    full_log = None
+    if config.ssh_output_log_dir is not None and output:
+        full_log = _write_output_log(hostname_or_ip, cmd, returncode, output)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        errorcode_msg = "" if returncode == 0 else " - Got error code: %s" % returncode
+        logging.debug(f"[{hostname_or_ip}] {cmd}{errorcode_msg}{_ellide_log_lines(output, full_log)}")
+
+def _ssh_options(options: list[str], suppress_fingerprint_warnings: bool, multiplexing: bool) -> list[str]:
     opts = list(options)
     opts += ['-o', 'BatchMode yes']
     opts += ['-o', 'PubkeyAcceptedKeyTypes +ssh-rsa']
@@ -108,6 +160,21 @@ def _ssh(
         opts += ['-o', 'ServerAliveInterval 10s']
     else:
         opts += ['-o', 'ControlMaster no']
+    return opts
+
+def _ssh(
+    hostname_or_ip: str,
+    cmd: str,
+    check: bool,
+    simple_output: bool,
+    suppress_fingerprint_warnings: bool,
+    background: bool,
+    decode: bool,
+    options: list[str],
+    multiplexing: bool,
+) -> SSHResult[str] | SSHResult[bytes] | SSHCommandFailed | str | bytes | None:
+    opts = _ssh_options(options, suppress_fingerprint_warnings, multiplexing)
+    count_remote_call()
 
     # Fetch banner and remove it to avoid stdout/stderr pollution.
     banner_res = None
@@ -144,14 +211,21 @@ def _ssh(
             stderr=subprocess.STDOUT
         )
 
-        stdout = []
-        assert process.stdout is not None
-        for line in iter(process.stdout.readline, b''):
-            readable_line = line.decode(errors='replace').strip()
-            stdout.append(line)
-            logging.debug("> %s", readable_line)
-        _, stderr = process.communicate()
-        res = subprocess.CompletedProcess(ssh_cmd, process.returncode, b''.join(stdout), stderr)
+        if config.ssh_output_log_dir is None and logging.root.isEnabledFor(logging.DEBUG):
+            # log each line as it comes, to follow long commands
+            stdout = []
+            assert process.stdout is not None
+            for line in iter(process.stdout.readline, b''):
+                readable_line = line.decode(errors='replace').strip()
+                stdout.append(line)
+                logging.debug("> %s", readable_line)
+            _, stderr = process.communicate()
+            res = subprocess.CompletedProcess(ssh_cmd, process.returncode, b''.join(stdout), stderr)
+        else:
+            # read the output in one piece, and only log a summary
+            stdout_bytes, stderr = process.communicate()
+            res = subprocess.CompletedProcess(ssh_cmd, process.returncode, stdout_bytes, stderr)
+            _log_output(hostname_or_ip, cmd, res.returncode, res.stdout)
 
         ssherr = ssh_log_file.read()
 
@@ -258,6 +332,20 @@ def ssh_with_result(hostname_or_ip: HostAddress, cmd: str, *, suppress_fingerpri
         return result_or_exc
     assert False, "unexpected type"
 
+def ssh_stream(hostname_or_ip: HostAddress, cmd: str, *, suppress_fingerprint_warnings: bool = True,
+               options: List[str] = []) -> subprocess.Popen[bytes]:
+    """
+    Start a long-running remote command and return the process, to read its output as it comes.
+
+    The connection is not multiplexed, so that it does not keep a shared master connection alive.
+    stderr is merged into stdout. The caller is responsible for terminating the process.
+    """
+    opts = _ssh_options(options + ['-o', 'ServerAliveInterval 10s'], suppress_fingerprint_warnings, False)
+    ssh_cmd = ['ssh', f'root@{hostname_or_ip}'] + opts + [cmd]
+    logging.debug(f"[{hostname_or_ip}] {cmd} (streaming)")
+    count_remote_call()
+    return subprocess.Popen(ssh_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
 def scp(hostname_or_ip: HostAddress, src: str, dest: str, check: bool = True,
         suppress_fingerprint_warnings: bool = True, local_dest: bool = False) -> subprocess.CompletedProcess[bytes]:
     opts = ['-o', 'BatchMode=yes']
@@ -274,6 +362,7 @@ def scp(hostname_or_ip: HostAddress, src: str, dest: str, check: bool = True,
         dest = 'root@{}:{}'.format(ip, dest)
 
     command = ['scp'] + opts + [src, dest]
+    count_remote_call()
     res = subprocess.run(
         command,
         stdout=subprocess.PIPE,
@@ -301,6 +390,7 @@ def sftp(
 
     args = "sftp {} -b - root@{}".format(opts, hostname_or_ip)
     input_bytes = bytes("\n".join(cmds), 'utf-8')
+    count_remote_call()
     res = subprocess.run(
         args,
         input=input_bytes,
@@ -343,15 +433,11 @@ def local_cmd(
         cwd=cwd,
     )
 
-    # get a decoded version of the output in any case, replacing potential errors
-    output_for_logs = res.stdout.decode(errors='replace').strip()
-
-    errorcode_msg = "" if res.returncode == 0 else " - Got error code: %s" % res.returncode
     command = " ".join(cmd)
-    logging.debug(f"[local] {command}{errorcode_msg}{_ellide_log_lines(output_for_logs)}")
+    _log_output("local", command, res.returncode, res.stdout)
 
     if res.returncode and check:
-        raise LocalCommandFailed(res.returncode, output_for_logs, command)
+        raise LocalCommandFailed(res.returncode, res.stdout.decode(errors='replace').strip(), command)
 
     if decode:
         return LocalCommandResult[str](res.returncode, res.stdout.decode())
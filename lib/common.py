@@ -1,32 +1,34 @@
 from __future__ import annotations
 
-import pytest
-
+import contextlib
+import fcntl
 import getpass
+import hashlib
 import inspect
 import itertools
+import json
 import logging
 import os
 import random
+import re
 import string
 import sys
-import tempfile
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 from functools import lru_cache
 from pathlib import Path
+from urllib.parse import urlparse
 from uuid import UUID
 
-import requests
-from passlib.hash import sha512_crypt
-from pydantic import TypeAdapter
-
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
+    Iterator,
     Literal,
     TypeAlias,
     TypeVar,
@@ -35,6 +37,10 @@ from typing import (
 )
 
 if TYPE_CHECKING:
+    import pytest
+
+    from pydantic import TypeAdapter
+
     from lib.host import Host
 
 
@@ -134,6 +140,8 @@ def expand_scope_relative_nodeid(scoped_nodeid: str, scope: str, ref_nodeid: str
 
 @lru_cache(maxsize=None)
 def _get_type_adapter(tp: Any) -> TypeAdapter[Any]:
+    # pydantic is slow to import, and only needed when a type is checked
+    from pydantic import TypeAdapter
     return TypeAdapter(tp)
 
 @overload
@@ -179,6 +187,8 @@ def callable_marker(value: T | Callable[..., T], request: pytest.FixtureRequest)
     return a value.  The callable may take as parameters any subset of
     the fixture names the test itself uses.
     """
+    import pytest  # only needed in fixtures, not by the tools
+
     if callable(value):
         try:
             params = {arg_name: request.getfixturevalue(arg_name)
@@ -237,6 +247,26 @@ def parse_xe_dict(xe_dict: str) -> dict[str, str]:
         res[key.strip()] = value.strip()
     return res
 
+# Example: "     name-label ( RW): my VM", "other-config (MRW): key: value"
+_XE_RECORD_FIELD_RE = re.compile(r"^\s*(\S+) \(\s?[MS]?R[OW]\)\s*: ?(.*)$")
+
+def parse_xe_records(output: str) -> list[dict[str, str]]:
+    """
+    Parses the output of a xe *-list command with `params=...`: one record per object, separated by empty lines.
+
+    Data type remains str for all values.
+    """
+    records = []
+    for block in re.split(r"\n\s*\n", output.strip()):
+        record = {}
+        for line in block.splitlines():
+            m = _XE_RECORD_FIELD_RE.match(line)
+            if m is not None:
+                record[m.group(1)] = m.group(2).strip()
+        if record:
+            records.append(record)
+    return records
+
 def safe_split(text: str, sep: str = ',') -> list[str]:
     """ A split function that returns an empty list if the input string is empty. """
     return text.split(sep) if len(text) > 0 else []
@@ -321,31 +351,222 @@ def strtobool(val: str | None) -> bool:
         return False
     raise ValueError("invalid truth value '{}'".format(val))
 
-def url_download(url: str, filename: str) -> None:
-    """
-    Download the content of `url` to the `filename` destination.
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_CHUNK_SIZE = 16 * MiB
+DOWNLOAD_INDEX = "index.json"
 
-    A randomized filename is used during download to prevent file corruption on
-    concurrent use. If the download fails then the temporary file is removed.
-    """
-    destination = Path(filename)
+class DownloadError(Exception):
+    pass
+
+@contextlib.contextmanager
+def _download_lock(destination: Path) -> Iterator[None]:
+    """ Serialize downloads to the same destination, including across test sessions. """
     destination.parent.mkdir(parents=True, exist_ok=True)
-    with requests.get(url, stream=True) as r:
+    with open(destination.with_name(f".{destination.name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _remote_file_info(url: str) -> tuple[int | None, bool, str | None]:
+    """ Return the size of the remote file, whether range requests are supported, and its ETag/Last-Modified. """
+    import requests  # slow to import, only load it when downloading
+    r = requests.head(url, allow_redirects=True, timeout=60)
+    if not r.ok:
+        return None, False, None
+    length = r.headers.get('Content-Length')
+    size = int(length) if length is not None else None
+    ranges = r.headers.get('Accept-Ranges') == 'bytes' and bool(size)
+    return size, ranges, r.headers.get('ETag') or r.headers.get('Last-Modified')
+
+def _download_stream(url: str, part: Path) -> None:
+    import requests
+    with requests.get(url, stream=True, timeout=60) as r:
         r.raise_for_status()
-        temp_name: str | None = None
         try:
-            with tempfile.NamedTemporaryFile(
-                dir=destination.parent, prefix=f"{destination.name}.", suffix=".part", delete=False
-            ) as fd:
-                temp_name = fd.name
-                for chunk in r.iter_content(chunk_size=64 * 1024):
+            with open(part, "wb") as fd:
+                for chunk in r.iter_content(chunk_size=1 * MiB):
                     fd.write(chunk)
         except BaseException:
-            if temp_name is not None:
-                os.unlink(temp_name)
+            part.unlink(missing_ok=True)
             raise
-        else:
-            os.rename(temp_name, filename)
+
+def _download_ranges(url: str, part: Path, size: int, validator: str | None, connections: int) -> None:
+    """
+    Download `url` to `part` in DOWNLOAD_CHUNK_SIZE ranges over parallel connections.
+
+    Completed chunks are recorded in a state file next to `part`, so that a later call resumes the download
+    if the remote file did not change (same size and ETag/Last-Modified).
+    """
+    state_file = part.with_name(f"{part.name}.json")
+    state: dict[str, Any] = dict(url=url, size=size, validator=validator, chunk_size=DOWNLOAD_CHUNK_SIZE)
+    nchunks = -(-size // DOWNLOAD_CHUNK_SIZE)
+
+    done: set[int] = set()
+    if validator is not None and part.exists():
+        try:
+            with open(state_file) as f:
+                saved = json.load(f)
+            if all(saved.get(key) == value for key, value in state.items()):
+                done = set(saved['done'])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+    if done:
+        logging.info("Resuming download of %s: %d/%d chunks already downloaded", url, len(done), nchunks)
+    else:
+        with open(part, "wb"):
+            pass
+    os.truncate(part, size)
+
+    import requests
+
+    state_lock = threading.Lock()
+    sessions = threading.local()
+
+    def fetch(chunk: int) -> None:
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        start = chunk * DOWNLOAD_CHUNK_SIZE
+        end = min(size, start + DOWNLOAD_CHUNK_SIZE)
+        with sessions.session.get(url, headers={'Range': f'bytes={start}-{end - 1}'},
+                                  stream=True, timeout=60) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise DownloadError(f"server ignored range request for {url}")
+            offset = start
+            with open(part, "r+b") as fd:
+                fd.seek(start)
+                for data in r.iter_content(chunk_size=1 * MiB):
+                    fd.write(data[:end - offset])
+                    offset += len(data)
+        if offset < end:
+            raise DownloadError(f"short read for {url} at offset {offset}, expected {end}")
+        if validator is None:
+            return
+        with state_lock:
+            done.add(chunk)
+            tmp_state = state_file.with_name(f"{state_file.name}.tmp")
+            with open(tmp_state, "w") as f:
+                json.dump(dict(state, done=sorted(done)), f)
+            os.replace(tmp_state, state_file)
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(fetch, sorted(set(range(nchunks)) - done)))
+    state_file.unlink(missing_ok=True)
+
+def _download(url: str, destination: Path, sha256: str | None, connections: int) -> str | None:
+    """ Download `url` to `destination` without locking, and return the remote ETag/Last-Modified. """
+    part = destination.with_name(f"{destination.name}.part")
+    size, ranges, validator = _remote_file_info(url)
+    start = time.monotonic()
+    if ranges:
+        assert size is not None
+        _download_ranges(url, part, size, validator, connections)
+    else:
+        _download_stream(url, part)
+    logging.info("Downloaded %s (%d bytes) in %.1fs", url, part.stat().st_size, time.monotonic() - start)
+
+    if sha256 is not None:
+        actual = file_sha256(str(part))
+        if actual != sha256.lower():
+            part.unlink()
+            raise DownloadError(f"checksum mismatch for {url}: expected sha256 {sha256}, got {actual}")
+    os.replace(part, destination)
+    return validator
+
+def url_download(url: str, filename: str, *, sha256: str | None = None,
+                 connections: int = DOWNLOAD_CONNECTIONS) -> None:
+    """
+    Download the content of `url` to the `filename` destination.
+
+    When the server supports HTTP range requests, the file is downloaded in chunks over `connections`
+    parallel connections, and an interrupted download is resumed from `<filename>.part` by the next call
+    for the same file. The content is checked against `sha256` if given, and `filename` is only
+    replaced once the download is complete and verified. Concurrent downloads of the same file are
+    serialized.
+    """
+    destination = Path(filename)
+    with _download_lock(destination):
+        _download(url, destination, sha256, connections)
+
+def _update_download_index(cache_dir: Path, url: str, entry: dict[str, Any]) -> None:
+    index_file = cache_dir / DOWNLOAD_INDEX
+    with _download_lock(index_file):
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {}
+        index[url] = entry
+        tmp_index = index_file.with_name(f"{index_file.name}.tmp")
+        with open(tmp_index, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_index, index_file)
+
+def cached_url_download(url: str, filename: str | None = None, *, sha256: str | None = None,
+                        revalidate: bool = False, cache_dir: str | None = None) -> str:
+    """
+    Return the path of a local copy of `url`, downloading it into the download cache if needed.
+
+    All downloads share a cache directory (ISO_IMAGES_CACHE by default) and its index, which records the
+    URL, size, SHA-256 and ETag/Last-Modified of each file. `filename` defaults to the basename of the URL,
+    prefixed with a hash of the URL to avoid collisions.
+    A cached file is reused if it matches the expected `sha256`, and with `revalidate` if the remote file
+    did not change. Files already in the cache but not in the index are adopted as is, which allows
+    providing files manually.
+    """
+    if cache_dir is None:
+        from data import ISO_IMAGES_CACHE  # import here to avoid depending on this user file for collecting tests
+        cache_dir = ISO_IMAGES_CACHE
+    cache_path = Path(cache_dir)
+    if filename is None:
+        url_hash = hashlib.sha256(url.encode()).hexdigest()[:12]
+        filename = f"{url_hash}-{os.path.basename(urlparse(url).path)}"
+    destination = cache_path / filename
+
+    with _download_lock(destination):
+        try:
+            with open(cache_path / DOWNLOAD_INDEX) as f:
+                entry = json.load(f).get(url)
+        except FileNotFoundError:
+            entry = None
+
+        if destination.exists():
+            size = destination.stat().st_size
+            if entry is None:
+                if sha256 is None or file_sha256(str(destination)) == sha256.lower():
+                    logging.info("Adding %s to the download index for %s", destination, url)
+                    _update_download_index(cache_path, url, dict(filename=destination.name, size=size,
+                                                                 sha256=file_sha256(str(destination)),
+                                                                 validator=None))
+                    return str(destination)
+            elif (entry['filename'] == destination.name and entry['size'] == size
+                  and (sha256 is None or entry['sha256'] == sha256.lower())
+                  and (not revalidate or _remote_file_info(url)[2] in (None, entry['validator']))):
+                logging.info("Using cached %s for %s", destination, url)
+                return str(destination)
+
+        logging.info("Downloading %r into %r", url, str(destination))
+        validator = _download(url, destination, sha256, DOWNLOAD_CONNECTIONS)
+        _update_download_index(cache_path, url, dict(filename=destination.name, size=destination.stat().st_size,
+                                                     sha256=file_sha256(str(destination)), validator=validator))
+    return str(destination)
+
+@lru_cache(maxsize=None)
+def _file_sha256(path: str, size: int, mtime_ns: int) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_sha256(filename: str) -> str:
+    """
+    Return the SHA-256 hex digest of the content of a local file.
+
+    The digest is memoized as long as the file keeps the same path, size and modification time,
+    so that large files (ISOs, images) are hashed only once per session.
+    """
+    st = os.stat(filename)
+    return _file_sha256(os.path.realpath(filename), st.st_size, st.st_mtime_ns)
 
 def randid(length: int = 6) -> str:
     """
@@ -423,5 +644,7 @@ def _param_clear(host: Host, xe_prefix: str, uuid: str, param_name: str) -> None
 
 def hash_password(password: str) -> str:
     """Hash password for /etc/shadow."""
+    from passlib.hash import sha512_crypt
+
     # XCP-ng uses sha512 with 5000 rounds by default
     return sha512_crypt.using(rounds=5000).hash(password)
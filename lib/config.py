@@ -2,9 +2,18 @@ from lib.common import GiB
 
 ignore_ssh_banner = False
 ssh_output_max_lines = 20
+ssh_output_log_dir: str | None = None
 volume_size = 1 * GiB
 write_volume_cap = 2 * GiB
 write_volume_align = 1
+efi_key_cache: str | None = None
+efi_key_cache_max_age = 7
+efi_key_pool_size = 4
+efi_keys_seed: str | None = None
+remastered_iso_cache: str | None = None
+remastered_iso_cache_size = 20 * GiB
+rpm_cache: str | None = None
+rpm_cache_port = 0
 
 def sr_device_config(datakey: str, *, required: list[str] = []) -> dict[str, str]:
     import data  # import here to avoid depending on this user file for collecting tests
@@ -1,11 +1,29 @@
-from dataclasses import dataclass
+from __future__ import annotations
+
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 from lib.host import Host
 
-from typing import Literal
+from typing import Iterable
 
 NO_SUBLEAF = 0xffffffff
 
+REGISTERS = ("eax", "ebx", "ecx", "edx")
+
+# Example: "Raw policy: 32 leaves, 2 MSRs"
+_POLICY_HEADER_RE = re.compile(r"^(.*?)\s*policy:.*$", re.MULTILINE)
+# Example: "00000004:00000003 -> 1c03c163:02c0003f:00001fff:00000006"
+_CPUID_RE = re.compile(
+    r"^\s*([0-9a-fA-F]{8}):([0-9a-fA-F]{8})\s*->\s*"
+    r"([0-9a-fA-F]{8}):([0-9a-fA-F]{8}):([0-9a-fA-F]{8}):([0-9a-fA-F]{8})\s*$",
+    re.MULTILINE,
+)
+# Example: "0000010a -> 400000000c000000"
+_MSR_RE = re.compile(r"^\s*([0-9a-fA-F]{8})\s*->\s*([0-9a-fA-F]+)\s*$", re.MULTILINE)
+
 @dataclass(frozen=True)
 class CpuidRegisters:
     eax: int
@@ -13,81 +31,154 @@ class CpuidRegisters:
     ecx: int
     edx: int
 
+@dataclass(frozen=True)
+class CpuidDifference:
+    """A CPUID register that differs. Values are None when the leaf is missing on one side."""
+    leaf: int
+    subleaf: int
+    register: str
+    left: int | None
+    right: int | None
+
+@dataclass(frozen=True)
+class MsrDifference:
+    """An MSR that differs. Values are None when the MSR is missing on one side."""
+    index: int
+    left: int | None
+    right: int | None
+
+@dataclass
+class CpuPolicyDiff:
+    cpuid: list[CpuidDifference] = field(default_factory=list)
+    msr: list[MsrDifference] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.cpuid or self.msr)
+
 class CpuPolicy:
-    """A specific CPU policy (PV, HVM, ...)"""
-    # (leaf, subleaf) -> (eax, ebx, ecx, edx)
-    cpuid: dict[tuple[int, int], CpuidRegisters]
-    # msr -> val
-    msr: dict[int, int]
+    """
+    A specific CPU policy (PV, HVM, ...)
+
+    The policy is stored in packed arrays sorted by key: CPUID leaves as (leaf << 32 | subleaf) with 4 registers
+    per leaf (eax, ebx, ecx, edx), and MSRs as index and value. Comparing policies compares whole arrays at once,
+    and only looks at individual entries when they differ.
+    """
+    leaves: array
+    registers: array
+    msr_indexes: array
+    msr_values: array
 
     def __init__(self, cpuid: dict[tuple[int, int], CpuidRegisters], msr: dict[int, int]):
-        self.cpuid = cpuid
-        self.msr = msr
+        self.leaves = array("Q")
+        self.registers = array("L")
+        for (leaf, subleaf), regs in sorted(cpuid.items()):
+            self.leaves.append(leaf << 32 | subleaf)
+            self.registers.extend((regs.eax, regs.ebx, regs.ecx, regs.edx))
+        self.msr_indexes = array("L", sorted(msr))
+        self.msr_values = array("Q", (msr[idx] for idx in self.msr_indexes))
+
+    @classmethod
+    def parse(cls, text: str) -> CpuPolicy:
+        """Parse the CPUID and MSR lines of one policy from the output of `xen-cpuid --policy`."""
+        policy = cls({}, {})
+        for leaf, subleaf, eax, ebx, ecx, edx in sorted(_CPUID_RE.findall(text)):
+            policy.leaves.append(int(leaf, 16) << 32 | int(subleaf, 16))
+            policy.registers.extend((int(eax, 16), int(ebx, 16), int(ecx, 16), int(edx, 16)))
+        for idx, val in sorted(_MSR_RE.findall(text)):
+            policy.msr_indexes.append(int(idx, 16))
+            policy.msr_values.append(int(val, 16))
+        return policy
+
+    @property
+    def cpuid(self) -> dict[tuple[int, int], CpuidRegisters]:
+        """(leaf, subleaf) -> (eax, ebx, ecx, edx)"""
+        return {
+            (key >> 32, key & 0xffffffff): CpuidRegisters(*self.registers[4 * i:4 * i + 4])
+            for i, key in enumerate(self.leaves)
+        }
+
+    @property
+    def msr(self) -> dict[int, int]:
+        """msr -> val"""
+        return dict(zip(self.msr_indexes, self.msr_values))
+
+    def diff(self, other: CpuPolicy) -> CpuPolicyDiff:
+        """Return the CPUID registers and MSRs that differ between this policy (left) and the other one (right)."""
+        diff = CpuPolicyDiff()
+
+        if self.leaves != other.leaves or self.registers != other.registers:
+            other_pos = {key: i for i, key in enumerate(other.leaves)}
+            self_keys = set(self.leaves)
+            for i, key in enumerate(self.leaves):
+                regs = self.registers[4 * i:4 * i + 4]
+                j = other_pos.get(key)
+                other_regs = None if j is None else other.registers[4 * j:4 * j + 4]
+                if regs == other_regs:
+                    continue
+                for r, name in enumerate(REGISTERS):
+                    right = None if other_regs is None else other_regs[r]
+                    if regs[r] != right:
+                        diff.cpuid.append(CpuidDifference(key >> 32, key & 0xffffffff, name, regs[r], right))
+            for j, key in enumerate(other.leaves):
+                if key not in self_keys:
+                    for r, name in enumerate(REGISTERS):
+                        diff.cpuid.append(
+                            CpuidDifference(key >> 32, key & 0xffffffff, name, None, other.registers[4 * j + r])
+                        )
+
+        if self.msr_indexes != other.msr_indexes or self.msr_values != other.msr_values:
+            self_msr = self.msr
+            other_msr = other.msr
+            for idx in sorted(self_msr.keys() | other_msr.keys()):
+                if self_msr.get(idx) != other_msr.get(idx):
+                    diff.msr.append(MsrDifference(idx, self_msr.get(idx), other_msr.get(idx)))
+
+        return diff
 
 class HostCpuPolicy:
     """All CPU policies of a host (CPUID, specific MSRs)"""
-    policies: dict[str, CpuPolicy] = {}
+    policies: dict[str, CpuPolicy]
 
     def __init__(self, host: Host):
+        self.host = host
+        self.policies = {}
+
         text = host.ssh("xen-cpuid --policy")
-        current_policy: CpuPolicy | None = None
-        mode: Literal["cpuid", "msr"] | None = None
-
-        lines = text.splitlines()
-
-        for line in lines:
-            line = line.rstrip()
-
-            # ---- Policy header ----
-            if "policy:" in line:
-                # Example: "Raw policy: 32 leaves, 2 MSRs"
-                name, rest = line.split("policy:", 1)
-                name = name.strip()
-
-                self.policies[name] = CpuPolicy(dict(), dict())
-                current_policy = self.policies[name]
-                mode = None
-                continue
-
-            if current_policy is None:
-                continue
-
-            # ---- Section switches ----
-            if line.strip() == "CPUID:":
-                mode = "cpuid"
-                continue
-
-            if line.strip() == "MSRs:":
-                mode = "msr"
-                continue
-
-            # Skip table headers
-            if "leaf" in line or "index" in line or not line.strip():
-                continue
-
-            # ---- CPUID parsing ----
-            if mode == "cpuid":
-                # Example:
-                # 00000004:00000003 -> 1c03c163:02c0003f:00001fff:00000006
-                left, right = line.split("->")
-                leaf_hex, subleaf_hex = left.strip().split(":")
-                eax, ebx, ecx, edx = right.strip().split(":")
-
-                key = (int(leaf_hex, 16), int(subleaf_hex, 16))
-                current_policy.cpuid[key] = CpuidRegisters(
-                    int(eax, 16),
-                    int(ebx, 16),
-                    int(ecx, 16),
-                    int(edx, 16)
-                )
-                continue
-
-            # ---- MSR parsing ----
-            if mode == "msr":
-                # Example:
-                # 0000010a -> 400000000c000000
-                idx_hex, val_hex = line.split("->")
-                idx = int(idx_hex.strip(), 16)
-                val = int(val_hex.strip(), 16)
-                current_policy.msr[idx] = val
-                continue
+        # [text before first header, name, body, name, body, ...]
+        sections = _POLICY_HEADER_RE.split(text)
+        for name, body in zip(sections[1::2], sections[2::2]):
+            self.policies[name.strip()] = CpuPolicy.parse(body)
+
+    def diff(self, other: HostCpuPolicy, names: Iterable[str] | None = None) -> dict[str, CpuPolicyDiff]:
+        """
+        Return the differences with the policies of another host, for the given policy names (default: all the
+        policies of this host), skipping identical policies.
+        """
+        diffs = {}
+        for name in self.policies if names is None else names:
+            diff = self.policies[name].diff(other.policies.get(name, CpuPolicy({}, {})))
+            if diff:
+                diffs[name] = diff
+        return diffs
+
+def collect_cpu_policies(hosts: Iterable[Host]) -> list[HostCpuPolicy]:
+    """Collect the CPU policies of several hosts in parallel, in the order of `hosts`."""
+    hosts = list(hosts)
+    with ThreadPoolExecutor(max_workers=max(1, len(hosts))) as executor:
+        return list(executor.map(HostCpuPolicy, hosts))
+
+def diff_cpu_policies(
+    policies: list[HostCpuPolicy], names: Iterable[str] | None = None
+) -> dict[Host, dict[str, CpuPolicyDiff]]:
+    """
+    Compare the policies of each host to the ones of the first host, for instance to check that VMs can migrate
+    between all hosts of a heterogeneous pool. Only hosts with differences are returned.
+    """
+    reference, *others = policies
+    names = None if names is None else list(names)
+    diffs = {}
+    for policy in others:
+        diff = reference.diff(policy, names)
+        if diff:
+            diffs[policy.host] = diff
+    return diffs
@@ -5,23 +5,27 @@ from __future__ import annotations, print_function
 import atexit
 import copy
 import hashlib
+import io
 import logging
 import os
+import shlex
 import shutil
 import struct
+import tarfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
 from tempfile import TemporaryDirectory, mkstemp
 from uuid import UUID
 
-from cryptography import x509
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.serialization import Encoding, pkcs7
-from cryptography.hazmat.primitives.serialization.pkcs7 import PKCS7PrivateKeyTypes
-
 import lib.commands as commands
+import lib.config as config
 
-from typing import Any, Iterable, Literal, Self, cast
+from typing import Any, Iterable, Literal, Mapping, Self, cast
 
 class _EfiGlobalTempdir:
     _instance = None
@@ -184,6 +188,10 @@ def get_secure_boot_guid(variable: str) -> GUID:
 
 def cert_to_efi_sig_list(cert: str) -> bytes:
     """Return an ESL from a PEM cert."""
+    # cryptography is slow to import, only load it when Secure Boot data is built
+    from cryptography import x509
+    from cryptography.hazmat.primitives.serialization import Encoding
+
     with open(cert, 'rb') as f:
         cert_raw = f.read()
         # Cert files can come in either PEM or DER form, and we can't assume
@@ -282,6 +290,11 @@ def sign_efi_sig_db(
 
 def sign(payload: bytes, key_file: str, cert_file: str) -> bytes:
     """Returns a signed PKCS7 of payload signed by key and cert."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
+    from cryptography.hazmat.primitives.serialization.pkcs7 import PKCS7PrivateKeyTypes
+
     with open(key_file, 'rb') as f:
         priv_key = cast(PKCS7PrivateKeyTypes, serialization.load_pem_private_key(f.read(), password=None))
 
@@ -315,7 +328,9 @@ def create_auth2_header(sig_db: bytes, timestamp: bytes) -> bytes:
 def timestamp() -> datetime:
     global time_offset
     time_offset += 1
-    return time_seed + timedelta(seconds=time_offset)
+    # In deterministic mode the timestamps must not depend on the time of the run
+    seed = time_seed if config.efi_keys_seed is None else DETERMINISTIC_TIME_SEED
+    return seed + timedelta(seconds=time_offset)
 
 
 def get_signed_name(image: str) -> str:
@@ -362,6 +377,197 @@ def pesign(key: str, cert: str, name: str, image: str) -> str:
         return signed
 
 
+def generate_self_signed(common_name: str, pub: str, key: str) -> None:
+    commands.local_cmd([
+        'openssl', 'req', '-new', '-x509', '-newkey', 'rsa:2048',
+        '-subj', '/CN=%s/' % common_name, '-nodes', '-keyout',
+        key, '-sha256', '-days', '3650', '-out', pub
+    ])
+
+
+DETERMINISTIC_TIME_SEED = datetime(2024, 1, 1)
+
+
+class _EfiKeyCache:
+    """
+    On-disk cache of Secure Boot key material, shared between test runs. Disabled unless a cache directory is set,
+    except for signed EFI images which are always cached in memory.
+
+    Self-signed certificates are taken from pools of pre-generated ones, refilled in the background, so each
+    certificate is still used only once. In deterministic mode, the n-th certificate requested for a given
+    common name is the same in every run, and so are the signing timestamps, so signed data is cached too.
+    Files older than the maximum age are evicted when the cache is first used.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        self._counters: dict[str, int] = {}
+        self._refilling: set[str] = set()
+        self._evicted = False
+        # Signed images are also cached in memory, as VMs get their binaries signed again after each revert
+        self._images: dict[str, bytes] = {}
+        self._signed_digests: set[str] = set()
+
+    def _dir(self) -> Path | None:
+        if config.efi_key_cache is None:
+            return None
+        path = Path(config.efi_key_cache)
+        with self._lock:
+            if not self._evicted:
+                path.mkdir(parents=True, exist_ok=True)
+                self._evict(path)
+                self._evicted = True
+        return path
+
+    @staticmethod
+    def _evict(path: Path) -> None:
+        expiry = time.time() - config.efi_key_cache_max_age * 24 * 3600
+        for f in path.rglob('*'):
+            if f.is_file() and f.stat().st_mtime < expiry:
+                logging.debug(f"Evicting {f} from the EFI key cache")
+                f.unlink(missing_ok=True)
+
+    @staticmethod
+    def _digest(*parts: bytes | str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode() if isinstance(part, str) else part)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    @staticmethod
+    def _store(target: Path, data: bytes) -> None:
+        # Write then rename so that concurrent readers never see a partial file
+        tmp = target.with_name(f'.{target.name}.{uuid.uuid4()}')
+        tmp.write_bytes(data)
+        os.replace(tmp, target)
+
+    def _generate_into(self, directory: Path, name: str, common_name: str) -> None:
+        with TemporaryDirectory(dir=directory) as tmp:
+            pub, key = os.path.join(tmp, 'pub.pem'), os.path.join(tmp, 'key.pem')
+            generate_self_signed(common_name, pub, key)
+            # The key is moved last: its presence means the pair is complete
+            os.replace(pub, directory / f'{name}.pub.pem')
+            os.replace(key, directory / f'{name}.key.pem')
+
+    def _refill(self, pool: Path, common_name: str) -> None:
+        try:
+            while len(list(pool.glob('*.key.pem'))) < config.efi_key_pool_size:
+                self._generate_into(pool, str(uuid.uuid4()), common_name)
+        except Exception as e:
+            logging.warning(f"Failed to pre-generate EFI keys for {common_name!r}: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(common_name)
+
+    def _schedule_refill(self, pool: Path, common_name: str) -> None:
+        with self._lock:
+            if common_name in self._refilling:
+                return
+            self._refilling.add(common_name)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='efi-keys')
+            self._executor.submit(self._refill, pool, common_name)
+
+    def _claim(self, pool: Path, pub: str, key: str) -> bool:
+        for ready_key in pool.glob('*.key.pem'):
+            try:
+                # Renaming is atomic: only one test process can claim a given pair
+                os.rename(ready_key, key)
+            except FileNotFoundError:
+                continue
+            os.rename(str(ready_key).removesuffix('.key.pem') + '.pub.pem', pub)
+            return True
+        return False
+
+    def self_signed(self, common_name: str, pub: str, key: str) -> None:
+        """ Write a self-signed certificate and its private key to `pub` and `key`. """
+        path = self._dir()
+        if path is None:
+            generate_self_signed(common_name, pub, key)
+            return
+
+        if config.efi_keys_seed is not None:
+            with self._lock:
+                index = self._counters.get(common_name, 0)
+                self._counters[common_name] = index + 1
+            certs = path / 'certs'
+            certs.mkdir(exist_ok=True)
+            name = self._digest(config.efi_keys_seed, common_name, str(index))
+            cached_pub, cached_key = certs / f'{name}.pub.pem', certs / f'{name}.key.pem'
+            if not cached_key.exists():
+                self._generate_into(certs, name, common_name)
+            os.utime(cached_key)
+            shutil.copyfile(cached_pub, pub)
+            shutil.copyfile(cached_key, key)
+            return
+
+        pool = path / 'pool' / self._digest(common_name)
+        pool.mkdir(parents=True, exist_ok=True)
+        if not self._claim(pool, pub, key):
+            generate_self_signed(common_name, pub, key)
+        self._schedule_refill(pool, common_name)
+
+    def sign_efi_sig_db(self, sig_db: bytes, var: str, key: str, cert: str, time: datetime, guid: GUID | None) -> bytes:
+        """ Cached version of `sign_efi_sig_db`, only used in deterministic mode. """
+        path = self._dir()
+        if path is None or config.efi_keys_seed is None:
+            return sign_efi_sig_db(sig_db, var, key, cert, time=time, guid=guid)
+
+        with open(cert, 'rb') as f:
+            cert_data = f.read()
+        auths = path / 'auths'
+        auths.mkdir(exist_ok=True)
+        cached = auths / (self._digest(cert_data, var, str(guid), time.isoformat(), sig_db) + '.auth')
+        if cached.exists():
+            os.utime(cached)
+            return cached.read_bytes()
+
+        auth = sign_efi_sig_db(sig_db, var, key, cert, time=time, guid=guid)
+        self._store(cached, auth)
+        return auth
+
+    def signed_image(self, cert: str, image: bytes) -> bytes | None:
+        """ Return the image signed with the given certificate if it was signed before. """
+        name = self._digest(Path(cert).read_bytes(), image)
+        with self._lock:
+            signed = self._images.get(name)
+        if signed is not None:
+            return signed
+
+        path = self._dir()
+        if path is None:
+            return None
+        cached = path / 'images' / f'{name}.efi'
+        if not cached.exists():
+            return None
+        os.utime(cached)
+        signed = cached.read_bytes()
+        with self._lock:
+            self._images[name] = signed
+        return signed
+
+    def store_signed_image(self, cert: str, image: bytes, signed: bytes) -> None:
+        name = self._digest(Path(cert).read_bytes(), image)
+        with self._lock:
+            self._images[name] = signed
+            self._signed_digests.add(self._digest(cert, signed))
+
+        path = self._dir()
+        if path is not None:
+            (path / 'images').mkdir(exist_ok=True)
+            self._store(path / 'images' / f'{name}.efi', signed)
+
+    def is_signed_image(self, cert: str, image: bytes) -> bool:
+        """ Whether the image is the output of a signature with the given certificate in this run. """
+        with self._lock:
+            return self._digest(cert, image) in self._signed_digests
+
+
+_key_cache = _EfiKeyCache()
+
+
 class Certificate:
     def __init__(self, pub: str, key: str | None) -> None:
         self.pub = pub
@@ -372,17 +578,13 @@ class Certificate:
         pub = _tempdir.getfile(suffix='.pem')
         key = _tempdir.getfile(suffix='.pem')
 
-        commands.local_cmd([
-            'openssl', 'req', '-new', '-x509', '-newkey', 'rsa:2048',
-            '-subj', '/CN=%s/' % common_name, '-nodes', '-keyout',
-            key, '-sha256', '-days', '3650', '-out', pub
-        ])
+        _key_cache.self_signed(common_name, pub, key)
 
         return cls(pub, key)
 
     def sign_efi_sig_db(self, var: str, data: bytes, guid: GUID | None) -> bytes:
         assert self.key is not None
-        return sign_efi_sig_db(data, var, self.key, self.pub, time=timestamp(), guid=guid)
+        return _key_cache.sign_efi_sig_db(data, var, self.key, self.pub, time=timestamp(), guid=guid)
 
     def copy(self) -> Certificate:
         newpub = _tempdir.getfile(suffix='.pem')
@@ -466,8 +668,19 @@ class EFIAuth:
         but 'binary' probably better fits community terminology.
 
         Returns path to signed image.
+
+        Signed images are cached: signing the same image with the same key again doesn't call the signing tool.
         """
         assert self._owner_cert is not None
+        with open(image, 'rb') as f:
+            image_data = f.read()
+        signed_data = _key_cache.signed_image(self._owner_cert.pub, image_data)
+        if signed_data is not None:
+            signed = get_signed_name(image)
+            with open(signed, 'wb') as f:
+                f.write(signed_data)
+            return signed
+
         if shutil.which('sbsign'):
             signed = get_signed_name(image)
             assert self._owner_cert.key is not None
@@ -479,8 +692,16 @@ class EFIAuth:
             assert self._owner_cert.key is not None
             signed = pesign(self._owner_cert.key, self._owner_cert.pub, self.name, image)
 
+        with open(signed, 'rb') as f:
+            _key_cache.store_signed_image(self._owner_cert.pub, image_data, f.read())
         return signed
 
+    def has_signed_image(self, image: str) -> bool:
+        """Whether the EFI image at path `image` is already the output of `sign_image` with this object's key."""
+        assert self._owner_cert is not None
+        with open(image, 'rb') as f:
+            return _key_cache.is_signed_image(self._owner_cert.pub, f.read())
+
     def copy(self, name: Literal["PK", "KEK", "db", "dbx"] | None = None) -> Self:
         """
         Make a copy of an existing EFIAuth object.
@@ -529,6 +750,77 @@ class EFIAuth:
         return certs_to_sig_db(certs)
 
 
+EFIVARFS_DIR = '/sys/firmware/efi/efivars'
+
+
+@dataclass(frozen=True)
+class EfiVariable:
+    attrs: bytes
+    data: bytes
+
+
+# UEFI variables indexed by name and GUID
+EfiVariables = dict[tuple[str, GUID], EfiVariable]
+
+
+def efivarfs_dump_cmd() -> str:
+    """Return a shell command printing all the variables of efivarfs, one `<name>-<guid> <hex content>` per line."""
+    return (
+        f'cd {EFIVARFS_DIR} && for f in *; do '
+        'if [ -f "$f" ]; then echo "$f $(od -An -v -tx1 "$f" | tr -d \' \\n\')"; fi; done'
+    )
+
+
+def parse_efivarfs_dump(output: str) -> EfiVariables:
+    """Parse the output of `efivarfs_dump_cmd`."""
+    variables: EfiVariables = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        filename, _, hexdata = line.partition(' ')
+        # The file name is <name>-<guid>, and GUIDs are 36 characters long
+        name, guid = filename[:-37], GUID(filename[-36:])
+        content = bytes.fromhex(hexdata)
+        # The efivarfs file starts with the attributes, which are 4 bytes long
+        variables[(name, guid)] = EfiVariable(content[:4], content[4:])
+    return variables
+
+
+def write_efivarfs_changes(
+    changes: Mapping[tuple[str, GUID], EfiVariable | None], archive: str, remote_archive: str
+) -> str:
+    """
+    Prepare a set of changes to efivarfs: variables mapped to None are deleted, the others are written.
+
+    Writes the archive to be copied to `remote_archive` on the remote end, and returns the shell command
+    applying the changes from there, in the order of `changes`.
+    """
+    script_lines = []
+    with tarfile.open(archive, 'w') as tar:
+        for (name, guid), variable in changes.items():
+            filename = f'{name}-{guid.as_str()}'
+            if variable is None:
+                script_lines.append(f'delete {shlex.quote(filename)}')
+                continue
+            assert len(variable.attrs) == 4
+            info = tarfile.TarInfo(filename)
+            info.size = len(variable.attrs) + len(variable.data)
+            tar.addfile(info, io.BytesIO(variable.attrs + variable.data))
+            script_lines.append(f'write {shlex.quote(filename)}')
+
+    # Files are written with 'cat' because efivarfs needs the whole content in a single write, and 'cp' doesn't
+    # work in Alpine images (because cp is busybox in Alpine)
+    return '\n'.join([
+        'set -e',
+        'staging=$(mktemp -d)',
+        f'trap \'rm -rf "$staging" {remote_archive}\' EXIT',
+        f'tar -C "$staging" -xf {remote_archive}',
+        f'cd {EFIVARFS_DIR}',
+        'write() { if [ -e "$1" ]; then chattr -i "$1"; fi; cat "$staging/$1" > "$1"; }',
+        'delete() { if [ -e "$1" ]; then chattr -i "$1"; rm "$1"; fi; }',
+    ] + script_lines)
+
+
 def esl_from_auth_file(auth: str) -> bytes:
     """
     Return the ESL contained inside the EFI auth file.
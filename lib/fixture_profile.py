@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import pytest
+
+import dataclasses
+import time
+from collections import Counter, defaultdict
+
+from lib.commands import remote_call_count
+from lib.fixture_timing import FixtureTimer
+
+from typing import TYPE_CHECKING, Generator
+
+if TYPE_CHECKING:
+    from _pytest.fixtures import SubRequest
+    from _pytest.terminal import TerminalReporter
+
+# Number of fixtures listed in the terminal summary
+SUMMARY_MAX_FIXTURES = 20
+
+@dataclasses.dataclass
+class FixtureStats:
+    name: str
+    scope: str
+    # where the fixture is defined
+    baseid: str
+    instantiations: int = 0
+    # instantiations in a scope (module, package...) where the fixture was already instantiated
+    rebuilds: int = 0
+    # parameters which had changed for each rebuild, "?" when none did (a dependency was torn down)
+    rebuild_causes: Counter[str] = dataclasses.field(default_factory=Counter)
+    # durations in seconds and remote calls of the fixture itself, without the fixtures it instantiated. Remote calls
+    # are counted for the whole process: the ones of threads running meanwhile, like other fixtures of a parallel
+    # setup, are counted too, as are the ones of the threads the fixture itself starts
+    setup: float = 0.0
+    teardown: float = 0.0
+    remote_calls: int = 0
+
+    @property
+    def total(self) -> float:
+        return self.setup + self.teardown
+
+@dataclasses.dataclass
+class _Setup:
+    frames: tuple[str, ...]
+    start: float
+    remote_calls: int
+    # time spent and remote calls made by the fixtures instantiated during this setup
+    nested_time: float = 0.0
+    nested_remote_calls: int = 0
+
+def _frames(node: pytest.Item | pytest.Collector) -> tuple[str, ...]:
+    # ";" separates the frames of a stack in the folded format
+    return tuple((n.name or "session").replace(";", ",") for n in node.listchain())
+
+class FixtureProfiler:
+    """
+    Time every fixture setup and teardown, count the remote calls they make, and find which parametrizations make
+    module, package or session scoped fixtures be instantiated several times in the same scope.
+
+    The whole run is written as a profile in the folded stacks format, one line per stack with its duration in
+    milliseconds, that flamegraph.pl, speedscope or inferno read: the stacks are the path of the scope node of each
+    fixture, or of each test for its call, followed by the setup and teardown of the fixtures.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fixtures: dict[tuple[str, str], FixtureStats] = {}
+        # self time of each stack, in seconds
+        self.stacks: defaultdict[tuple[str, ...], float] = defaultdict(float)
+        self._item: pytest.Item | None = None
+        self._setups: list[_Setup] = []
+        # arguments of the fixtures, to find which parameters they depend on
+        self._argnames: dict[str, tuple[str, ...]] = {}
+        # parameters of the test which instantiated each fixture, by fixture and scope node
+        self._instantiated_by: dict[tuple[str, str, str], dict[str, object]] = {}
+        self._timer = FixtureTimer()
+
+    def _stats(self, fixturedef: pytest.FixtureDef[object]) -> FixtureStats:
+        key = (fixturedef.argname, fixturedef.baseid)
+        if key not in self.fixtures:
+            self.fixtures[key] = FixtureStats(fixturedef.argname, fixturedef.scope, fixturedef.baseid)
+        return self.fixtures[key]
+
+    def _count_rebuild(self, stats: FixtureStats, request: SubRequest) -> None:
+        if stats.scope == "function":
+            return
+        callspec = getattr(self._item, "callspec", None)
+        params: dict[str, object] = dict(callspec.params) if callspec is not None else {}
+        key = (stats.name, stats.baseid, request.node.nodeid)
+        previous = self._instantiated_by.get(key)
+        self._instantiated_by[key] = params
+        if previous is None:
+            return
+        stats.rebuilds += 1
+        dependencies = {stats.name}
+        pending = [stats.name]
+        while pending:
+            for name in self._argnames.get(pending.pop(), ()):
+                if name not in dependencies:
+                    dependencies.add(name)
+                    pending.append(name)
+        changed = sorted(name for name in dependencies if params.get(name) != previous.get(name))
+        stats.rebuild_causes.update(changed or ["?"])
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_setup(self, item: pytest.Item) -> None:
+        self._item = item
+
+    @pytest.hookimpl(wrapper=True)
+    def pytest_runtest_call(self, item: pytest.Item) -> Generator[None, None, None]:
+        start = time.monotonic()
+        try:
+            return (yield)
+        finally:
+            self.stacks[_frames(item) + ("call",)] += time.monotonic() - start
+
+    @pytest.hookimpl(wrapper=True)
+    def pytest_fixture_setup(self, fixturedef: pytest.FixtureDef[object], request: SubRequest
+                             ) -> Generator[None, object, object]:
+        stats = self._stats(fixturedef)
+        self._argnames[fixturedef.argname] = fixturedef.argnames
+        parent_frames = self._setups[-1].frames if self._setups else _frames(request.node)
+        setup = _Setup(parent_frames + (f"setup {fixturedef.argname}",), time.monotonic(), remote_call_count())
+        self._setups.append(setup)
+        try:
+            return (yield)
+        finally:
+            self._setups.pop()
+            duration = time.monotonic() - setup.start
+            remote_calls = remote_call_count() - setup.remote_calls
+            if self._setups:
+                self._setups[-1].nested_time += duration
+                self._setups[-1].nested_remote_calls += remote_calls
+            self.stacks[setup.frames] += duration - setup.nested_time
+            stats.instantiations += 1
+            stats.setup += duration - setup.nested_time
+            stats.remote_calls += remote_calls - setup.nested_remote_calls
+            self._count_rebuild(stats, request)
+            self._timer.setup_done(fixturedef, duration)
+
+    def pytest_fixture_post_finalizer(self, fixturedef: pytest.FixtureDef[object], request: SubRequest) -> None:
+        timing = self._timer.teardown_done(fixturedef)
+        if timing is None or timing.teardown is None:
+            return
+        stats = self._stats(fixturedef)
+        stats.teardown += timing.teardown
+        stats.remote_calls += timing.teardown_remote_calls
+        self.stacks[_frames(request.node) + (f"teardown {fixturedef.argname}",)] += timing.teardown
+
+    def write_profile(self) -> None:
+        with open(self.path, "w") as f:
+            for frames, duration in sorted(self.stacks.items()):
+                if round(duration * 1000):
+                    f.write(f"{';'.join(frames)} {round(duration * 1000)}\n")
+
+    def pytest_terminal_summary(self, terminalreporter: TerminalReporter) -> None:
+        self.write_profile()
+        fixtures = sorted(self.fixtures.values(), key=lambda s: -s.total)[:SUMMARY_MAX_FIXTURES]
+        terminalreporter.section("fixture profile")
+        terminalreporter.write_line(f"{'setup':>9} {'teardown':>9} {'count':>6} {'rebuilds':>8} {'remote':>7}  fixture")
+        for s in fixtures:
+            line = (f"{s.setup:>8.1f}s {s.teardown:>8.1f}s {s.instantiations:>6} {s.rebuilds:>8} "
+                    f"{s.remote_calls:>7}  {s.name} ({s.scope}{', ' + s.baseid if s.baseid else ''})")
+            if s.rebuild_causes:
+                line += " rebuilt for: " + ", ".join(f"{name} ({n})" for name, n in s.rebuild_causes.most_common())
+            terminalreporter.write_line(line)
+        terminalreporter.write_line(f"Flame graph profile written to {self.path}")
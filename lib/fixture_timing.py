@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import pytest
+
+import dataclasses
+import time
+
+from lib.commands import remote_call_count
+
+@dataclasses.dataclass
+class FixtureTiming:
+    # durations in seconds, the teardown one being None if the teardown did not start
+    setup: float
+    teardown: float | None = None
+    # remote calls made during the teardown, by any thread, see remote_call_count()
+    teardown_remote_calls: int = 0
+
+class FixtureTimer:
+    """
+    Time the teardowns of fixtures, for the plugins measuring fixtures.
+
+    pytest has no hook at the start of a teardown, only `pytest_fixture_post_finalizer` once it ends: at the end of
+    the setup, `setup_done()` adds a finalizer to the fixture, which runs last among the finalizers added before it,
+    so after the teardown of the fixtures depending on this one, and right before its own teardown.
+    """
+
+    def __init__(self) -> None:
+        # fixtures set up, with the start time and remote call count of their teardown once started, by id of their
+        # FixtureDef
+        self._fixtures: dict[int, tuple[FixtureTiming, tuple[float, int] | None]] = {}
+
+    def setup_done(self, fixturedef: pytest.FixtureDef[object], duration: float) -> None:
+        """ Call at the end of `pytest_fixture_setup`, with the setup duration to report in `teardown_done()`. """
+        key = id(fixturedef)
+        timing = FixtureTiming(duration)
+        self._fixtures[key] = (timing, None)
+
+        def teardown_start() -> None:
+            self._fixtures[key] = (timing, (time.monotonic(), remote_call_count()))
+        fixturedef.addfinalizer(teardown_start)
+
+    def teardown_done(self, fixturedef: pytest.FixtureDef[object]) -> FixtureTiming | None:
+        """ Call in `pytest_fixture_post_finalizer`. None if the setup of the fixture was not timed. """
+        if id(fixturedef) not in self._fixtures:
+            return None
+        timing, teardown_start = self._fixtures.pop(id(fixturedef))
+        if teardown_start is not None:
+            start, remote_calls = teardown_start
+            timing.teardown = time.monotonic() - start
+            timing.teardown_remote_calls = remote_call_count() - remote_calls
+        return timing
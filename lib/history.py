@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import pytest
+
+import dataclasses
+import datetime
+import logging
+import os
+import sqlite3
+import statistics
+import sys
+import time
+
+from lib.fixture_timing import FixtureTimer
+
+from typing import TYPE_CHECKING, Generator, Iterable, Iterator
+
+if TYPE_CHECKING:
+    from _pytest.fixtures import SubRequest
+
+# Default location of the history database, relative to the root directory of the tests
+TEST_HISTORY = ".pytest_cache/test-history.sqlite"
+# Number of most recent runs of a test used to predict its duration and failure rate
+HISTORY_DEPTH = 10
+# Orderings of the tests, see TestHistoryPlugin.order_packages()
+HISTORY_ORDERS = ["collection", "flaky-first", "cheap-first"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    args TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tests (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    nodeid TEXT NOT NULL,
+    setup REAL NOT NULL,
+    call REAL NOT NULL,
+    teardown REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_nodeid ON tests (nodeid, run);
+CREATE TABLE IF NOT EXISTS fixtures (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    baseid TEXT NOT NULL,
+    param TEXT,
+    setup REAL NOT NULL,
+    teardown REAL
+);
+"""
+
+def base_nodeid(nodeid: str) -> str:
+    """ The node ID of a test without its parameters. """
+    return nodeid.split("[")[0]
+
+@dataclasses.dataclass
+class TestStats:
+    __test__ = False
+
+    # median of the total (setup, call and teardown) durations, in seconds
+    duration: float
+    runs: int
+    failures: int
+
+    @property
+    def failure_rate(self) -> float:
+        return self.failures / self.runs if self.runs else 0.0
+
+class TestHistory:
+    """
+    Durations and outcomes of the tests and fixtures of previous runs, in a SQLite database.
+
+    Several pytest processes, like the shards of a job, may record their results in the same database.
+    """
+    __test__ = False
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # concurrent writers wait for each other
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def start_run(self, args: Iterable[str]) -> int:
+        with self.db:
+            cursor = self.db.execute("INSERT INTO runs (started, args) VALUES (?, ?)",
+                                     (datetime.datetime.now().isoformat(timespec="seconds"), " ".join(args)))
+        assert cursor.lastrowid is not None
+        return cursor.lastrowid
+
+    def record_test(self, run: int, nodeid: str, setup: float, call: float, teardown: float, outcome: str) -> None:
+        with self.db:
+            self.db.execute("INSERT INTO tests VALUES (?, ?, ?, ?, ?, ?)",
+                            (run, nodeid, setup, call, teardown, outcome))
+
+    def record_fixture(self, run: int, name: str, scope: str, baseid: str, param: str | None,
+                       setup: float, teardown: float | None) -> None:
+        with self.db:
+            self.db.execute("INSERT INTO fixtures VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (run, name, scope, baseid, param, setup, teardown))
+
+    def test_stats(self) -> dict[str, TestStats]:
+        """ Statistics of the last HISTORY_DEPTH runs of each test, skipped runs excluded, by node ID. """
+        durations: dict[str, list[float]] = {}
+        failures: dict[str, int] = {}
+        rows = self.db.execute(
+            "SELECT nodeid, setup + call + teardown, outcome FROM ("
+            "  SELECT *, row_number() OVER (PARTITION BY nodeid ORDER BY run DESC) AS n"
+            "  FROM tests WHERE outcome != 'skipped'"
+            ") WHERE n <= ?", (HISTORY_DEPTH,))
+        for nodeid, duration, outcome in rows:
+            durations.setdefault(nodeid, []).append(duration)
+            failures[nodeid] = failures.get(nodeid, 0) + (outcome != "passed")
+        return {
+            nodeid: TestStats(statistics.median(d), len(d), failures[nodeid]) for nodeid, d in durations.items()
+        }
+
+    def base_durations(self) -> dict[str, float]:
+        """ Predicted duration of each test, all parameters included, by node ID without parameters. """
+        durations: dict[str, float] = {}
+        for nodeid, stats in self.test_stats().items():
+            durations[base_nodeid(nodeid)] = durations.get(base_nodeid(nodeid), 0.0) + stats.duration
+        return durations
+
+class TestHistoryPlugin:
+    """
+    Record the durations and outcomes of the tests and fixtures in a TestHistory, and use them to predict the
+    duration of the run and order the tests.
+    """
+    __test__ = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self._history: TestHistory | None = None
+        self._run: int | None = None
+        self._stats: dict[str, TestStats] | None = None
+        # durations of the phases of the test being run
+        self._phases: dict[str, float] = {}
+        self._outcome = "passed"
+        self._fixtures = FixtureTimer()
+
+    @property
+    def history(self) -> TestHistory:
+        if self._history is None:
+            self._history = TestHistory(self.path)
+        return self._history
+
+    @property
+    def run(self) -> int:
+        if self._run is None:
+            self._run = self.history.start_run(sys.argv[1:])
+        return self._run
+
+    @property
+    def stats(self) -> dict[str, TestStats]:
+        if self._stats is None:
+            # don't create a database just to read it
+            self._stats = self.history.test_stats() if os.path.exists(self.path) else {}
+        return self._stats
+
+    def predict(self, items: Iterable[pytest.Item]) -> Iterator[float | None]:
+        """
+        Predicted duration of each item: from its own history, or else the history of the other parameters of the
+        same test. None for tests that never ran.
+        """
+        by_base: dict[str, list[float]] = {}
+        for nodeid, stats in self.stats.items():
+            by_base.setdefault(base_nodeid(nodeid), []).append(stats.duration)
+        for item in items:
+            if item.nodeid in self.stats:
+                yield self.stats[item.nodeid].duration
+            elif base_nodeid(item.nodeid) in by_base:
+                yield statistics.median(by_base[base_nodeid(item.nodeid)])
+            else:
+                yield None
+
+    def _group_keys(self, groups: list[list[pytest.Item]], order: str) -> list[float]:
+        if order == "flaky-first":
+            return [-max((self.stats[i.nodeid].failure_rate for i in group if i.nodeid in self.stats), default=0.0)
+                    for group in groups]
+        assert order == "cheap-first"
+        predictions = [list(self.predict(group)) for group in groups]
+        known = [d for group in predictions for d in group if d is not None]
+        default = statistics.median(known) if known else 0.0
+        return [sum(default if d is None else d for d in group) for group in predictions]
+
+    def _sorted_groups(self, groups: list[list[pytest.Item]], order: str) -> list[list[pytest.Item]]:
+        # sorted() is stable: groups without history keep their relative order
+        keys = self._group_keys(groups, order)
+        return [groups[i] for i in sorted(range(len(groups)), key=lambda i: keys[i])]
+
+    def order_packages(self, packages: list[list[pytest.Item]], order: str) -> list[list[pytest.Item]]:
+        """
+        Order the packages, then the modules in each package, so that the tests that failed most often run first
+        (flaky-first), or the shortest ones (cheap-first). The order of the tests of a module doesn't change, and
+        neither does the order of the modules of packages that use pytest-dependency.
+        """
+        if order == "collection" or not self.stats:
+            return packages
+        ordered = []
+        for items in self._sorted_groups(packages, order):
+            if any(item.get_closest_marker("dependency") for item in items):
+                ordered.append(items)
+                continue
+            modules: dict[str, list[pytest.Item]] = {}
+            for item in items:
+                modules.setdefault(item.nodeid.split("::")[0], []).append(item)
+            ordered.append([item for module in self._sorted_groups(list(modules.values()), order) for item in module])
+        return ordered
+
+    def pytest_report_collectionfinish(self, items: list[pytest.Item]) -> str | None:
+        if not self.stats or not items:
+            return None
+        predictions = list(self.predict(items))
+        known = [d for d in predictions if d is not None]
+        if not known:
+            return None
+        total = sum(known) + statistics.median(known) * (len(predictions) - len(known))
+        return (f"predicted duration: {datetime.timedelta(seconds=round(total))} "
+                f"({len(known)}/{len(items)} tests with history)")
+
+    def pytest_runtest_logreport(self, report: pytest.TestReport) -> None:
+        self._phases[report.when] = report.duration
+        if report.failed:
+            self._outcome = "failed" if report.when == "call" else "error"
+        elif report.skipped and self._outcome == "passed":
+            self._outcome = "skipped"
+        if report.when == "teardown":
+            self.history.record_test(self.run, report.nodeid, self._phases.get("setup", 0.0),
+                                     self._phases.get("call", 0.0), self._phases["teardown"], self._outcome)
+            self._phases = {}
+            self._outcome = "passed"
+
+    @pytest.hookimpl(wrapper=True)
+    def pytest_fixture_setup(self, fixturedef: pytest.FixtureDef[object], request: SubRequest
+                             ) -> Generator[None, object, object]:
+        start = time.monotonic()
+        try:
+            return (yield)
+        finally:
+            self._fixtures.setup_done(fixturedef, time.monotonic() - start)
+
+    def pytest_fixture_post_finalizer(self, fixturedef: pytest.FixtureDef[object], request: SubRequest) -> None:
+        timing = self._fixtures.teardown_done(fixturedef)
+        if timing is None:
+            return
+        param = str(request.param) if hasattr(request, "param") else None
+        self.history.record_fixture(self.run, fixturedef.argname, fixturedef.scope, fixturedef.baseid, param,
+                                    timing.setup, timing.teardown)
+
+    def pytest_unconfigure(self) -> None:
+        if self._history is not None:
+            self._history.close()
+            logging.debug(f"Test history recorded in {self.path}")
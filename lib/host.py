@@ -2,16 +2,16 @@ from __future__ import annotations
 
 import logging
 import os
-import re
 import shlex
 import subprocess
 import tempfile
 import uuid
-from dataclasses import dataclass
 
 from packaging import version
 
 import lib.commands as commands
+import lib.efi as efi
+from lib.blockdev import BlockDeviceGraph, BlockDeviceInfo, lsblk_command
 from lib.bond import Bond
 from lib.common import (
     _param_add,
@@ -32,9 +32,9 @@ from lib.network import Network
 from lib.pif import PIF
 from lib.sr import SR
 from lib.vm import VM
-from lib.xo import xo_cli, xo_object_exists
+from lib.xo import wait_for_xo_object, xo_cli
 
-from typing import TYPE_CHECKING, Literal, overload
+from typing import TYPE_CHECKING, Literal, TypeAlias, overload
 
 if TYPE_CHECKING:
     from lib.pool import Pool
@@ -56,17 +56,9 @@ class Host:
     xe_prefix = "host"
     pool: "Pool"
 
-    # Data extraction is automatic, no conversion from str is done.
-    @dataclass
-    class BlockDeviceInfo:
-        name: str       # short kernel name: "sda", "md0", "dm-3"
-        path: str       # full device path: "/dev/sda", "/dev/md/myarray", "/dev/mapper/mpathb"
-        size: int       # bytes
-        log_sec: int    # logical sector size
-        type: str       # "disk", "md", "mpath"
-        available: bool # not mounted, not member of md/lvm/mpath/zfs
-        wwn: str = ''   # LUN WWN (hex, no 0x prefix); same LUN has same WWN across hosts
+    BlockDeviceInfo: TypeAlias = BlockDeviceInfo
 
+    block_devices: BlockDeviceGraph
     block_devices_info: list[BlockDeviceInfo]
 
     def __init__(self, pool: Pool, hostname_or_ip: str):
@@ -366,7 +358,7 @@ class Host:
         wait_for(self.xo_server_connected, timeout_secs=10)
         # wait for XO to know about the host. Apparently a connected server status
         # is not enough to guarantee that the host object exists yet.
-        wait_for(lambda: xo_object_exists(self.uuid), f"[{self}] Wait for XO to know about HOST {self.uuid}")
+        wait_for_xo_object(self.uuid, f"[{self}] Wait for XO to know about HOST {self.uuid}")
 
     @staticmethod
     def vm_cache_key(uri: str) -> str:
@@ -511,6 +503,15 @@ class Host:
         logging.info(f"[{self}] Removing cache metadata...")
         return self.ssh("yum clean metadata -q")
 
+    def set_yum_proxy(self, url: str | None) -> None:
+        """Make yum download through an HTTP proxy, such as a `lib.rpm_cache.RpmCacheProxy`.
+
+        :param url: URL of the proxy, or None to download directly from the repositories again
+        """
+        self.ssh("sed -i '/^proxy=/d' /etc/yum.conf")
+        if url is not None:
+            self.ssh(f"sed -i '/^\\[main\\]/a proxy={url}' /etc/yum.conf")
+
     def yum_update(self, enablerepos: list[str] = [], disablerepos: list[str] = []) -> str:
         """Updates packages on target.
 
@@ -733,7 +734,7 @@ class Host:
         uuid = self.xe('pif-list', {'management': True, 'host-uuid': self.uuid}, minimal=True)
         return PIF(uuid, self)
 
-    def rescan_block_devices_info(self) -> None:
+    def rescan_block_devices_info(self, device: str | None = None) -> None:
         """
         Initialize information about block devices: local disks, mdadm arrays, and multipath devices.
 
@@ -741,144 +742,27 @@ class Host:
         when we test how XCP-ng reacts to changes of hardware (or
         reconfiguration of device blocksize), or after a reboot.
 
-        Handled device scenarios and their effect on `available`:
-
-        - Plain disk, no children: available unless the disk itself has a
-          mountpoint.
-        - Partitioned disk: available if no partition is mounted and no partition
-          has a used child (lvm, md, mpath, crypt); unavailable otherwise.
-        - Disk member of an mdadm array: the disk itself is unavailable; the md
-          array is added as a separate entry (type 'md'), deduplicated across
-          member appearances, and available if it has no mountpoint and no used
-          children.
-        - LUN with multipath configured: each path appears as a 'disk' entry and
-          a shared 'mpath' entry as its child. The path disks are unavailable
-          (mpath child); the mpath device is added once (type 'mpath'),
-          deduplicated by kname across path appearances.
-        - LUN accessible through multiple paths without multipath configured:
-          multiple 'disk' entries with no children but sharing the same WWN.
-          Deduplicated to a single entry (first path seen) based on WWN.
+        With `device`, a kernel name such as "sdb" or "dm-3", only this device
+        and the devices built on it are scanned again, e.g. after creating or
+        destroying an SR on it. See BlockDeviceGraph.devices_info() for the
+        handled device scenarios and their effect on `available`.
         """
-        RAID_TYPES = {'raid0', 'raid1', 'raid4', 'raid5', 'raid6', 'raid10', 'linear'}
-        USED_TYPES = RAID_TYPES | {'lvm', 'mpath', 'crypt'}
-        LSBLK_FIELDS = 'NAME,KNAME,PKNAME,SIZE,LOG-SEC,TYPE,MOUNTPOINT,WWN'
-        # The device major numbers we have on an xcp-ng host, except 254 (tapdev) and 202 (xvd)
-        # From /dev/devices:
-        #   8 sd
-        #   9 md
-        #  65 sd
-        #  66 sd
-        #  67 sd
-        #  68 sd
-        #  69 sd
-        #  70 sd
-        #  71 sd
-        # 128 sd
-        # 129 sd
-        # 130 sd
-        # 131 sd
-        # 132 sd
-        # 133 sd
-        # 134 sd
-        # 135 sd
-        # 252 mdp
-        # 253 device-mapper
-        # 259 blkext
-        LSBLK_MAJOR_NUMBERS = '8,9,65,66,67,68,69,70,71,128,129,130,131,132,133,134,135,252,253,259'
-
-        devices: list[Host.BlockDeviceInfo] = []
-
-        raw = self.ssh(f'lsblk --pairs --bytes --output {LSBLK_FIELDS} --include {LSBLK_MAJOR_NUMBERS}')
-
-        def _split_keys(line: str) -> list[tuple[str, str]]:
-            return re.findall(r'(\S+)=(".*?"|\S+)', line)
-
-        rows = [
-            {key.lower(): val.strip('"') for key, val in _split_keys(line)}
-            for line in raw.strip().splitlines()
-        ]
-
-        # build children map: kname -> list of child knames
-        children: dict[str, list[str]] = {}
-        for r in rows:
-            if r['pkname']:
-                children.setdefault(r['pkname'], []).append(r['kname'])
-
-        # availability from lsblk fields: no mountpoint, not a "used" type, all descendants also free
-        def _row_by_kname(kname: str) -> dict[str, str] | None:
-            for r in rows:
-                if r['kname'] == kname:
-                    return r
-            return None
-
-        def _all_available(kname: str) -> bool:
-            r = _row_by_kname(kname)
-            if r is None:
-                return False
-            if r['mountpoint'] or r['type'] in USED_TYPES:
-                return False
-            return all(_all_available(c) for c in children.get(kname, []))
-
-        seen_knames: set[str] = set()
-        seen_wwns: set[str] = set()
-
-        for r in rows:
-            # --- local disks ---
-            if r['type'] == 'disk' and not r['pkname']:
-                wwn = r['wwn']
-                if wwn:
-                    if wwn in seen_wwns:
-                        continue
-                    seen_wwns.add(wwn)
-                devices.append(Host.BlockDeviceInfo(
-                    name=r['name'],
-                    path=f'/dev/{r["name"]}',
-                    size=int(r['size']),
-                    log_sec=int(r['log-sec']),
-                    type='disk',
-                    available=_all_available(r['kname']),
-                    wwn=wwn.removeprefix('0x'),
-                ))
-
-            # --- mdadm arrays (may appear once per member, deduplicate) ---
-            elif r['type'] in RAID_TYPES:
-                if r['kname'] in seen_knames:
-                    continue
-                seen_knames.add(r['kname'])
-                available = not r['mountpoint'] and all(_all_available(c) for c in children.get(r['kname'], []))
-                devices.append(Host.BlockDeviceInfo(
-                    name=r['name'],
-                    path=f'/dev/{r["name"]}',
-                    size=int(r['size']),
-                    log_sec=int(r['log-sec']),
-                    type='md',
-                    available=available,
-                ))
-
-            # --- multipath devices (may appear once per path, deduplicate) ---
-            elif r['type'] == 'mpath':
-                if r['kname'] in seen_knames:
-                    continue
-                seen_knames.add(r['kname'])
-                available = not r['mountpoint'] and all(_all_available(c) for c in children.get(r['kname'], []))
-                wwn = r['name'][1:17] if re.fullmatch(r'3[0-9a-f]{32}', r['name']) else ''
-                devices.append(Host.BlockDeviceInfo(
-                    name=r['kname'],
-                    path=f'/dev/mapper/{r["name"]}',
-                    size=int(r['size']),
-                    log_sec=int(r['log-sec']),
-                    type='mpath',
-                    available=available,
-                    wwn=wwn,
-                ))
-
-        self.block_devices_info = sorted(devices, key=lambda d: d.size, reverse=True)
+        output = self.ssh(lsblk_command(device))
+        if device is None:
+            self.block_devices = BlockDeviceGraph.from_lsblk(output)
+        else:
+            self.block_devices.refresh(device, output)
+        self.block_devices_info = self.block_devices.devices_info()
         logging.debug(f"[{self}] blockdevs found: {[d.name for d in self.block_devices_info]}")
 
     def disks(self) -> list[Host.BlockDeviceInfo]:
         """ List of all block devices (local disks, mdadm arrays, multipath devices). """
         return list(self.block_devices_info)
 
+    def get_efi_vars(self) -> efi.EfiVariables:
+        """ Return all the EFI variables of the host, as seen from dom0's efivarfs, in one call. """
+        return efi.parse_efivarfs_dump(self.ssh(efi.efivarfs_dump_cmd()))
+
     def file_exists(self, filepath: str, regular_file: bool = True) -> bool:
         option = '-f' if regular_file else '-e'
         return self.ssh_with_result(f'test {option} {filepath}').returncode == 0
@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+import hashlib
 import logging
+import os
+import shutil
+import tempfile
 import time
 import xml.etree.ElementTree as ET
 
 from lib.commands import ssh
 from lib.common import wait_for
 
-from typing import Any, Callable, Self
+from typing import Any, Callable, Iterable, Self
 
 class InstallationFailed(Exception):
     pass
@@ -167,3 +171,79 @@ def monitor_restore(*, ip: str) -> None:
     time.sleep(30)
 
     logging.info("Shutting down Host VM after successful restore")
+
+def remastered_iso_cache_key(iso_file: str, iso_remaster: str, inputs: Iterable[str], workdir: str) -> str:
+    """
+    Compute the cache key of a remastered ISO from everything the result depends on.
+
+    The source ISO and the iso-remaster tool are identified by path, size and modification time, to avoid
+    reading whole ISOs. `inputs` are the generated files passed to iso-remaster (answerfile, patcher
+    scripts), hashed by content, with `workdir` (the temporary directory they reference) masked out.
+    Missing inputs (eg. no answerfile) are part of the key.
+    """
+    sha = hashlib.sha256()
+    for path in (iso_file, iso_remaster):
+        st = os.stat(path)
+        sha.update(f"{os.path.realpath(path)}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    for path in inputs:
+        sha.update(f"{os.path.basename(path)}\0".encode())
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                sha.update(f.read().replace(workdir.encode(), b"@WORKDIR@"))
+        else:
+            sha.update(b"\0missing\0")
+    return sha.hexdigest()
+
+def cached_remastered_iso(cache_dir: str, key: str) -> str | None:
+    """ Return the cached remastered ISO for `key`, marking it as recently used, or None if not cached. """
+    cached = os.path.join(cache_dir, f"{key}.iso")
+    try:
+        os.utime(cached)
+    except FileNotFoundError:
+        return None
+    logging.info("Using cached remastered ISO %s", cached)
+    return cached
+
+def store_remastered_iso(cache_dir: str, key: str, iso_file: str, max_size: int) -> str:
+    """
+    Add a remastered ISO to the cache, evict least recently used ISOs to fit `max_size`, and return the
+    path of the cached ISO.
+
+    The ISO is first copied to a temporary file in the cache, then renamed, so that
+    concurrent test sessions sharing the cache never see a partial ISO.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = os.path.join(cache_dir, f"{key}.iso")
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=f".{key}.", suffix=".part")
+    os.close(fd)
+    try:
+        shutil.copyfile(iso_file, tmp_file)
+        os.replace(tmp_file, cached)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    logging.info("Cached remastered ISO as %s", cached)
+    _evict_remastered_isos(cache_dir, max_size, keep=cached)
+    return cached
+
+def _evict_remastered_isos(cache_dir: str, max_size: int, keep: str) -> None:
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".iso") and entry.is_file():
+            try:
+                st = entry.stat()
+            except FileNotFoundError:  # evicted by a concurrent session
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        logging.info("Evicting remastered ISO %s from cache", path)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
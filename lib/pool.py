@@ -7,7 +7,7 @@ import traceback
 from packaging import version
 
 import lib.commands as commands
-from lib.common import HostAddress, _param_get, _param_set, safe_split, wait_for_not
+from lib.common import HostAddress, _param_get, _param_set, file_sha256, safe_split, wait_for_not
 from lib.efi import EFIAuth
 from lib.host import Host
 from lib.sr import SR
@@ -136,9 +136,36 @@ class Pool:
         assert len(uuids) == 1  # we may need to allow finer selection if this triggers
         return SR(uuids[0], self)
 
-    def push_iso(self, local_file: str, remote_filename: str | None = None) -> str:
+    def push_iso(self, local_file: str, remote_filename: str | None = None, dedupe: bool = False) -> str:
+        """
+        Upload a local ISO file to the ISO SR of the pool, and return its name in the SR.
+
+        With `dedupe`, the remote file is named after the SHA-256 of the local file's content and the upload
+        is skipped if this ISO is already in the SR. Such ISOs are shared by all the users of the SR, so they
+        must not be removed by any one of them.
+        """
         iso_sr = self.get_iso_sr()
         mountpoint = f"/run/sr-mount/{iso_sr.uuid}"
+        if dedupe:
+            assert remote_filename is None, "dedupe uses content-addressed remote filenames"
+            remote_filename = f"{mountpoint}/{file_sha256(local_file)}.iso"
+            remote_size = self.master.ssh(f'stat -c %s {remote_filename} 2>/dev/null || true')
+            if remote_size == str(os.path.getsize(local_file)):
+                logging.info("ISO %s already in ISO-SR as %s, not uploading", local_file, remote_filename)
+                return os.path.basename(remote_filename)
+
+            # upload under a temporary name so that a partial upload never looks like a valid ISO
+            tmp_filename = self.master.ssh(f'mktemp -p {mountpoint} .push-iso.XXXXXX')
+            logging.info("Uploading to ISO-SR %s as %s", local_file, remote_filename)
+            try:
+                self.master.scp(local_file, tmp_filename)
+                self.master.ssh(f'chmod 644 {tmp_filename} && mv -f {tmp_filename} {remote_filename}')
+            except BaseException:
+                self.master.ssh(f'rm -f {tmp_filename}', check=False)
+                raise
+            iso_sr.scan()
+            return os.path.basename(remote_filename)
+
         if remote_filename is None:
             # needs only work on XCP-ng 8.2+
             remote_filename = self.master.ssh(f'mktemp --suffix=.iso -p {mountpoint}')
@@ -1,7 +1,14 @@
 from __future__ import annotations
 
+import atexit
+import logging
+import re
+import subprocess
+import threading
+import time
+
 from data import ARP_SERVER, PXE_CONFIG_SERVER
-from lib.commands import scp, ssh
+from lib.commands import scp, ssh, ssh_stream
 
 PXE_CONFIG_DIR = "/pxe/configs/custom"
 
@@ -35,10 +42,123 @@ def server_remove_bootconf(mac_address: str) -> None:
     distant_file = f'{PXE_CONFIG_DIR}/{mac_address}/boot.conf'
     ssh(PXE_CONFIG_SERVER, f'rm -rf {distant_file}')
 
+# Neighbour entries, as printed by both `ip neigh show` and `ip monitor neigh`, eg.:
+# "10.0.0.5 dev eth0 lladdr 52:54:00:12:34:56 REACHABLE"
+# "Deleted 10.0.0.5 dev eth0 lladdr 52:54:00:12:34:56 STALE"
+# "10.0.0.6 dev eth0  FAILED"
+_NEIGH_RE = re.compile(r"^(?:\[NEIGH\])?(Deleted )?(\S+) dev \S+(?: lladdr (\S+))?.*?(?: (\w+))?$")
+# Printed after the output of `ip neigh show`, which doesn't match _NEIGH_RE
+_DUMP_END = "--- end of neighbour dump ---"
+
+class ArpWatcher:
+    """
+    Index of the reachable neighbours of an ARP server, kept up to date by one long-lived `ip monitor neigh`.
+
+    Any number of threads can wait for a MAC address to get an IP without further round-trips to the server.
+    The monitor is restarted if the connection drops. Lookups wait for the current neighbours to be known.
+    """
+
+    # Delay before reconnecting after the monitor stopped
+    RECONNECT_DELAY_SECS = 5
+    # Maximum time lookups wait for the initial neighbour dump
+    DUMP_TIMEOUT_SECS = 60
+
+    def __init__(self, server: str):
+        self.server = server
+        # MAC -> IP -> neighbour state (REACHABLE, STALE, ...)
+        self.neighbours: dict[str, dict[str, str]] = {}
+        self._cond = threading.Condition()
+        self._process: subprocess.Popen[bytes] | None = None
+        # whether the neighbours include the dump of the current connection
+        self._dumped = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=f"arp-watcher-{server}", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            # start the monitor before the dump, so that no change is missed in between
+            process = ssh_stream(self.server, f"ip monitor neigh & ip neigh show; echo '{_DUMP_END}'; wait")
+            with self._cond:
+                self._process = process
+                self._dumped = False
+                self.neighbours.clear()
+            assert process.stdout is not None
+            for raw_line in process.stdout:
+                line = raw_line.decode(errors='replace').strip()
+                if line == _DUMP_END:
+                    with self._cond:
+                        self._dumped = True
+                        self._cond.notify_all()
+                else:
+                    self._update(line)
+            process.wait()
+            if not self._stopped:
+                logging.warning("ARP watcher for %s stopped (exit code %s), restarting",
+                                self.server, process.returncode)
+                time.sleep(self.RECONNECT_DELAY_SECS)
+
+    def _update(self, line: str) -> None:
+        m = _NEIGH_RE.match(line)
+        if m is None:
+            return
+        deleted, ip, mac, state = m.groups()
+        with self._cond:
+            # the IP may have moved to another MAC, or lost its MAC (FAILED, INCOMPLETE)
+            for ips in self.neighbours.values():
+                ips.pop(ip, None)
+            if mac is not None and not deleted:
+                self.neighbours.setdefault(mac.lower(), {})[ip] = state or ""
+            self._cond.notify_all()
+
+    def _reachable(self, mac_address: str) -> list[str]:
+        ips = self.neighbours.get(mac_address.lower(), {})
+        return [ip for ip, state in ips.items() if state == "REACHABLE"]
+
+    def _wait_for_dump(self) -> None:
+        if not self._cond.wait_for(lambda: self._dumped, self.DUMP_TIMEOUT_SECS):
+            raise TimeoutError(f"Timeout reached while waiting for the neighbours of {self.server} "
+                               f"({self.DUMP_TIMEOUT_SECS})")
+
+    def addresses_for(self, mac_address: str) -> list[str]:
+        """ IPs currently reachable with this MAC address. """
+        with self._cond:
+            self._wait_for_dump()
+            return self._reachable(mac_address)
+
+    def wait_for_addresses(self, mac_address: str, timeout_secs: float) -> list[str]:
+        """ Block until the MAC address is reachable with at least one IP, and return its IPs. """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._reachable(mac_address), timeout_secs):
+                raise TimeoutError(f"Timeout reached while waiting for {mac_address} in ARP tables of "
+                                   f"{self.server} ({timeout_secs})")
+            return self._reachable(mac_address)
+
+    def stop(self) -> None:
+        self._stopped = True
+        with self._cond:
+            if self._process is not None:
+                self._process.terminate()
+
+_arp_watchers: dict[str, ArpWatcher] = {}
+_arp_watchers_lock = threading.Lock()
+
+def arp_watcher(server: str = ARP_SERVER) -> ArpWatcher:
+    """ Return the ARP watcher of a server, starting it on first use. """
+    with _arp_watchers_lock:
+        if server not in _arp_watchers:
+            _arp_watchers[server] = ArpWatcher(server)
+        return _arp_watchers[server]
+
+@atexit.register
+def _stop_arp_watchers() -> None:
+    for watcher in _arp_watchers.values():
+        watcher.stop()
+
 def arp_addresses_for(mac_address: str) -> list[str]:
-    output = ssh(
-        ARP_SERVER,
-        f"ip neigh show nud reachable | grep {mac_address} | awk '{{ print $1 }}'"
-    )
-    candidate_ips = output.splitlines()
-    return candidate_ips
+    return arp_watcher().addresses_for(mac_address)
+
+def wait_for_arp_addresses(mac_address: str, msg: str | None = None, timeout_secs: float = 2 * 60) -> list[str]:
+    if msg is not None:
+        logging.info(msg)
+    return arp_watcher().wait_for_addresses(mac_address, timeout_secs)
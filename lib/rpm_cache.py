@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import ipaddress
+import logging
+import os
+import re
+import select
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+from lib.common import MiB
+from lib.netutil import wrap_ip
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from lib.host import Host
+
+# Repository metadata files named after their checksum never change, unlike repomd.xml which references them
+_CHECKSUMMED_METADATA_RE = re.compile(r"/repodata/[0-9a-f]{40,128}-[^/]+$")
+# Headers that only apply to one connection, and must not be forwarded by a proxy
+_HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection", "te", "trailers",
+    "transfer-encoding", "upgrade",
+}
+_UPSTREAM_TIMEOUT = 60
+# Yum only needs HTTPS tunnels to mirrors, not to any service reachable from the test runner
+_CONNECT_PORTS = {443}
+
+def is_cacheable(path: str) -> bool:
+    """ Whether the file at this URL path is immutable: packages, and metadata files named after their checksum. """
+    return path.endswith(".rpm") or _CHECKSUMMED_METADATA_RE.search(path) is not None
+
+class RpmCacheStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.forwarded = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+
+    def add(self, hits: int = 0, misses: int = 0, forwarded: int = 0, hit_bytes: int = 0, miss_bytes: int = 0) -> None:
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.forwarded += forwarded
+            self.hit_bytes += hit_bytes
+            self.miss_bytes += miss_bytes
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.hits} hits, {self.misses} misses ({self.hit_ratio:.0%} hit ratio), "
+                f"{self.hit_bytes / MiB:.1f} MiB served from cache, {self.miss_bytes / MiB:.1f} MiB downloaded, "
+                f"{self.forwarded} requests forwarded without caching")
+
+def _normalize_ip(ip: str) -> str:
+    """ The IP as the proxy sees it for a client, IPv4 clients of an IPv6 socket being IPv4-mapped. """
+    address = ipaddress.ip_address(ip.split("%")[0])
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return str(address)
+
+class _RpmCacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # listen for both IPv4 and IPv6 hosts
+    address_family = socket.AF_INET6 if socket.has_dualstack_ipv6() else socket.AF_INET
+    proxy: RpmCacheProxy
+
+    def server_bind(self) -> None:
+        if self.address_family == socket.AF_INET6:
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        super().server_bind()
+
+    def verify_request(self, request: object, client_address: object) -> bool:
+        """ Only serve the configured hosts: the proxy listens on all interfaces, it must not be an open proxy. """
+        assert isinstance(client_address, tuple)
+        if _normalize_ip(client_address[0]) in self.proxy.allowed_clients:
+            return True
+        logging.warning(f"[rpm cache] Refused connection from {client_address[0]}")
+        return False
+
+class _RpmCacheHandler(BaseHTTPRequestHandler):
+    server: _RpmCacheServer
+    # keep the connections of yum open between packages
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug(f"[rpm cache] {self.client_address[0]} {format % args}")
+
+    def _forward(self, method: str) -> None:
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in _HOP_BY_HOP_HEADERS | {"host"}}
+        try:
+            response = requests.request(method, self.path, headers=headers, stream=True,
+                                        allow_redirects=False, timeout=_UPSTREAM_TIMEOUT)
+        except requests.RequestException as e:
+            self.send_error(502, f"Upstream request failed: {e}")
+            return
+        self.server.proxy.stats.add(forwarded=1)
+        with response:
+            self.send_response(response.status_code)
+            for key, value in response.headers.items():
+                # requests decodes the content, it must not be announced as still encoded
+                if key.lower() not in _HOP_BY_HOP_HEADERS | {"content-encoding", "content-length"}:
+                    self.send_header(key, value)
+            if method == "HEAD":
+                self.send_header("Content-Length", response.headers.get("Content-Length", "0"))
+                self.end_headers()
+                return
+            # the decoded length is unknown: the end of the content is signaled by closing the connection
+            self.close_connection = True
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in response.iter_content(MiB):
+                self.wfile.write(chunk)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if not url.scheme or not url.netloc:
+            self.send_error(400, "Not a proxy request")
+            return
+        if not is_cacheable(url.path) or "Range" in self.headers:
+            self._forward("GET")
+            return
+        try:
+            path, hit = self.server.proxy.fetch(self.path)
+        except requests.HTTPError as e:
+            self.send_error(e.response.status_code)
+            return
+        except requests.RequestException as e:
+            self.send_error(502, f"Upstream request failed: {e}")
+            return
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            self.connection.sendfile(f)
+        if hit:
+            self.server.proxy.stats.add(hits=1, hit_bytes=size)
+
+    def do_HEAD(self) -> None:
+        self._forward("HEAD")
+
+    def do_CONNECT(self) -> None:
+        """ Tunnel HTTPS requests, which can't be cached. """
+        host, _, port = self.path.rpartition(":")
+        if not port.isdigit() or int(port) not in _CONNECT_PORTS:
+            self.send_error(403, f"Tunnels are only allowed to ports {sorted(_CONNECT_PORTS)}")
+            return
+        try:
+            upstream = socket.create_connection((host.strip("[]"), int(port)), timeout=_UPSTREAM_TIMEOUT)
+        except OSError as e:
+            self.send_error(502, f"Upstream connection failed: {e}")
+            return
+        self.server.proxy.stats.add(forwarded=1)
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        self.close_connection = True
+        with upstream:
+            sockets = [self.connection, upstream]
+            while True:
+                readable, _, _ = select.select(sockets, [], [], _UPSTREAM_TIMEOUT)
+                if not readable:
+                    return
+                for s in readable:
+                    data = s.recv(64 * 1024)
+                    if not data:
+                        return
+                    (upstream if s is self.connection else self.connection).sendall(data)
+
+class RpmCacheProxy:
+    """
+    An HTTP proxy, running on the test runner, that caches the packages downloaded by yum on the hosts.
+
+    Packages and repository metadata files named after their checksum are immutable: they are downloaded once from
+    the mirrors and then served from `cache_dir` to all the hosts of all the pools. Concurrent requests for the same
+    file wait for a single download. Other requests, like `repomd.xml`, are forwarded, so that the hosts always see
+    the latest state of the repositories.
+
+    Only the hosts set up with `configure()`, or allowed with `allow()`, can use the proxy.
+    """
+
+    def __init__(self, cache_dir: str, port: int = 0):
+        self.cache_dir = cache_dir
+        self.stats = RpmCacheStats()
+        self._lock = threading.Lock()
+        self._fetch_locks: dict[str, threading.Lock] = {}
+        self.allowed_clients: set[str] = set()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.server = _RpmCacheServer(("", port), _RpmCacheHandler)
+        self.server.proxy = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="rpm-cache", daemon=True)
+        self.thread.start()
+        logging.info(f"RPM cache proxy listening on port {self.port}, caching in {cache_dir}")
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def _cache_path(self, url: str) -> str:
+        parsed = urlsplit(url)
+        path = os.path.normpath(os.path.join(self.cache_dir, parsed.netloc, parsed.path.lstrip("/")))
+        if not path.startswith(os.path.join(os.path.normpath(self.cache_dir), "")):
+            raise requests.RequestException(f"Invalid path in {url}")
+        return path
+
+    def fetch(self, url: str) -> tuple[str, bool]:
+        """ Return the path of the cached file for this URL, downloading it if needed, and whether it was cached. """
+        path = self._cache_path(url)
+        if os.path.exists(path):
+            return path, True
+        with self._lock:
+            lock = self._fetch_locks.setdefault(path, threading.Lock())
+        with lock:
+            if os.path.exists(path):
+                return path, True
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # the file is stored as is: no content encoding
+            with requests.get(url, headers={"Accept-Encoding": "identity"}, stream=True,
+                              timeout=_UPSTREAM_TIMEOUT) as response:
+                response.raise_for_status()
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        shutil.copyfileobj(response.raw, f, MiB)
+                        size = f.tell()
+                    expected = response.headers.get("Content-Length")
+                    if expected is not None and int(expected) != size:
+                        raise requests.RequestException(f"Truncated download of {url}: {size}/{expected} bytes")
+                    os.replace(tmp, path)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+            self.stats.add(misses=1, miss_bytes=size)
+        return path, False
+
+    def allow(self, ip: str) -> None:
+        """ Let a client use the proxy. """
+        self.allowed_clients.add(_normalize_ip(ip))
+
+    def _ssh_connection(self, host: Host) -> tuple[str, str]:
+        """ The IPs of the test runner and of the host, as seen from each other. """
+        # SSH_CONNECTION: "<client ip> <client port> <server ip> <server port>"
+        runner_ip, _, host_ip, _ = host.ssh("echo $SSH_CONNECTION").split()
+        return runner_ip, host_ip
+
+    def url_for(self, host: Host) -> str:
+        """ The URL of the proxy, as seen from the host. """
+        runner_ip, _ = self._ssh_connection(host)
+        return f"http://{wrap_ip(runner_ip)}:{self.port}"
+
+    def configure(self, host: Host) -> None:
+        """ Make yum on the host download through the proxy, which it connects to from the IP it is reached at. """
+        runner_ip, host_ip = self._ssh_connection(host)
+        self.allow(host_ip)
+        url = f"http://{wrap_ip(runner_ip)}:{self.port}"
+        logging.info(f"[{host}] Use RPM cache proxy {url}")
+        host.set_yum_proxy(url)
+
+    def unconfigure(self, host: Host) -> None:
+        host.set_yum_proxy(None)
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        logging.info(f"RPM cache: {self.stats}")
@@ -11,17 +11,44 @@ from pathlib import Path
 from lib.common import HostAddress
 from lib.tools import logger
 from lib.tools.inventory import into_inventory, load_inventory
-from lib.tools.tasks.clean import clean_pools
+from lib.tools.tasks.clean import DEFAULT_JOBS, clean_pools
 from lib.tools.tasks.exec import exec_pools
 from lib.tools.tasks.update import update_pools
 
-def _command_update(args: argparse.Namespace) -> None:
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def _command_update(args: argparse.Namespace) -> int:
     if args.inventory:
         inventory = load_inventory(args.inventory)
     else:
         inventory = into_inventory(args.hosts, args.repos, args.hosting_pool, disabled_repositories=args.disablerepos)
 
-    update_pools(inventory, reboot=args.reboot, parallel=args.parallel)
+    rpm_cache = None
+    if args.rpm_cache:
+        from lib.rpm_cache import RpmCacheProxy
+        rpm_cache = RpmCacheProxy(args.rpm_cache, args.rpm_cache_port)
+    try:
+        return update_pools(
+            inventory,
+            reboot=args.reboot,
+            parallel=args.parallel,
+            evacuate=args.evacuate,
+            max_unavailable=args.max_unavailable,
+            state_file=args.state,
+            rpm_cache=rpm_cache,
+            package_cache=args.package_cache,
+        )
+    finally:
+        if rpm_cache is not None:
+            rpm_cache.stop()
 
 
 def _command_clean(args: argparse.Namespace) -> int:
@@ -30,7 +57,7 @@ def _command_clean(args: argparse.Namespace) -> int:
     else:
         inventory = into_inventory(args.hosts, [], args.hosting_pool)
 
-    return clean_pools(inventory, dry_run=args.dry_run)
+    return clean_pools(inventory, dry_run=args.dry_run, jobs=args.jobs)
 
 
 def _command_exec(args: argparse.Namespace) -> int:
@@ -98,7 +125,46 @@ def cli() -> None:
         "--parallel",
         action="store_true",
         default=False,
-        help="Update the master and secondary hosts at the same time",
+        help="Update all the hosts of a pool at the same time, without evacuating them",
+    )
+    subparser_cmd_update.add_argument(
+        "--max-unavailable",
+        type=_positive_int,
+        metavar="N",
+        default=1,
+        help="Maximum number of secondary hosts of a pool to update at the same time (default: 1)",
+    )
+    subparser_cmd_update.add_argument(
+        "--no-evacuate",
+        action="store_false",
+        dest="evacuate",
+        default=True,
+        help="Don't migrate the VMs of a host to the other hosts of its pool before rebooting it",
+    )
+    subparser_cmd_update.add_argument(
+        "--state",
+        type=Path,
+        metavar="FILE",
+        help="Record the progress of the update in FILE, and resume an interrupted update from it",
+    )
+    subparser_cmd_update.add_argument(
+        "--rpm-cache",
+        metavar="DIR",
+        help="Download packages once for all hosts through a local caching proxy, storing them in DIR",
+    )
+    subparser_cmd_update.add_argument(
+        "--rpm-cache-port",
+        type=int,
+        metavar="PORT",
+        default=0,
+        help="Port of the caching proxy, which must be reachable from the hosts (default: any free port)",
+    )
+    subparser_cmd_update.add_argument(
+        "--package-cache",
+        type=Path,
+        metavar="DIR",
+        help="Keep the lists of installed packages of the hosts in DIR, to only fetch them again from the hosts "
+             "whose packages changed since the previous run",
     )
     subparser_cmd_update.set_defaults(func=_command_update)
 
@@ -123,7 +189,15 @@ def cli() -> None:
         "--dry-run",
         action="store_true",
         default=False,
-        help="Only display what would be removed, without deleting anything",
+        help="Only display what would be removed, and the estimated duration, without deleting anything",
+    )
+    subparser_cmd_clean.add_argument(
+        "-j",
+        "--jobs",
+        type=_positive_int,
+        metavar="N",
+        default=DEFAULT_JOBS,
+        help=f"Maximum number of VMs or VDIs removed at the same time in each pool (default: {DEFAULT_JOBS})",
     )
     subparser_cmd_clean.set_defaults(func=_command_clean)
 
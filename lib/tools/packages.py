@@ -0,0 +1,166 @@
+"""Package inventory for tools scripts.
+
+The installed packages of many hosts are collected in parallel, and stored once in a table where each distinct
+package is identified by an index. The packages of a host are a bitset over these indexes, so that comparing hosts
+or states is a few integer operations, whatever the number of hosts and packages.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import operator
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    from lib.host import Host
+
+# Packages which are not real packages, and never available in repositories
+IGNORED_PREFIXES = ("gpg-pubkey-",)
+# Files of the rpm database, berkeley DB (XCP-ng 8) or sqlite: they change with every transaction
+RPMDB_FILES = ["/var/lib/rpm/Packages", "/var/lib/rpm/rpmdb.sqlite"]
+# Checksum of the stat output when none of the RPMDB_FILES exist: can't tell whether packages changed
+_NO_RPMDB = hashlib.md5(b"").hexdigest()
+# One package per line: "<name> <name>-<epoch>:<version>-<release>.<arch>", the format of Host.packages()
+_RPM_QA_FORMAT = r"%{NAME} %{NAME}-%{EPOCHNUM}:%{VERSION}-%{RELEASE}.%{ARCH}\n"
+# Default number of hosts queried at the same time
+DEFAULT_JOBS = 16
+
+class PackageTable:
+    """Interned packages: each distinct NEVRA is stored once, and sets of packages are bitsets of their indexes."""
+
+    def __init__(self) -> None:
+        self.nevras: list[str] = []
+        self.names: list[str] = []
+        self._indexes: dict[str, int] = {}
+        # bitset of the packages to leave out of reports, see IGNORED_PREFIXES
+        self.ignored = 0
+
+    def add(self, packages: Iterable[tuple[str, str]]) -> int:
+        """Intern (name, NEVRA) pairs, and return the bitset of these packages."""
+        bits = 0
+        for name, nevra in packages:
+            index = self._indexes.get(nevra)
+            if index is None:
+                index = self._indexes[nevra] = len(self.nevras)
+                self.nevras.append(nevra)
+                self.names.append(name)
+                if nevra.startswith(IGNORED_PREFIXES):
+                    self.ignored |= 1 << index
+            bits |= 1 << index
+        return bits
+
+    def lookup(self, nevras: Iterable[str]) -> int:
+        """The bitset of the packages of the table among these NEVRAs: others are not installed on any host."""
+        bits = 0
+        for nevra in nevras:
+            index = self._indexes.get(nevra)
+            if index is not None:
+                bits |= 1 << index
+        return bits
+
+    def indexes(self, bits: int) -> list[int]:
+        # bin() is much faster than testing bits one by one
+        return [i for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == "1"]
+
+    def packages(self, bits: int) -> list[str]:
+        """The sorted NEVRAs of a bitset."""
+        return sorted(self.nevras[i] for i in self.indexes(bits))
+
+    def package_names(self, bits: int) -> list[str]:
+        """The names of the packages of a bitset, in the order of their NEVRAs."""
+        return [self.names[i] for i in sorted(self.indexes(bits), key=lambda i: self.nevras[i])]
+
+class PackageInventory:
+    """The installed packages of hosts, as bitsets of a PackageTable.
+
+    The packages of a host are only fetched again when its rpm database changed, using a checksum of the stat of the
+    database files, computed in the same SSH call. With a `cache_dir`, they are also kept between runs.
+    """
+
+    def __init__(self, cache_dir: Path | None = None, jobs: int = DEFAULT_JOBS):
+        self.table = PackageTable()
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        # rpmdb checksum and packages of each host, by host address
+        self._cache: dict[str, tuple[str, list[tuple[str, str]]]] = {}
+        # number of hosts whose packages were fetched, and not found in the cache
+        self.fetched = 0
+
+    def _cache_file(self, host: Host) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / f"{host.hostname_or_ip}.json"
+
+    def _cached(self, host: Host) -> tuple[str, list[tuple[str, str]]] | None:
+        cached = self._cache.get(host.hostname_or_ip)
+        cache_file = self._cache_file(host)
+        if cached is None and cache_file is not None and cache_file.exists():
+            data = json.loads(cache_file.read_text())
+            cached = data["rpmdb"], [(name, nevra) for name, nevra in data["packages"]]
+        return cached
+
+    def _store(self, host: Host, checksum: str, packages: list[tuple[str, str]]) -> None:
+        self._cache[host.hostname_or_ip] = checksum, packages
+        cache_file = self._cache_file(host)
+        if cache_file is None or checksum == _NO_RPMDB:
+            return
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_file.parent, prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"rpmdb": checksum, "packages": packages}, f)
+        os.replace(tmp, cache_file)
+
+    def _fetch(self, host: Host) -> tuple[list[tuple[str, str]], bool]:
+        """The (name, NEVRA) of the packages of the host, and whether they were fetched or came from the cache."""
+        cached = self._cached(host)
+        known = cached[0] if cached is not None and cached[0] != _NO_RPMDB else ""
+        # a single SSH call: the packages are only listed if the checksum changed
+        output = host.ssh(
+            f"sum=$(stat -c '%n %i %s %y' {' '.join(RPMDB_FILES)} 2>/dev/null | md5sum | cut -d' ' -f1); "
+            f"echo $sum; if [ \"$sum\" != '{known}' ]; then rpm -qa --qf '{_RPM_QA_FORMAT}'; fi"
+        )
+        checksum, *lines = output.splitlines()
+        if checksum == known and cached is not None:
+            self._cache[host.hostname_or_ip] = cached
+            return cached[1], False
+        packages = [(name, nevra) for name, nevra in (line.split(" ", 1) for line in lines)]
+        self._store(host, checksum, packages)
+        return packages, True
+
+    def collect(self, hosts: list[Host]) -> dict[Host, int]:
+        """The installed packages of each host, fetched in parallel."""
+        if not hosts:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.jobs, len(hosts))) as executor:
+            results = list(executor.map(self._fetch, hosts))
+        self.fetched += sum(fetched for _, fetched in results)
+        return {host: self.table.add(packages) for host, (packages, _) in zip(hosts, results)}
+
+    def available(self, host: Host, repoquery_args: str = "") -> int:
+        """The packages of the table that are available in the repositories of the host."""
+        return self.table.lookup(host.ssh(f"repoquery --all {repoquery_args}".strip()).splitlines())
+
+    def common(self, packages: list[int]) -> int:
+        """The packages common to all the bitsets, ignored packages excluded."""
+        return functools.reduce(operator.and_, packages, -1) & ~self.table.ignored if packages else 0
+
+    def changed(self, before: dict[Host, int], after: dict[Host, int]) -> dict[Host, int]:
+        """The packages of each host that were installed or updated since `before`."""
+        return {h: after[h] & ~bits & ~self.table.ignored for h, bits in before.items()}
+
+    def differences(self, packages: dict[Host, int]) -> dict[Host, int]:
+        """The packages of each host that not all hosts have, for the hosts which have some."""
+        common = self.common(list(packages.values()))
+        extra = {h: bits & ~common & ~self.table.ignored for h, bits in packages.items()}
+        return {h: bits for h, bits in extra.items() if bits}
+
+    def unavailable(self, packages: dict[Host, int], available: int) -> dict[Host, int]:
+        """The installed packages of each host that are not in `available`, for the hosts which have some."""
+        missing = {h: bits & ~available & ~self.table.ignored for h, bits in packages.items()}
+        return {h: bits for h, bits in missing.items() if bits}
@@ -6,17 +6,53 @@ from existing remote targets.
 from __future__ import annotations
 
 from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-from lib.common import safe_split, wait_for_not
+from lib.common import parse_xe_records, safe_split, wait_for_not
+from lib.host import Host
 from lib.pool import NotAMasterHostError, Pool
-from lib.sr import SR
 from lib.tools.inventory import Inventory
-from lib.vdi import VDI
-from lib.vm import VM
 
 from .. import logger
 
-def clean_pools(inventory: Inventory, dry_run: bool = False) -> int:
+# Default number of objects destroyed at the same time in each pool
+DEFAULT_JOBS = 8
+# Rough duration of each operation, in seconds, to estimate the duration of a cleanup
+ESTIMATED_DURATIONS = {
+    "vm-shutdown": 10.0,
+    "vdi-destroy": 2.0,
+    "vm-destroy": 1.0,
+}
+
+@dataclass
+class CleanupAction:
+    """The destruction of a VM, snapshot or VDI, with the disks of the VM or snapshot."""
+    kind: str
+    uuid: str
+    name: str
+    shutdown: bool = False
+    vdi_uuids: list[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.uuid} ({self.name})"
+
+    def operations(self) -> list[str]:
+        """The xe operations needed, in order."""
+        ops = ["vm-shutdown"] if self.shutdown else []
+        ops += ["vdi-destroy"] * len(self.vdi_uuids)
+        if self.kind != "VDI":
+            ops.append("vm-destroy")
+        return ops
+
+    def run(self, master: Host) -> None:
+        if self.shutdown:
+            master.xe("vm-shutdown", {"uuid": self.uuid, "force": True})
+        for vdi_uuid in self.vdi_uuids:
+            master.xe("vdi-destroy", {"uuid": vdi_uuid})
+        if self.kind != "VDI":
+            master.xe("vm-destroy", {"uuid": self.uuid})
+
+def clean_pools(inventory: Inventory, dry_run: bool = False, jobs: int = DEFAULT_JOBS) -> int:
     """Remove all VMs and all orphan VDIs on local storage from pool(s).
 
     .. note::
@@ -31,6 +67,8 @@ def clean_pools(inventory: Inventory, dry_run: bool = False) -> int:
         Each host (key) holds its own config data (values, eg: `enablerepos`).
     :param bool dry_run:
         When True, only log what would be removed without actually deleting.
+    :param int jobs:
+        Maximum number of VMs or VDIs destroyed at the same time in each pool.
     :return:
         The number of VMs/VDIs/snapshots that failed to be removed.
     """
@@ -42,8 +80,8 @@ def clean_pools(inventory: Inventory, dry_run: bool = False) -> int:
         except NotAMasterHostError:
             logger.warning(f"[{host}] Skipping: not a master host")
 
-    with ThreadPoolExecutor() as executor:
-        futures = {executor.submit(clean_pool, p, dry_run): p for p in pools}
+    with ThreadPoolExecutor(max_workers=max(1, len(pools))) as executor:
+        futures = {executor.submit(clean_pool, p, dry_run, jobs): p for p in pools}
         failures = 0
         for future in futures:
             pool = futures[future]
@@ -54,7 +92,73 @@ def clean_pools(inventory: Inventory, dry_run: bool = False) -> int:
                 failures += 1
     return failures
 
-def clean_pool(pool: Pool, dry_run: bool) -> int:
+def plan_pool_cleanup(pool: Pool) -> list[list[CleanupAction]]:
+    """Return the actions needed to clean the pool, in successive stages.
+
+    The actions of a stage can run concurrently, but only after all the actions of the previous stages: VM snapshots
+    are destroyed before their VMs, then the VDIs left on local SRs, VDI snapshots before their parents.
+    Objects are listed with one xe call per type, instead of one per object and parameter.
+    """
+    master = pool.master
+    vms = parse_xe_records(master.xe(
+        "vm-list",
+        {"is-control-domain": False, "params": "uuid,name-label,power-state,is-a-template,is-a-snapshot"},
+    ))
+    vbds = parse_xe_records(master.xe("vbd-list", {"type": "Disk", "params": "vm-uuid,vdi-uuid"}))
+    srs = parse_xe_records(master.xe("sr-list", {"content-type": "user", "params": "uuid,shared"}))
+    vdis = parse_xe_records(master.xe("vdi-list", {"managed": True, "params": "uuid,name-label,sr-uuid,is-a-snapshot"}))
+
+    # templates are kept, but not their disks on local SRs, which are destroyed with the orphan VDIs
+    vms = [vm for vm in vms if vm["is-a-template"] != "true" or vm["is-a-snapshot"] == "true"]
+    vm_uuids = {vm["uuid"] for vm in vms}
+    # the VDIs destroyed with the VMs and snapshots, each by the first one using it
+    vm_vdis: dict[str, list[str]] = {}
+    seen_vdis = set()
+    for vbd in vbds:
+        if vbd["vm-uuid"] not in vm_uuids or vbd["vdi-uuid"] in seen_vdis or vbd["vdi-uuid"] == "<not in database>":
+            continue
+        seen_vdis.add(vbd["vdi-uuid"])
+        vm_vdis.setdefault(vbd["vm-uuid"], []).append(vbd["vdi-uuid"])
+
+    snapshots: list[CleanupAction] = []
+    others: list[CleanupAction] = []
+    for vm in vms:
+        is_snapshot = vm["is-a-snapshot"] == "true"
+        action = CleanupAction(
+            "snapshot" if is_snapshot else "VM",
+            vm["uuid"],
+            vm["name-label"],
+            shutdown=not is_snapshot and vm["power-state"] != "halted",
+            vdi_uuids=vm_vdis.get(vm["uuid"], []),
+        )
+        (snapshots if is_snapshot else others).append(action)
+
+    local_srs = {sr["uuid"] for sr in srs if sr["shared"] != "true"}
+    vdi_snapshots: list[CleanupAction] = []
+    vdi_others: list[CleanupAction] = []
+    for vdi in vdis:
+        if vdi["sr-uuid"] not in local_srs or vdi["uuid"] in seen_vdis:
+            continue
+        action = CleanupAction("VDI", vdi["uuid"], vdi["name-label"], vdi_uuids=[vdi["uuid"]])
+        (vdi_snapshots if vdi["is-a-snapshot"] == "true" else vdi_others).append(action)
+
+    return [stage for stage in (snapshots, others, vdi_snapshots, vdi_others) if stage]
+
+def estimated_duration(stages: list[list[CleanupAction]], jobs: int) -> float:
+    """Estimate the duration of a cleanup, in seconds, from the rough durations of its operations."""
+    total = 0.0
+    for stage in stages:
+        durations = sorted(
+            (sum(ESTIMATED_DURATIONS[op] for op in action.operations()) for action in stage), reverse=True
+        )
+        # the actions are spread over `jobs` workers: the stage ends with its most loaded worker
+        workers = [0.0] * min(jobs, len(durations))
+        for d in durations:
+            workers[workers.index(min(workers))] += d
+        total += max(workers)
+    return total
+
+def clean_pool(pool: Pool, dry_run: bool, jobs: int = DEFAULT_JOBS) -> int:
     """Remove all VMs and all orphan VDIs on local SRs from a single pool.
 
     :return:
@@ -62,48 +166,40 @@ def clean_pool(pool: Pool, dry_run: bool) -> int:
     """
     master = pool.master
     log_prefix = 'Would remove' if dry_run else 'Removing'
-    failures = 0
-
-    vm_uuids = safe_split(master.xe(
-        'vm-list',
-        {'is-control-domain': False, 'is-a-template': False},
-        minimal=True,
-    )) + safe_split(master.xe(
-        'vm-list',
-        {'is-a-snapshot': True},
-        minimal=True,
-    ))
-    for vm_uuid in vm_uuids:
-        vm = VM(vm_uuid, master)
-        logger.info(f"[{master}] {log_prefix} VM {vm.uuid} ({vm.name()})")
-        if not dry_run:
-            try:
-                vm.destroy(verify=True)
-            except Exception as exc:
-                logger.error(f"[{master}] Failed to remove VM {vm.uuid} ({vm.name()}): {exc}")
-                failures += 1
+    stages = plan_pool_cleanup(pool)
+    nb_actions = sum(len(stage) for stage in stages)
+    logger.info(
+        f"[{master}] {log_prefix} {nb_actions} VMs, snapshots and VDIs in {len(stages)} stages, "
+        f"estimated duration {estimated_duration(stages, jobs):.0f}s with {jobs} jobs"
+    )
+
+    def run(action: CleanupAction) -> bool:
+        logger.info(f"[{master}] {log_prefix} {action}")
+        if dry_run:
+            return True
+        try:
+            action.run(master)
+        except Exception as exc:
+            logger.error(f"[{master}] Failed to remove {action}: {exc}")
+            return False
+        return True
 
-    sr_uuids = local_sr_uuids(pool)
-    for sr_uuid in sr_uuids:
-        for vdi_uuid in SR(sr_uuid, pool).vdi_uuids(managed=True):
-            vdi = VDI(vdi_uuid, sr=SR(sr_uuid, pool))
-            logger.info(f"[{master}] {log_prefix} orphan VDI {vdi.uuid} from local SR {sr_uuid}")
-            if not dry_run:
-                try:
-                    vdi.destroy()
-                except Exception as exc:
-                    logger.error(f"[{master}] Failed to destroy VDI {vdi.uuid}: {exc}")
-                    failures += 1
+    failures = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for stage in stages:
+            failures += sum(not ok for ok in executor.map(run, stage))
 
     if not dry_run and failures == 0:
-        for sr_uuid in sr_uuids:
-            wait_for_not(
-                lambda: len(SR(sr_uuid, pool).vdi_uuids(managed=True)) > 0,
-                f"Wait for local SR {sr_uuid} to be empty",
-            )
+        sr_uuids = local_sr_uuids(pool)
+        wait_for_not(
+            lambda: any(sr_uuid in sr_uuids for sr_uuid in safe_split(master.xe(
+                'vdi-list', {'managed': True, 'params': 'sr-uuid'}, minimal=True
+            ))),
+            "Wait for local SRs to be empty",
+        )
     return failures
 
 def local_sr_uuids(pool: Pool) -> list[str]:
     """Return the UUIDs of the pool's local (non-shared, user) SRs."""
-    uuids = safe_split(pool.master.xe('sr-list', {'content-type': 'user'}, minimal=True))
-    return [uuid for uuid in uuids if not SR(uuid, pool).is_shared()]
+    srs = parse_xe_records(pool.master.xe('sr-list', {'content-type': 'user', 'params': 'uuid,shared'}))
+    return [sr["uuid"] for sr in srs if sr["shared"] != "true"]
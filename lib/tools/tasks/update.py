@@ -4,93 +4,97 @@ This module is intended for performing update actions on existing remote targets
 """
 from __future__ import annotations
 
-import re
+import json
+import os
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
 
 from lib.host import Host
 from lib.pool import NotAMasterHostError, Pool
 from lib.tools.inventory import HostConfig, Inventory
+from lib.tools.packages import PackageInventory
 from lib.tools.tasks.snapshot import create_snapshots
 
 from .. import logger
 
-def _capture_packages(pools: list[Pool]) -> dict[Host, set[str]]:
-    """Snapshot the installed packages of every host in the pools."""
-    return {h: set(h.packages()) for p in pools for h in p.hosts}
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from lib.rpm_cache import RpmCacheProxy
 
-def _filter_packages(pkgs: set[str]) -> set[str]:
-    return {p for p in pkgs if not p.startswith("gpg-pubkey-")}
+def _capture_packages(inventory: PackageInventory, pools: list[Pool]) -> dict[Host, int]:
+    """Snapshot the installed packages of every host in the pools."""
+    packages = inventory.collect([h for p in pools for h in p.hosts])
+    logger.debug(f"Packages of {len(packages)} hosts: {len(packages) - inventory.fetched} unchanged, "
+                 f"{len(inventory.table.nevras)} distinct packages")
+    inventory.fetched = 0
+    return packages
 
 def _format_packages(pkgs: list[str]) -> str:
     return "\n".join(f"  - {p}" for p in pkgs)
 
-def _nevra_to_nvra(nevra: str) -> str:
-    return re.sub(r'-\d+:', '-', nevra)
-
-def _downgrade_command(host: Host, pkgs: set[str]) -> str:
+def _downgrade_command(inventory: PackageInventory, pkgs: int) -> str:
     """Return a `yum downgrade` command for the given installed packages."""
-    specs = " ".join(_nevra_to_nvra(p) for p in sorted(pkgs))
-    names = host.ssh(f"rpm -q --qf '%{{NAME}} ' {specs}").split()
-    return "yum downgrade -y " + " ".join(names)
+    return "yum downgrade -y " + " ".join(inventory.table.package_names(pkgs))
 
-def _report_updated(before: dict[Host, set[str]], after: dict[Host, set[str]]) -> None:
+def _report_updated(inventory: PackageInventory, before: dict[Host, int], after: dict[Host, int]) -> None:
     """Log a summary of the packages that were updated on each host."""
-    updated = {
-        h: _filter_packages(after[h] - pkgs) for h, pkgs in before.items()
-    }
-    common_updated = set.intersection(*updated.values()) if updated else set()
+    updated = inventory.changed(before, after)
+    common_updated = inventory.common(list(updated.values()))
 
     if not common_updated:
         logger.info("No packages were updated on any host.")
         return
     logger.info(
-        f"Updated packages on all hosts ({len(common_updated)}):\n"
-        f"{_format_packages(sorted(common_updated))}"
+        f"Updated packages on all hosts ({common_updated.bit_count()}):\n"
+        f"{_format_packages(inventory.table.packages(common_updated))}"
     )
     for h, pkgs in updated.items():
-        extra = sorted(pkgs - common_updated)
+        extra = pkgs & ~common_updated
         if extra:
             logger.info(
-                f"Additional packages on [{h}] ({len(extra)}):\n"
-                f"{_format_packages(extra)}"
+                f"Additional packages on [{h}] ({extra.bit_count()}):\n"
+                f"{_format_packages(inventory.table.packages(extra))}"
             )
 
 def _check_packages_available(
+    inventory: PackageInventory,
     pools: list[Pool],
     inventory_hosts: dict[str, HostConfig],
-    packages: dict[Host, set[str]],
+    packages: dict[Host, int],
 ) -> None:
     """Warn about installed packages not available in the selected repositories."""
-    unavailable: dict[Host, set[str]] = {}
-    for p in pools:
+    def available(p: Pool) -> int:
         master_cfg = inventory_hosts[p.master.hostname_or_ip]
-        repoquery_cmd = "repoquery --all"
-        for r in master_cfg["disabled_repositories"]:
-            repoquery_cmd += f" --disablerepo={r}"
-        for r in master_cfg["repositories"]:
-            repoquery_cmd += f" --enablerepo={r}"
-        available = set(p.master.ssh(repoquery_cmd).splitlines())
-        for h in p.hosts:
-            pkgs = _filter_packages(packages[h]) - available
-            if pkgs:
-                unavailable[h] = pkgs
+        repoquery_args = [f"--disablerepo={r}" for r in master_cfg["disabled_repositories"]]
+        repoquery_args += [f"--enablerepo={r}" for r in master_cfg["repositories"]]
+        return inventory.available(p.master, " ".join(repoquery_args))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(pools))) as executor:
+        available_packages = list(executor.map(available, pools))
+    unavailable: dict[Host, int] = {}
+    for p, available_pkgs in zip(pools, available_packages):
+        unavailable.update(inventory.unavailable({h: packages[h] for h in p.hosts}, available_pkgs))
 
     if not unavailable:
         logger.info("All installed packages are available in the selected repositories.")
         return
-    common = set.intersection(*unavailable.values())
+    common = inventory.common(list(unavailable.values()))
     lines = []
-    downgrades = {h: _downgrade_command(h, pkgs) for h, pkgs in unavailable.items()}
+    downgrades = {h: _downgrade_command(inventory, pkgs) for h, pkgs in unavailable.items()}
     if common:
         lines.append(
             f"Installed packages not available in the selected repositories on all hosts "
-            f"({len(common)}):\n{_format_packages(sorted(common))}"
+            f"({common.bit_count()}):\n{_format_packages(inventory.table.packages(common))}"
         )
     for h, pkgs in unavailable.items():
-        extra = sorted(pkgs - common)
+        extra = pkgs & ~common
         if extra:
             lines.append(
-                f"Additional packages on [{h}] ({len(extra)}):\n{_format_packages(extra)}"
+                f"Additional packages on [{h}] ({extra.bit_count()}):\n"
+                f"{_format_packages(inventory.table.packages(extra))}"
             )
     common_downgrade = next(iter(downgrades.values()))
     if set(downgrades.values()) == {common_downgrade}:
@@ -100,37 +104,191 @@ def _check_packages_available(
             lines.append(f"Downgrade command on [{h}]:\n  {cmd}")
     logger.warning("\n".join(lines))
 
-def _check_consistency(packages: dict[Host, set[str]]) -> None:
+def _check_consistency(inventory: PackageInventory, packages: dict[Host, int]) -> None:
     """Warn if not all hosts end up with the same set of packages."""
-    common_set = set.intersection(*packages.values())
-    inconsistent = {
-        h: _filter_packages(p) - _filter_packages(common_set)
-        for h, p in packages.items() if _filter_packages(p) != _filter_packages(common_set)
-    }
+    inconsistent = inventory.differences(packages)
     if inconsistent:
         lines = [
             f"Not all hosts have the same set of packages "
             f"(reference: common set of {len(packages)} hosts):"
         ]
         for h, extra_pkgs in inconsistent.items():
-            lines.append(f"  [{h}] additional packages:\n{_format_packages(sorted(extra_pkgs))}")
+            lines.append(f"  [{h}] additional packages:\n{_format_packages(inventory.table.packages(extra_pkgs))}")
         logger.warning("\n".join(lines))
 
-def update_pools(inventory: Inventory, reboot: bool = True, parallel: bool = False) -> None:
+class UpdateProgress:
+    """Progress of a rolling update.
+
+    When a path is given, the progress is saved to this JSON file after each step, and loaded from it if it exists,
+    so that an interrupted update resumes where it stopped: hosts already updated are skipped, and hosts whose
+    packages were updated but which were not rebooted yet are rebooted.
+    """
+    PENDING = "pending"
+    # packages updated, reboot still needed
+    UPDATED = "updated"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hosts: dict[str, dict[str, Any]] = {}
+        if path is not None and path.exists():
+            with open(path) as f:
+                self.hosts = json.load(f)
+            done = [h for h, info in self.hosts.items() if info["state"] == self.DONE]
+            logger.info(f"Resuming update from {path}, {len(done)} host(s) already updated")
+
+    def state(self, host: Host) -> str:
+        return self.hosts.get(host.hostname_or_ip, {}).get("state", self.PENDING)
+
+    def needs_reboot(self, host: Host) -> bool:
+        return self.hosts.get(host.hostname_or_ip, {}).get("reboot", False)
+
+    def set(self, host: Host, state: str, **info: Any) -> None:
+        with self.lock:
+            entry = self.hosts.setdefault(host.hostname_or_ip, {})
+            entry.update(info, state=state, time=datetime.now().isoformat(timespec="seconds"))
+            if self.path is not None:
+                tmp = self.path.with_name(f".{self.path.name}.tmp")
+                with open(tmp, "w") as f:
+                    json.dump(self.hosts, f, indent=2)
+                os.replace(tmp, self.path)
+
+    def report(self, pools: list[Pool]) -> None:
+        """Log the state of each host."""
+        lines = []
+        for p in pools:
+            lines.append(f"Pool [{p.master}]:")
+            for h in p.hosts:
+                entry = self.hosts.get(h.hostname_or_ip, {})
+                error = f": {entry['error']}" if "error" in entry else ""
+                lines.append(f"  [{h}] {self.state(h)}{error}")
+        logger.info("Update progress:\n" + "\n".join(lines))
+
+def _update_host_packages(host: Host, config: HostConfig, progress: UpdateProgress, reboot: bool) -> bool:
+    """Update the packages of a host, without rebooting it. Return whether it must be rebooted."""
+    try:
+        host.yum_clean_metadata()
+        output = host.yum_update(enablerepos=config["repositories"], disablerepos=config["disabled_repositories"])
+        # a previous, interrupted, run may have updated the packages without rebooting
+        needs_reboot = reboot and ("No packages marked for update" not in output or progress.needs_reboot(host))
+    except Exception as exc:
+        progress.set(host, UpdateProgress.FAILED, error=str(exc))
+        raise
+    progress.set(host, UpdateProgress.UPDATED, reboot=needs_reboot)
+    if reboot and not needs_reboot:
+        logger.info(f"[{host}] No packages updated, skipping reboot")
+    return needs_reboot
+
+def _evacuate_host(pool: Pool, host: Host, progress: UpdateProgress) -> None:
+    """Move the VMs running on the host to the other hosts of the pool."""
+    logger.info(f"[{host}] Evacuating host")
+    try:
+        pool.master.xe("host-evacuate", {"host": host.uuid})
+    except Exception as exc:
+        progress.set(host, UpdateProgress.FAILED, error=str(exc))
+        raise
+
+def _reboot_host(host: Host, progress: UpdateProgress) -> None:
+    try:
+        # a rebooted host is enabled again by XAPI
+        host.reboot(verify=True)
+    except Exception as exc:
+        progress.set(host, UpdateProgress.FAILED, error=str(exc))
+        raise
+    progress.set(host, UpdateProgress.DONE, reboot=False)
+
+def _rolling_update_pool(
+    pool: Pool,
+    config: HostConfig,
+    progress: UpdateProgress,
+    reboot: bool,
+    evacuate: bool,
+    max_unavailable: int | None,
+) -> None:
+    """Update the master host of the pool, then its other hosts, at most `max_unavailable` at a time.
+
+    Hosts of a batch are disabled, so that no VM is moved to them, then evacuated before being rebooted.
+    With `max_unavailable=None`, all the hosts of the pool, including the master, are updated at the same time.
+    """
+    if max_unavailable is None:
+        batches = [pool.hosts]
+    else:
+        secondaries = pool.hosts[1:]
+        batches = [[pool.master]]
+        batches += [secondaries[i:i + max_unavailable] for i in range(0, len(secondaries), max_unavailable)]
+    for n, batch in enumerate(batches):
+        hosts = [h for h in batch if progress.state(h) != UpdateProgress.DONE]
+        if not hosts:
+            continue
+        logger.info(f"[{pool.master}] Updating batch {n + 1}/{len(batches)}: {', '.join(str(h) for h in hosts)}")
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            needs_reboot = list(executor.map(lambda h: _update_host_packages(h, config, progress, reboot), hosts))
+        to_reboot = [h for h, r in zip(hosts, needs_reboot) if r]
+
+        if to_reboot and evacuate:
+            if len(to_reboot) == len(pool.hosts):
+                logger.warning(f"[{pool.master}] No host left to evacuate VMs to, rebooting without evacuation")
+            else:
+                try:
+                    for h in to_reboot:
+                        pool.master.xe("host-disable", {"host": h.uuid})
+                    for h in to_reboot:
+                        _evacuate_host(pool, h, progress)
+                except Exception:
+                    # don't leave the hosts disabled, as they won't be rebooted
+                    for h in to_reboot:
+                        pool.master.xe("host-enable", {"host": h.uuid}, check=False)
+                    raise
+        with ThreadPoolExecutor(max_workers=max(1, len(to_reboot))) as executor:
+            list(executor.map(lambda h: _reboot_host(h, progress), to_reboot))
+
+        for h in hosts:
+            if h not in to_reboot:
+                progress.set(h, UpdateProgress.DONE, reboot=False)
+            logger.info(f"[{h}] Updated successfully!")
+
+def update_pools(
+    inventory: Inventory,
+    reboot: bool = True,
+    parallel: bool = False,
+    evacuate: bool = True,
+    max_unavailable: int = 1,
+    state_file: Path | None = None,
+    rpm_cache: RpmCacheProxy | None = None,
+    package_cache: Path | None = None,
+) -> int:
     """Updates hosts in pool(s).
 
     .. note::
 
         Every non-master hosts in inventory will be ignored
 
-    *Update each pool's master host declared in inventory first, then, update other hosts for each pool.*
+    *Pools are updated at the same time. In each pool, the master host declared in inventory is updated first, then
+    the other hosts, by batches of at most `max_unavailable` hosts. Before being rebooted, hosts are evacuated, so
+    that the VMs of the pool keep running. If a host fails to update, the update of its pool stops, but the other
+    pools are still updated.*
 
     :param dict inventory:
         Each host (key) holds its own config data (values, eg: `enablerepos`).
     :param bool reboot:
         Choose to reboot or not after update (default: True).
     :param bool parallel:
-        Update the master and secondary hosts at the same time (default: False).
+        Update all the hosts of a pool at the same time, without evacuation (default: False).
+    :param bool evacuate:
+        Migrate the VMs of each host to other hosts of its pool before rebooting it (default: True).
+    :param int max_unavailable:
+        Maximum number of secondary hosts of a pool to update at the same time (default: 1).
+    :param Path state_file:
+        Record the progress of the update in this file, and resume the update from it if it exists (default: None).
+    :param RpmCacheProxy rpm_cache:
+        Make the hosts download packages through this caching proxy during the update (default: None).
+    :param Path package_cache:
+        Keep the lists of installed packages of the hosts in this directory between runs, so that they are only
+        fetched again from the hosts whose packages changed (default: None).
+    :return:
+        The number of pools that failed to update.
     """
     logger.debug(f"Inventory: {inventory}")
     inventory_hosts = inventory["hosts"]
@@ -150,67 +308,63 @@ def update_pools(inventory: Inventory, reboot: bool = True, parallel: bool = Fal
         except NotAMasterHostError:
             logger.warning(f"[{host}] Skipping: not a master host")
 
-    before_packages = _capture_packages(pools)
-
-    # update master hosts
-    with ThreadPoolExecutor() as executor:
-        future_hosts = {executor.submit(
-            p.master.update,
-            inventory_hosts[p.master.hostname_or_ip]["repositories"],
-            disablerepos=inventory_hosts[p.master.hostname_or_ip]["disabled_repositories"],
-            reboot=reboot,
-        ): p.master for p in pools}
-        if parallel:
-            # update other hosts at the same time as the master hosts
-            for p in pools:
-                # omit first item because it is the pool's master
-                for h in p.hosts[1:]:
-                    # repos are the same as for the master host
-                    repos = inventory_hosts[p.master.hostname_or_ip]["repositories"]
-                    disablerepos = inventory_hosts[p.master.hostname_or_ip]["disabled_repositories"]
-                    future_hosts[executor.submit(h.update, repos, disablerepos=disablerepos, reboot=reboot)] = h
-        for future in as_completed(future_hosts):
-            updated_host = future_hosts[future]
-            try:
-                future.result()
-            except Exception as exc:
-                logger.error(f"Updating pool has failed! The host {updated_host} cannot be updated.")
-                logger.info(
-                    "*** Due to previous error, the pool updating task will stop. "
-                    "Waiting for running updates to finish if any. ***"
-                )
-                raise exc
-
-    if not parallel:
-        # update other hosts
-        with ThreadPoolExecutor() as executor:
-            future_other_hosts = {}
+    progress = UpdateProgress(state_file)
+    packages = PackageInventory(package_cache)
+    before_packages = _capture_packages(packages, pools)
+    if rpm_cache is not None:
+        for p in pools:
+            for h in p.hosts:
+                rpm_cache.configure(h)
+
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(pools))) as executor:
+            future_pools = {}
             for p in pools:
-                # omit first item because it is the pool's master
-                for h in p.hosts[1:]:
-                    # repos are the same as for the master host
-                    repos = inventory_hosts[p.master.hostname_or_ip]["repositories"]
-                    disablerepos = inventory_hosts[p.master.hostname_or_ip]["disabled_repositories"]
-                    future_other_hosts[executor.submit(h.update, repos, disablerepos=disablerepos, reboot=reboot)] = h
-            for future in as_completed(future_other_hosts):
-                other_host = future_other_hosts[future]
+                # repos are the same as for the master host
+                config = inventory_hosts[p.master.hostname_or_ip]
+                if parallel:
+                    future = executor.submit(_rolling_update_pool, p, config, progress, reboot, False, None)
+                else:
+                    future = executor.submit(
+                        _rolling_update_pool, p, config, progress, reboot, evacuate, max_unavailable
+                    )
+                future_pools[future] = p
+            for future in as_completed(future_pools):
+                pool = future_pools[future]
                 try:
                     future.result()
                 except Exception as exc:
-                    logger.error(f"Updating pool has failed! The host {other_host} cannot be updated.")
+                    failures += 1
+                    logger.error(f"Updating pool [{pool.master}] has failed: {exc}")
                     logger.info(
-                        "*** Due to previous error, the pool updating task will stop. "
-                        "Waiting for running updates to finish if any. ***"
+                        "*** Due to previous error, the update of this pool stopped. "
+                        "Other pools are still being updated. ***"
                     )
-                    raise exc
+    finally:
+        if rpm_cache is not None:
+            for p in pools:
+                for h in p.hosts:
+                    rpm_cache.unconfigure(h)
+            logger.info(f"RPM cache: {rpm_cache.stats}")
+    progress.report(pools)
+    if failures:
+        if state_file is not None:
+            logger.info(f"Run the same command again to resume the update from {state_file}")
+        return failures
 
-    after_packages = _capture_packages(pools)
-    _report_updated(before_packages, after_packages)
-    _check_consistency(after_packages)
-    _check_packages_available(pools, inventory_hosts, after_packages)
+    after_packages = _capture_packages(packages, pools)
+    _report_updated(packages, before_packages, after_packages)
+    _check_consistency(packages, after_packages)
+    _check_packages_available(packages, pools, inventory_hosts, after_packages)
 
     # Snapshot creation
     for hosting_pool, nested in nested_hosts.items():
         pool = Pool(hosting_pool) # mandatory for getting an host instance
         vm_uuids = [h.get_system_uuid() for h in nested]
         create_snapshots(pool.master, vm_uuids)
+
+    if state_file is not None:
+        # the update is complete, the next one must start from scratch
+        state_file.unlink(missing_ok=True)
+    return 0
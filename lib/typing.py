@@ -12,6 +12,7 @@ IsoImageDef = TypedDict('IsoImageDef',
                          'net-url': NotRequired[str],
                          'net-only': NotRequired[bool],
                          'unsigned': NotRequired[bool],
+                         'sha256': NotRequired[str],
                          })
 
 JSONType = None | bool | int | float | str | list["JSONType"] | dict[str, "JSONType"]
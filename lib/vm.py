@@ -1,13 +1,15 @@
 from __future__ import annotations
 
-import pytest
-
 import logging
 import os
 import re
+import shlex
+import shutil
 import subprocess
+import tarfile
 import tempfile
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import lib.commands as commands
 import lib.efi as efi
@@ -29,7 +31,7 @@ from lib.vbd import VBD
 from lib.vdi import VDI
 from lib.vif import VIF
 
-from typing import TYPE_CHECKING, Iterable, List, Literal, assert_never, overload
+from typing import TYPE_CHECKING, Iterable, List, Literal, Mapping, assert_never, overload
 
 if TYPE_CHECKING:
     from lib.host import Host
@@ -371,6 +373,7 @@ class VM(BaseVM):
                 self.vdis.remove(vdi)
                 vdi.destroy()
                 return
+        import pytest
         raise pytest.fail(f"No VDI named '{name}' in vm {self.uuid}")
 
     def create_vdis_list(self) -> None:
@@ -600,37 +603,63 @@ class VM(BaseVM):
             self.host.xe('message-destroy', {'uuid': msg})
 
     def sign_efi_bins(self, db: efi.EFIAuth) -> None:
+        """
+        Sign all the EFI binaries found in /boot.
+
+        The EFI binaries are found remotely and fetched in a single archive, signed locally in parallel, then
+        the signed binaries are pushed back in a single archive. Binaries already signed by `db` are skipped.
+        """
+        candidates = self.get_all_efi_bins()
+        if not candidates:
+            logging.info("No EFI binary to sign")
+            return
+        remote_archive = f'/tmp/efi-bins-{uuid.uuid4()}.tar'
+        remote_staging = f'/tmp/efi-bins-{uuid.uuid4()}'
         with tempfile.TemporaryDirectory() as directory:
-            for remote_bin in self.get_all_efi_bins():
-                local_bin = os.path.join(directory, os.path.basename(remote_bin))
-                self.scp(remote_bin, local_bin, local_dest=True)
-                signed = db.sign_image(local_bin)
-                self.scp(signed, remote_bin)
+            local_archive = os.path.join(directory, 'boot.tar')
+            try:
+                paths = ' '.join(shlex.quote(path.lstrip('/')) for path in candidates)
+                self.ssh(f'tar -C / -cf {remote_archive} {paths}')
+                self.scp(remote_archive, local_archive, local_dest=True)
+
+                binaries: List[tuple[str, str]] = []
+                with tarfile.open(local_archive) as tar:
+                    for member in tar:
+                        if not member.isfile() or member.name.startswith('/') or '..' in member.name.split('/'):
+                            continue
+                        local_bin = os.path.join(directory, member.name)
+                        os.makedirs(os.path.dirname(local_bin), exist_ok=True)
+                        with tar.extractfile(member) as src, open(local_bin, 'wb') as dst:  # type: ignore[union-attr]
+                            shutil.copyfileobj(src, dst)
+                        if not db.has_signed_image(local_bin):
+                            binaries.append((member.name, local_bin))
+
+                if not binaries:
+                    logging.info("No EFI binary to sign")
+                    return
+
+                # Signing tools run as separate processes, so threads are enough to sign in parallel
+                with ThreadPoolExecutor() as executor:
+                    signed_bins = list(executor.map(db.sign_image, [local_bin for _, local_bin in binaries]))
+
+                with tarfile.open(local_archive, 'w') as tar:
+                    for (name, _), signed in zip(binaries, signed_bins):
+                        logging.debug(f"Signed EFI binary: /{name}")
+                        tar.add(signed, arcname=name)
+                self.scp(local_archive, remote_archive)
+                # Write the signed binaries over the existing files rather than extracting them in place, as
+                # tar would try to set owners and modes, which fails on the FAT filesystem of the ESP
+                self.ssh(
+                    f'mkdir {remote_staging} && tar -C {remote_staging} -xf {remote_archive} && '
+                    f'cd {remote_staging} && find . -type f -exec sh -c \'cat "$1" > "/$1"\' sh {{}} \\;'
+                )
+            finally:
+                self.ssh(f'rm -rf {remote_archive} {remote_staging}', check=False)
 
     def set_efi_var(self, var: str, guid: efi.GUID, attrs: bytes, data: bytes) -> None:
         """Sets the data and attrs for an EFI variable and GUID."""
         assert len(attrs) == 4
-
-        efivarfs = '/sys/firmware/efi/efivars/%s-%s' % (var, guid.as_str())
-        tmp_efivarfs = '/tmp/%s-%s' % (var, guid.as_str())
-
-        if self.file_exists(efivarfs):
-            self.ssh(f'chattr -i {efivarfs}')
-
-        try:
-            with tempfile.NamedTemporaryFile('wb') as f:
-                f.write(attrs)
-                f.write(data)
-                f.flush()
-
-                # Copy the key in 2 steps because the sftp protocol now used by
-                # scp is not able to write directly to efivarfs. Also use 'cat'
-                # instead of 'cp' since it doesn't work in Alpine image (because
-                # cp is busybox in Alpine)
-                self.scp(f.name, tmp_efivarfs)
-                self.ssh(f'cat {tmp_efivarfs} > {efivarfs}')
-        finally:
-            self.ssh(f'rm -f {tmp_efivarfs}', check=False)
+        self.set_efi_vars({(var, guid): efi.EfiVariable(attrs, data)})
 
     def get_efi_var(self, var: str, guid: efi.GUID) -> bytes:
         """Returns a 2-tuple of (attrs, data) for an EFI variable."""
@@ -644,6 +673,23 @@ class VM(BaseVM):
         # The efivarfs file starts with the attributes, which are 4 bytes long
         return data[4:]
 
+    def get_efi_vars(self) -> efi.EfiVariables:
+        """Return all the EFI variables of the VM, as seen from its efivarfs, in one call."""
+        return efi.parse_efivarfs_dump(self.ssh(efi.efivarfs_dump_cmd()))
+
+    def set_efi_vars(self, changes: Mapping[tuple[str, efi.GUID], efi.EfiVariable | None]) -> None:
+        """
+        Set several EFI variables in one remote transaction.
+
+        Variables mapped to None are deleted. Changes are applied in order, stopping at the first failure.
+        """
+        remote_archive = f'/tmp/efivars-{uuid.uuid4()}.tar'
+        with tempfile.TemporaryDirectory() as directory:
+            archive = os.path.join(directory, 'efivars.tar')
+            script = efi.write_efivarfs_changes(changes, archive, remote_archive)
+            self.scp(archive, remote_archive)
+        self.ssh(script)
+
     def clear_uefi_variables(self) -> None:
         """
         Remove all UEFI variables.
@@ -656,21 +702,12 @@ class VM(BaseVM):
         self.param_remove('NVRAM', 'EFI-variables')
 
     def get_all_efi_bins(self) -> List[str]:
-        magicsz = str(len(efi.EFI_HEADER_MAGIC))
-        files = self.ssh(
-            f'for file in $(find /boot -type f); do echo $file $(head -c {magicsz} $file); done', decode=False
-        ).split(b'\n')
-
-        magic = efi.EFI_HEADER_MAGIC.encode('ascii')
-        binaries: List[str] = []
-        for f in files:
-            if magic in f:
-                # Avoid decoding an unsplit f, as some headers are not utf8
-                # decodable
-                fpath = f.split()[0].decode('ascii')
-                binaries.append(fpath)
-
-        return binaries
+        """ Paths of the files in /boot starting with the PE magic of EFI binaries. """
+        magic = efi.EFI_HEADER_MAGIC
+        # NUL bytes are dropped before comparing, as shells can't hold them in variables
+        script = (f'for f; do if [ "$(head -c {len(magic)} "$f" | tr -d \'\\000\')" = {magic} ]; '
+                  'then echo "$f"; fi; done')
+        return self.ssh(f'find /boot -type f -exec sh -c {shlex.quote(script)} sh {{}} +').splitlines()
 
     def get_vtpm_uuid(self) -> str:
         return self.host.xe('vtpm-list', {'vm-uuid': self.uuid}, minimal=True)
@@ -1,10 +1,338 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import itertools
 import json
+import logging
+import os
+import socket
+import ssl
+import struct
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlparse
 
-from data import TOOLS
-from lib.commands import local_cmd
+from lib.commands import count_remote_call, local_cmd
+from lib.common import wait_for
 from lib.typing import JSONType
 
-from typing import Literal, overload
+from typing import Any, Literal, overload
+
+# Timeout of XO API calls, in seconds
+XO_CALL_TIMEOUT = 5 * 60
+
+class XoError(Exception):
+    """ Error returned by XO-server for an API call, or loss of the connection to it. """
+    def __init__(self, message: str, code: int | None = None, data: JSONType = None):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+class _WebSocket:
+    """
+    Minimal WebSocket client (RFC 6455): text messages, fragmentation, ping/pong and close.
+
+    Enough for JSON-RPC with XO-server, without depending on a WebSocket library.
+    """
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    def __init__(self, url: str, *, verify: bool = True, timeout: float = 30):
+        parsed = urlparse(url)
+        assert parsed.scheme in ("ws", "wss"), f"not a WebSocket URL: {url}"
+        assert parsed.hostname is not None
+        port = parsed.port or (443 if parsed.scheme == "wss" else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=timeout)
+        if parsed.scheme == "wss":
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=parsed.hostname)
+        self._sock = sock
+        self._rfile = sock.makefile("rb")
+        self._send_lock = threading.Lock()
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall((f"GET {parsed.path or '/'} HTTP/1.1\r\n"
+                      f"Host: {parsed.netloc}\r\n"
+                      "Upgrade: websocket\r\n"
+                      "Connection: Upgrade\r\n"
+                      f"Sec-WebSocket-Key: {key}\r\n"
+                      "Sec-WebSocket-Version: 13\r\n"
+                      "\r\n").encode())
+        status = self._rfile.readline().decode(errors="replace").strip()
+        headers = {}
+        while (line := self._rfile.readline().decode(errors="replace").strip()):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if status.split(" ")[1:2] != ["101"]:
+            raise XoError(f"WebSocket handshake with {url} failed: {status}")
+        accept = base64.b64encode(hashlib.sha1((key + self.GUID).encode()).digest()).decode()
+        if headers.get("sec-websocket-accept") != accept:
+            raise XoError(f"WebSocket handshake with {url} failed: invalid Sec-WebSocket-Accept")
+        # from now on, reads block until a message arrives
+        sock.settimeout(None)
+
+    def _send_frame(self, opcode: int, payload: bytes) -> None:
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack("!H", length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+        # client frames must be masked
+        mask = os.urandom(4)
+        repeated = (mask * (length // 4 + 1))[:length]
+        masked = (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(length, "big")
+        with self._send_lock:
+            self._sock.sendall(header + mask + masked)
+
+    def send(self, text: str) -> None:
+        self._send_frame(self.OP_TEXT, text.encode())
+
+    def _read_exact(self, size: int) -> bytes:
+        data = self._rfile.read(size)
+        if len(data) < size:
+            raise EOFError("WebSocket connection closed")
+        return data
+
+    def recv(self) -> str | None:
+        """ Return the next text message, or None when the connection is closed. """
+        message = b""
+        while True:
+            try:
+                first, second = self._read_exact(2)
+                length = second & 0x7F
+                if length == 126:
+                    length, = struct.unpack("!H", self._read_exact(2))
+                elif length == 127:
+                    length, = struct.unpack("!Q", self._read_exact(8))
+                mask = self._read_exact(4) if second & 0x80 else None
+                payload = self._read_exact(length)
+            except (EOFError, OSError):
+                return None
+            if mask is not None:
+                repeated = (mask * (length // 4 + 1))[:length]
+                payload = (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(length, "big")
+
+            opcode = first & 0x0F
+            if opcode == self.OP_PING:
+                self._send_frame(self.OP_PONG, payload)
+            elif opcode == self.OP_CLOSE:
+                try:
+                    self._send_frame(self.OP_CLOSE, payload[:2])
+                except OSError:
+                    pass
+                return None
+            elif opcode in (self.OP_TEXT, self.OP_BINARY, self.OP_CONTINUATION):
+                message += payload
+                if first & 0x80:
+                    return message.decode()
+
+    def close(self) -> None:
+        try:
+            self._send_frame(self.OP_CLOSE, struct.pack("!H", 1000))
+        except OSError:
+            pass
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+class XoClient:
+    """
+    JSON-RPC client keeping one authenticated WebSocket session to XO-server.
+
+    Calls can be made from any thread and are multiplexed on the connection. `batch()` sends several
+    calls at once and waits for all the results, for the cost of a single round-trip. Once `watch_objects()`
+    was called, the client keeps an index of XO objects up to date from the `all` notifications of
+    XO-server, so that waiting for an object does not need any call.
+    """
+
+    def __init__(self, url: str, token: str, *, verify: bool = True):
+        parsed = urlparse(url)
+        scheme = {"http": "ws", "https": "wss"}.get(parsed.scheme, parsed.scheme)
+        self.url = parsed._replace(scheme=scheme, path=parsed.path.rstrip("/") + "/api/").geturl()
+        self._ws = _WebSocket(self.url, verify=verify)
+        self._ids = itertools.count(1)
+        self._pending: dict[int, Future[JSONType]] = {}
+        self._lock = threading.Lock()
+        self.closed = False
+        # XO object id -> uuid, None until watch_objects() is called
+        self._objects: dict[str, str] | None = None
+        self._buffered_events: list[dict[str, Any]] = []
+        self._objects_cond = threading.Condition()
+        self._reader = threading.Thread(target=self._read_loop, name="xo-client", daemon=True)
+        self._reader.start()
+        self.call("session.signIn", {"token": token})
+
+    def _read_loop(self) -> None:
+        while (text := self._ws.recv()) is not None:
+            try:
+                messages = json.loads(text)
+            except ValueError:
+                logging.warning("Invalid JSON-RPC message from XO: %r", text[:200])
+                continue
+            for message in messages if isinstance(messages, list) else [messages]:
+                self._dispatch(message)
+
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(XoError(f"connection to {self.url} closed"))
+        with self._objects_cond:
+            self._objects_cond.notify_all()
+
+    def _dispatch(self, message: dict[str, Any]) -> None:
+        if "id" in message and ("result" in message or "error" in message):
+            with self._lock:
+                future = self._pending.pop(message["id"], None)
+            if future is None:
+                return
+            error = message.get("error")
+            if error is not None:
+                future.set_exception(XoError(error.get("message", str(error)), error.get("code"), error.get("data")))
+            else:
+                future.set_result(message.get("result"))
+        elif message.get("method") == "all":
+            with self._objects_cond:
+                if self._objects is None:
+                    self._buffered_events.append(message["params"])
+                else:
+                    self._apply_event(message["params"])
+
+    def _apply_event(self, event: dict[str, Any]) -> None:
+        assert self._objects is not None
+        for object_id, obj in event["items"].items():
+            if event["type"] == "exit":
+                self._objects.pop(object_id, None)
+            elif isinstance(obj, dict):
+                self._objects[object_id] = str(obj.get("uuid", object_id))
+        self._objects_cond.notify_all()
+
+    def _send(self, method: str, params: dict[str, JSONType]) -> Future[JSONType]:
+        request_id = next(self._ids)
+        future: Future[JSONType] = Future()
+        with self._lock:
+            if self.closed:
+                raise XoError(f"connection to {self.url} closed")
+            self._pending[request_id] = future
+        logging.debug("[xo] %s %s", method, params)
+        try:
+            self._ws.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}))
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise XoError(f"connection to {self.url} lost: {e}")
+        return future
+
+    def call(self, method: str, params: dict[str, JSONType] = {}, *, timeout: float = XO_CALL_TIMEOUT) -> JSONType:
+        return self._send(method, params).result(timeout)
+
+    def batch(self, calls: list[tuple[str, dict[str, JSONType]]], *,
+              timeout: float = XO_CALL_TIMEOUT) -> list[JSONType | XoError]:
+        """ Send all the calls before waiting for their results, which are returned in order, errors included. """
+        futures = [self._send(method, params) for method, params in calls]
+        results: list[JSONType | XoError] = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout))
+            except XoError as e:
+                results.append(e)
+        return results
+
+    def watch_objects(self) -> None:
+        """ Start indexing XO objects, if not done yet. """
+        with self._objects_cond:
+            if self._objects is not None:
+                return
+        objects = self.call("xo.getAllObjects")
+        assert isinstance(objects, dict)
+        with self._objects_cond:
+            self._objects = {
+                object_id: str(obj.get("uuid", object_id)) if isinstance(obj, dict) else object_id
+                for object_id, obj in objects.items()
+            }
+            # changes that happened while the objects were being fetched
+            for event in self._buffered_events:
+                self._apply_event(event)
+            self._buffered_events = []
+
+    def object_exists(self, uuid: str) -> bool:
+        self.watch_objects()
+        with self._objects_cond:
+            assert self._objects is not None
+            return uuid in self._objects or uuid in self._objects.values()
+
+    def wait_for_object(self, uuid: str, timeout_secs: float) -> None:
+        self.watch_objects()
+        with self._objects_cond:
+            if not self._objects_cond.wait_for(lambda: self.closed or self.object_exists(uuid), timeout_secs):
+                raise TimeoutError(f"Timeout reached while waiting for XO object {uuid} ({timeout_secs})")
+        if self.closed and not self.object_exists(uuid):
+            raise XoError(f"connection to {self.url} closed while waiting for XO object {uuid}")
+
+    def close(self) -> None:
+        self._ws.close()
+        self._reader.join()
+
+_client: XoClient | None = None
+_client_lock = threading.Lock()
+
+def _xo_cli_config() -> dict[str, Any] | None:
+    """ The registration of xo-cli (`xo-cli register`), which holds the XO-server URL and an auth token. """
+    config_home = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+    try:
+        with open(os.path.join(config_home, "xo-cli", "config.json")) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not config.get("server") or not config.get("token"):
+        return None
+    return config
+
+def _xo_cli_tool() -> str | None:
+    """ The xo-cli command configured in `TOOLS` of data.py, if any. """
+    try:
+        from data import TOOLS  # import here to avoid depending on this user file for using the XO client
+    except ImportError:
+        return None
+    return TOOLS.get('xo-cli')
+
+def xo_client() -> XoClient | None:
+    """
+    Return the shared client to the XO-server xo-cli is registered to, (re)connecting if needed.
+
+    None if xo-cli is not registered, or if an xo-cli command is configured in `TOOLS`: `xo_cli()` then runs xo-cli
+    itself, so that a wrapper or a specific xo-cli version set by the user keeps being used.
+    """
+    global _client
+    with _client_lock:
+        if _client is None or _client.closed:
+            if _xo_cli_tool() is not None:
+                return None
+            config = _xo_cli_config()
+            if config is None:
+                return None
+            logging.debug("[xo] connecting to %s", config["server"])
+            _client = XoClient(config["server"], config["token"], verify=not config.get("allowUnauthorized", False))
+        return _client
+
+def _xo_cli_params(args: dict[str, str]) -> dict[str, JSONType]:
+    # like xo-cli, values are strings unless prefixed with "json:"
+    return {key: json.loads(value[5:]) if value.startswith("json:") else value for key, value in args.items()}
 
 @overload
 def xo_cli(action: str, args: dict[str, str] = {}, *, check: bool = True, use_json: Literal[False] = False) -> str:
@@ -14,7 +342,36 @@ def xo_cli(action: str, args: dict[str, str] = {}, *, check: bool = True, use_js
     ...
 
 def xo_cli(action: str, args: dict[str, str] = {}, *, check: bool = True, use_json: bool = False) -> JSONType | str:
-    cmd = [TOOLS.get('xo-cli', 'xo-cli'), action]
+    count_remote_call()
+    try:
+        client = xo_client()
+    except (XoError, OSError) as e:
+        # nothing was sent yet: xo-cli can run the action instead
+        logging.debug("[xo] could not connect to XO-server (%s), running xo-cli", e)
+        client = None
+    if client is None:
+        return _xo_cli_subprocess(action, args, check=check, use_json=use_json)
+
+    try:
+        if action == "list-objects":
+            objects = client.call("xo.getAllObjects", {"filter": _xo_cli_params(args)})
+            assert isinstance(objects, dict)
+            result: JSONType = list(objects.values())
+        else:
+            result = client.call(action, _xo_cli_params(args))
+    except (XoError, OSError) as e:
+        if check:
+            raise
+        # the action may have run before the failure: it must not run again. Like with xo-cli, the output of the
+        # failed call is its error message, which is not JSON
+        return None if use_json else str(e)
+
+    if use_json:
+        return result
+    return result if isinstance(result, str) else json.dumps(result)
+
+def _xo_cli_subprocess(action: str, args: dict[str, str], *, check: bool, use_json: bool) -> JSONType | str:
+    cmd = [_xo_cli_tool() or 'xo-cli', action]
     if use_json:
         cmd += ['--json']
     cmd += ["%s=%s" % (key, value) for key, value in args.items()]
@@ -27,6 +384,18 @@ def xo_cli(action: str, args: dict[str, str] = {}, *, check: bool = True, use_js
     return res.stdout
 
 def xo_object_exists(uuid: str) -> bool:
+    client = xo_client()
+    if client is not None:
+        return client.object_exists(uuid)
     lst = xo_cli('list-objects', {'uuid': uuid}, use_json=True)
     assert isinstance(lst, list)
     return len(lst) > 0
+
+def wait_for_xo_object(uuid: str, msg: str | None = None, timeout_secs: float = 2 * 60) -> None:
+    if msg is not None:
+        logging.info(msg)
+    client = xo_client()
+    if client is None:
+        wait_for(lambda: xo_object_exists(uuid), timeout_secs=int(timeout_secs))
+        return
+    client.wait_for_object(uuid, timeout_secs)
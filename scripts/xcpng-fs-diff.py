@@ -37,17 +37,34 @@
 #   }
 # }
 #
+# Reference snapshots are saved gzip compressed, along with the metadata of each path. When a host is
+# collected again with its previous snapshot, only the files whose metadata changed are hashed again.
+#
+# {
+#   "host": "10.0.0.1",
+#   "data": { <data structure above> },
+#   "metadata": {
+#       "/usr/tmp": "10:1714052424.3071180320:777:1311",  <size>:<mtime>:<mode>:<inode>
+#       ...
+#   }
+# }
+#
 
 import argparse
+import gzip
+import io
 import json
 import os
+import re
 import shlex
+import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from enum import StrEnum, auto
 from fnmatch import fnmatch
-from subprocess import CompletedProcess
 
 from typing import Any, cast
 
@@ -61,138 +78,201 @@ class DataType(StrEnum):
 def ignore_file(filename: str, ignored_files: list[str]) -> bool:
     return any(fnmatch(filename, i) for i in ignored_files)
 
-def ssh_cmd(host: str, cmd: str) -> str:
+def ssh_cmd(host: str, cmd: str, input: str | None = None) -> str:
     args = ["ssh", f"root@{host}", cmd]
 
-    cmdres = subprocess.run(args, capture_output=True, text=True)
+    cmdres = subprocess.run(args, input=input, capture_output=True, text=True)
     if cmdres.returncode:
         raise Exception(cmdres.stderr)
 
     return cmdres.stdout
 
-def ssh_get_files(host: str, file_type: DataType, folders: list[str]) -> dict[str, str] | None:
-    md5sum = False
-    readlink = False
-    folders_concatenated = " ".join(folders)
-
-    match file_type:
-        case DataType.FILE:
-            find_type = "-type f"
-            md5sum = True
-        case DataType.FILE_SYMLINK:
-            find_type = "-type l -xtype f"
-            md5sum = True
-        case DataType.DIR_SYMLINK:
-            find_type = "-type l -xtype d"
-            readlink = True
-        case DataType.BROKEN_SYMLINK:
-            find_type = "-xtype l"
-            readlink = True
-        case _:
-            print("Unknown file type: ", file=sys.stderr)
-            return None
-
-    find_cmd = f"find {folders_concatenated} {find_type}"
-    if readlink:
-        find_cmd += " -exec readlink -n {} \\; -exec echo -n '  ' \\; -print"
-    elif md5sum:
-        # This will make one call to md5sum with all files passed as parameter
-        # This is much more efficient than using find '-exec md5sum {}'
-        find_cmd += " -print0 | xargs -0 md5sum"
-
-    rawres = ssh_cmd(host, find_cmd)
-
-    res: dict[str, str] = dict()
-    for line in rawres.splitlines():
-        entry = line.split(' ', 1)
-        res[entry[1].strip()] = entry[0].strip()
-
-    return res
-
-def ssh_get_packages(host: str) -> dict[str, str]:
-    packages = dict()
-
-    res = ssh_cmd(host, "rpm -qa --queryformat '%{NAME} %{VERSION}\n'")
-    for line in res.splitlines():
-        entries = line.split(' ', 1)
-        packages[entries[0]] = entries[1]
-
-    return packages
-
-def get_data(host: str, folders: list[str]) -> dict[DataType, dict[str, str] | None]:
-    ref_data: dict[DataType, dict[str, str] | None] = dict()
+# Single remote program collecting all the data of a host: the tree is walked once by find, which classifies
+# every entry and lists the files to hash, files are then hashed by parallel md5sum workers (each writing its own
+# output file so that lines never interleave), while rpm runs in the background.
+# Regular files whose '<metadata> <path>' record is given on stdin are unchanged since the previous snapshot
+# and are not hashed again. Symlinks are always hashed as their metadata doesn't follow the target.
+# The output is a stream of NUL-delimited records, in 3 sections separated by an empty record:
+# - entries: '<type><type followed>', '<path>', '<symlink target>', '<metadata>' (find %y%Y, %p, %l, %s:%T@:%m:%i)
+# - packages: '<name> <version>'
+# - md5sum lines: '<md5>  <path>'
+COLLECTOR_SCRIPT = """
+set -e
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+mkdir "$tmp/md5"
+cat > "$tmp/known"
+rpm -qa --queryformat '%{{NAME}} %{{VERSION}}\\0' > "$tmp/rpm" &
+rpm_pid=$!
+find {folders} \\( -type f -o -type l \\) -fprintf "$tmp/entries" '%y%Y\\0%p\\0%l\\0%s:%T@:%m:%i\\0' \\
+    -xtype f -fprintf "$tmp/hash" '%y %s:%T@:%m:%i %p\\0'
+awk -v RS='\\0' -v ORS='\\0' 'FILENAME == ARGV[1] {{ known[$0]; next }}
+    !($0 in known) {{ sub(/^[^ ]* [^ ]* /, ""); print }}' "$tmp/known" "$tmp/hash" > "$tmp/changed"
+xargs -0 -r -P "$(nproc)" -n {batch} sh -c 'md5sum -- "$@" > "$(mktemp -p "$0")"' "$tmp/md5" < "$tmp/changed"
+wait $rpm_pid
+cat "$tmp/entries"; printf '\\0'
+cat "$tmp/rpm"; printf '\\0'
+find "$tmp/md5" -type f -exec cat {{}} + | tr '\\n' '\\0'
+"""
+# Number of files hashed by each md5sum call
+MD5SUM_BATCH = 128
+
+def md5sum_unescape(path: str) -> str:
+    # md5sum prefixes the line with a backslash and escapes backslashes and newlines in file names
+    return re.sub(r'\\(.)', lambda m: '\n' if m[1] == 'n' else m[1], path)
+
+def parse_collector_output(output: str, previous: dict[str, Any] | None) -> dict[str, Any]:
+    data: dict[DataType, dict[str, str]] = {dtype: dict() for dtype in DataType}
+    metadata: dict[str, str] = dict()
+    hashed: dict[str, DataType] = dict()
+    records = iter(output.split('\0'))
+
+    for kind in records:
+        if kind == '':
+            break
+        path = next(records)
+        target = next(records)
+        metadata[path] = next(records)
+        match kind:
+            case 'ff':
+                hashed[path] = DataType.FILE
+                if previous is not None and path in previous['data'][DataType.FILE]:
+                    # Overwritten below if the file has been hashed again
+                    data[DataType.FILE][path] = previous['data'][DataType.FILE][path]
+            case 'lf':
+                hashed[path] = DataType.FILE_SYMLINK
+            case 'ld':
+                data[DataType.DIR_SYMLINK][path] = target
+            case 'lN' | 'lL' | 'l?':
+                data[DataType.BROKEN_SYMLINK][path] = target
+
+    for record in records:
+        if record == '':
+            break
+        name, version = record.split(' ', 1)
+        data[DataType.PACKAGE][name] = version
+
+    for record in records:
+        if record == '':
+            continue
+        md5, path = record.split('  ', 1)
+        if md5.startswith('\\'):
+            md5 = md5[1:]
+            path = md5sum_unescape(path)
+        data[hashed[path]][path] = md5
+
+    return {'data': data, 'metadata': metadata}
+
+# Collect the data of a host. If `previous` is a snapshot of the same host, only the files that changed since
+# are hashed.
+def get_data(host: str, folders: list[str], previous: dict[str, Any] | None = None) -> dict[str, Any]:
+    script = COLLECTOR_SCRIPT.format(folders=" ".join(shlex.quote(f) for f in folders), batch=MD5SUM_BATCH)
+
+    known = ""
+    if previous is not None and previous.get('host') == host:
+        known = "".join(f"f {previous['metadata'][path]} {path}\0"
+                        for path in previous['data'][DataType.FILE] if path in previous['metadata'])
+    else:
+        previous = None
 
     try:
-        ref_data[DataType.FILE] = ssh_get_files(host, DataType.FILE, folders)
-        ref_data[DataType.FILE_SYMLINK] = ssh_get_files(host, DataType.FILE_SYMLINK, folders)
-        ref_data[DataType.DIR_SYMLINK] = ssh_get_files(host, DataType.DIR_SYMLINK, folders)
-        ref_data[DataType.BROKEN_SYMLINK] = ssh_get_files(host, DataType.BROKEN_SYMLINK, folders)
-        ref_data[DataType.PACKAGE] = ssh_get_packages(host)
+        snapshot = parse_collector_output(ssh_cmd(host, script, input=known), previous)
     except Exception as e:
         print(e, file=sys.stderr)
         exit(-1)
 
-    return ref_data
-
-def sftp_get(host: str, remote_file: str, local_file: str) -> CompletedProcess[bytes]:
-    opts = '-o "StrictHostKeyChecking no" -o "LogLevel ERROR" -o "UserKnownHostsFile /dev/null"'
-
-    args = f"sftp {opts} -b - root@{host}"
-    input = bytes(f"get {shlex.quote(remote_file)} {shlex.quote(local_file)}", 'utf-8')
-    res = subprocess.run(
-        args,
-        input=input,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        check=False
-    )
-
-    if res.returncode:
-        raise Exception(f"Failed to get file from host: {res.returncode}")
-
-    return res
+    snapshot['host'] = host
+    return snapshot
 
-def remote_diff(host_ref: str, host_test: str, filename: str) -> None:
-    file_ref = None
-    file_test = None
-    try:
+# Print the type of each file given as NUL-delimited names on stdin, as NUL-delimited '<name>', '<type>' records
+FILE_TYPES_SCRIPT = """xargs -0 -r sh -c 'for f; do printf "%s\\0%s\\0" "$f" "$(file -L -b -- "$f")"; done' sh"""
+# Archive the files given as NUL-delimited names on stdin, following symlinks
+FETCH_SCRIPT = "tar --null --ignore-failed-read --hard-dereference -chf - -T -"
 
-        # check remote files are text files
-        cmd = f"file -b {shlex.quote(filename)}"
-        file_type = ssh_cmd(host_ref, cmd)
-        if not file_type.lower().startswith("ascii"):
-            print("Binary file. Not showing diff")
-            return
+def ssh_file_types(host: str, files: list[str]) -> dict[str, str]:
+    records = ssh_cmd(host, FILE_TYPES_SCRIPT, input="".join(f"{f}\0" for f in files)).split('\0')
+    return dict(zip(records[0::2], records[1::2]))
 
-        fd, file_ref = tempfile.mkstemp(suffix='_ref')
-        os.close(fd)
-        sftp_get(host_ref, filename, file_ref)
+# Get all the files from the host in a single tar stream, and extract the regular files in dest
+def ssh_fetch_files(host: str, files: list[str], dest: str) -> None:
+    opts = ["-o", "StrictHostKeyChecking no", "-o", "LogLevel ERROR", "-o", "UserKnownHostsFile /dev/null"]
+    args = ["ssh", *opts, f"root@{host}", FETCH_SCRIPT]
 
-        fd, file_test = tempfile.mkstemp(suffix='_test')
-        os.close(fd)
-        sftp_get(host_test, filename, file_test)
+    res = subprocess.run(args, input=b"".join(f"{f}\0".encode() for f in files), capture_output=True)
+    if res.returncode:
+        raise Exception(f"Failed to get files from host {host}: {res.stderr.decode()}")
 
-        args = ["diff", "-u", file_ref, file_test]
-        diff_res = subprocess.run(args, capture_output=True, text=True)
+    with tarfile.open(fileobj=io.BytesIO(res.stdout)) as tar:
+        for member in tar:
+            path = os.path.normpath(os.path.join(dest, member.name))
+            if not member.isfile() or not path.startswith(dest + os.sep):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tar.extractfile(member) as src, open(path, 'wb') as dst:  # type: ignore[union-attr]
+                shutil.copyfileobj(src, dst)
+
+def local_diff(filename: str, host_ref: str, host_test: str, dir_ref: str, dir_test: str) -> str | None:
+    local_name = filename.lstrip('/')
+    args = ["diff", "-u", "--label", f"{host_ref}:{filename}", "--label", f"{host_test}:{filename}",
+            os.path.join(dir_ref, local_name), os.path.join(dir_test, local_name)]
+    diff_res = subprocess.run(args, capture_output=True, text=True)
+
+    match diff_res.returncode:
+        case 1:
+            return diff_res.stdout
+        case 2:
+            raise Exception(diff_res.stderr)
+        case _:
+            return None
 
-        match diff_res.returncode:
-            case 1:
-                print(diff_res.stdout)
-            case 2:
-                raise Exception(diff_res.stderr)
-            case _:
-                pass
+# Diff the given files between the 2 hosts. Files are classified in one call to the reference host, text files
+# are fetched from both hosts concurrently, in one transfer per host, and diffed locally in parallel.
+# Returns what to print for each file.
+def remote_diffs(host_ref: str, host_test: str, files: list[str]) -> dict[str, str | None]:
+    diffs: dict[str, str | None] = dict()
+    if not files:
+        return diffs
 
+    try:
+        file_types = ssh_file_types(host_ref, files)
     except Exception as e:
         print(e, file=sys.stderr)
-    finally:
-        if file_ref is not None and os.path.exists(file_ref):
-            os.remove(file_ref)
-        if file_test is not None and os.path.exists(file_test):
-            os.remove(file_test)
+        return diffs
+
+    text_files = []
+    for filename in files:
+        if file_types.get(filename, "").lower().startswith("ascii"):
+            text_files.append(filename)
+        else:
+            diffs[filename] = "Binary file. Not showing diff"
+
+    with tempfile.TemporaryDirectory() as dir_ref, tempfile.TemporaryDirectory() as dir_test, \
+         ThreadPoolExecutor() as executor:
+        fetches = [executor.submit(ssh_fetch_files, host, text_files, tmpdir)
+                   for host, tmpdir in [(host_ref, dir_ref), (host_test, dir_test)]]
+        try:
+            for fetch in fetches:
+                fetch.result()
+        except Exception as e:
+            print(e, file=sys.stderr)
+            return diffs
+
+        futures = {filename: executor.submit(local_diff, filename, host_ref, host_test, dir_ref, dir_test)
+                   for filename in text_files}
+        for filename, future in futures.items():
+            try:
+                diffs[filename] = future.result()
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+    return diffs
 
 def print_results(results: dict[str, Any], show_diff: bool, show_ignored: bool) -> None:
+    diffs: dict[str, str | None] = dict()
+    if show_diff:
+        files = [file for dtype in DataType if dtype != DataType.PACKAGE for file in results[dtype]]
+        diffs = remote_diffs(results['host']['ref'], results['host']['test'], files)
+
     # Print what differs
     for dtype in DataType:
         if dtype == DataType.PACKAGE:
@@ -201,8 +281,8 @@ def print_results(results: dict[str, Any], show_diff: bool, show_ignored: bool)
         else:
             for file in results[dtype]:
                 print(f"{dtype} differs: {file}")
-                if show_diff:
-                    remote_diff(results['host']['ref'], results['host']['test'], file)
+                if diffs.get(file) is not None:
+                    print(diffs[file])
 
     # Print orphans
     for dtype in DataType:
@@ -286,26 +366,33 @@ def compare_data(
 
     return results, err
 
-# Load a previously saved json file containing reference data
-def load_reference_files(filename: str) -> dict[DataType, dict[str, str] | None]:
+# Load a previously saved snapshot. Plain json files containing only the data structure are still supported.
+def load_reference_files(filename: str) -> dict[str, Any]:
     try:
-        with open(filename, 'r') as fd:
-            return cast(dict[DataType, dict[str, str] | None], json.load(fd))
+        with open(filename, 'rb') as fd:
+            content = fd.read()
+        if content.startswith(b'\x1f\x8b'):
+            content = gzip.decompress(content)
+        snapshot = json.loads(content)
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         exit(-1)
 
-# Save files from a reference host in json format
-def save_reference_data(files: dict[DataType, dict[str, str] | None], filename: str) -> None:
+    if 'data' not in snapshot:
+        snapshot = {'host': None, 'data': snapshot, 'metadata': {}}
+    return cast(dict[str, Any], snapshot)
+
+# Save a host snapshot in gzip compressed json format
+def save_reference_data(snapshot: dict[str, Any], filename: str) -> None:
     try:
-        with open(filename, 'w') as fd:
-            json.dump(files, fd, indent=4)
+        with gzip.open(filename, 'wt') as fd:
+            json.dump(snapshot, fd)
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         exit(-1)
 
 def main() -> int:
-    ref_data: dict[DataType, dict[str, str] | None] | None = None
+    ref_snapshot: dict[str, Any] | None = None
     folders: list[str] = ["/boot", "/etc", "/opt", "/usr"]
     ignored_file_patterns: list[str] = [
         '/boot/initrd-*',
@@ -371,9 +458,13 @@ def main() -> int:
     parser.add_argument('--test-host', '-t', dest='test_host', type=str,
                         help='The XCP-ng host to be tested after install or upgrade')
     parser.add_argument('--save-reference', '-s', dest='save_ref', type=str,
-                        help='Save filesystem information of the reference host to a file')
+                        help='Save filesystem information of the reference host to a file. If the file already '
+                             'holds a snapshot of this host, only files changed since are hashed')
     parser.add_argument('--load-reference', '-l', dest='load_ref', type=str,
                         help='Load reference filesystem information from a file')
+    parser.add_argument('--since', dest='since', type=str,
+                        help='Report changes of the tested host since the snapshot saved in this file, '
+                             'then update the snapshot. Only files changed since are hashed')
     parser.add_argument('--show-diff', '-d', action='store_true', dest='show_diff',
                         help='Show diff of text files that differ. A reference host must be supplied with -r')
     parser.add_argument('--show-ignored', '-g', action='store_true', dest='show_ignored',
@@ -392,36 +483,54 @@ def main() -> int:
         print("Missing parameters. -d must be used with -r. Try --help", file=sys.stderr)
         return -1
 
-    if args.load_ref:
-        if not args.json_output:
-            print(f"Get reference data from {args.load_ref}")
-        ref_data = load_reference_files(args.load_ref)
-    elif args.ref_host:
+    if args.since and (args.ref_host or args.load_ref or args.test_host is None):
+        print("Missing parameters. --since must be used with -t, and without -r or -l. Try --help", file=sys.stderr)
+        return -1
+
+    ref_file = args.since or args.load_ref
+    if ref_file:
         if not args.json_output:
-            print(f"Get reference data from {args.ref_host}")
-        ref_data = get_data(args.ref_host, args.folders)
+            print(f"Get reference data from {ref_file}")
+        ref_snapshot = load_reference_files(ref_file)
 
-        if args.save_ref:
+    # Both hosts are collected concurrently. A snapshot of the tested host avoids hashing its unchanged files.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        test_future = None
+        if args.test_host is not None and (ref_snapshot is not None or args.ref_host):
             if not args.json_output:
-                print(f"Saving reference data to {args.save_ref}")
-            save_reference_data(ref_data, args.save_ref)
+                print(f"Get test host data from {args.test_host}")
+            test_future = executor.submit(get_data, args.test_host, args.folders, ref_snapshot)
 
-    if ref_data is None or args.test_host is None:
-        if args.save_ref:
-            return 0
+        if ref_snapshot is None and args.ref_host:
+            if not args.json_output:
+                print(f"Get reference data from {args.ref_host}")
+            previous = None
+            if args.save_ref and os.path.exists(args.save_ref):
+                previous = load_reference_files(args.save_ref)
+            ref_snapshot = get_data(args.ref_host, args.folders, previous)
 
-        print("\nMissing parameters. Try --help", file=sys.stderr)
-        return -1
+            if args.save_ref:
+                if not args.json_output:
+                    print(f"Saving reference data to {args.save_ref}")
+                save_reference_data(ref_snapshot, args.save_ref)
+
+        if ref_snapshot is None or test_future is None:
+            if args.save_ref:
+                return 0
 
-    if not args.json_output:
-        print(f"Get test host data from {args.test_host}")
-    test_data = get_data(args.test_host, args.folders)
+            print("\nMissing parameters. Try --help", file=sys.stderr)
+            return -1
 
-    ref: dict[str, Any] = dict([('data', ref_data), ('host', args.ref_host)])
-    test: dict[str, Any] = dict([('data', test_data), ('host', args.test_host)])
+        test_snapshot = test_future.result()
+
+    ref: dict[str, Any] = dict([('data', ref_snapshot['data']), ('host', args.ref_host)])
+    test: dict[str, Any] = dict([('data', test_snapshot['data']), ('host', args.test_host)])
 
     results, err = compare_data(ref, test, args.ignored_file_patterns)
 
+    if args.since:
+        save_reference_data(test_snapshot, args.since)
+
     if args.json_output:
         if not args.show_ignored:
             results.pop('ignored_files')
@@ -6,6 +6,9 @@ import argparse
 import io
 import logging
 import os
+import shutil
+import tarfile
+import time
 from xml.dom import minidom
 
 import libarchive  # type: ignore[import-untyped]
@@ -13,6 +16,10 @@ import libarchive.ffi  # type: ignore[import-untyped]
 
 from typing import Generator
 
+TAR_BLOCK_SIZE = 512
+# Buffer size used to stream data members, this bounds the memory used when copying
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
 class XvaHeaderMember:
     def __init__(self, member: minidom.Element):
         self.member = member
@@ -61,6 +68,105 @@ class XvaHeader:
         raise ValueError("Could not find bridge value in XVA header")
 
 
+def padded_size(size: int) -> int:
+    return (size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * TAR_BLOCK_SIZE
+
+def read_plain_header(path: str) -> tuple[bytes, bytes] | None:
+    """
+    Return the tar header block and the content of ova.xml if the XVA is an uncompressed tar starting with it,
+    None otherwise.
+    """
+    with open(path, "rb") as f:
+        block = f.read(TAR_BLOCK_SIZE)
+        try:
+            info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        except tarfile.HeaderError:
+            return None
+        if info.name != "ova.xml" or not info.isfile():
+            return None
+        return block, f.read(info.size)
+
+def read_header(path: str) -> bytes:
+    with libarchive.file_reader(path, "tar") as input_file:
+        logging.debug(f"Compression: {', '.join(filter.decode() for filter in input_file.filter_names)}")
+
+        header_entry = next(iter(input_file))
+        if header_entry.pathname != "ova.xml":
+            raise ValueError("Unexpected header entry name")
+        with io.BytesIO() as header_writer:
+            for block in header_entry.get_blocks():
+                header_writer.write(block)
+            return header_writer.getvalue()
+
+def fit_header_member(header_block: bytes, old_size: int, new_header: bytes) -> bytes | None:
+    """
+    Return the ova.xml member (tar header block and padded data) rewritten in the space used by the old one,
+    or None if the new header doesn't fit.
+    """
+    if len(new_header) > padded_size(old_size):
+        return None
+    if len(new_header) < old_size:
+        # Whitespace is allowed after the XML root element, keep the same size to leave the other blocks as is
+        new_header += b" " * (old_size - len(new_header))
+
+    block = bytearray(header_block)
+    block[124:136] = b"%011o\0" % len(new_header)
+    block[148:156] = b" " * 8
+    block[148:156] = b"%06o\0 " % sum(block)
+    return bytes(block) + new_header.ljust(padded_size(len(new_header)), b"\0")
+
+def header_member(new_header: bytes) -> bytes:
+    info = tarfile.TarInfo("ova.xml")
+    info.size = len(new_header)
+    info.mode = 0o400
+    info.mtime = int(time.time())
+    return info.tobuf(tarfile.USTAR_FORMAT) + new_header.ljust(padded_size(len(new_header)), b"\0")
+
+def rewrite_plain_in_place(path: str, member: bytes) -> None:
+    """ Overwrite the ova.xml member of an uncompressed XVA, the data members are left untouched. """
+    with open(path, "r+b") as f:
+        f.write(member)
+
+def rewrite_plain(path: str, output_path: str, old_size: int, new_header: bytes) -> None:
+    """ Write an uncompressed XVA with a new ova.xml, copying the data members from the uncompressed input as is. """
+    with open(path, "rb") as input_file, open(output_path, "wb") as output_file:
+        output_file.write(header_member(new_header))
+        input_file.seek(TAR_BLOCK_SIZE + padded_size(old_size))
+        shutil.copyfileobj(input_file, output_file, COPY_BUFFER_SIZE)
+
+def rewrite(path: str, output_path: str, new_header: bytes, compression: str, threads: int) -> None:
+    """ Stream the XVA through libarchive to write it with a new ova.xml and the given compression. """
+    filter_name = None if compression == "none" else compression
+    options = f"zstd:threads={threads}" if compression == "zstd" else ""
+    with libarchive.file_reader(path, "tar") as input_file, \
+         libarchive.file_writer(output_path, "pax_restricted", filter_name, options=options) as output_file:
+        entry_iter = iter(input_file)
+        next(entry_iter)
+
+        output_file.add_file_from_memory(
+            "ova.xml", len(new_header), new_header, permission=0o400, uid=0, gid=0
+        )
+
+        for entry in entry_iter:
+            logging.debug(f"Copying {entry.pathname}: {entry.size} bytes")
+            new_entry = libarchive.ArchiveEntry(entry.header_codec, perm=0o400, uid=0, gid=0)
+            for attr in ["filetype", "pathname", "size"]:
+                setattr(new_entry, attr, getattr(entry, attr))
+
+            # ArchiveEntry doesn't expose block copying, so write the entry manually via the FFI interface
+            libarchive.ffi.write_header(output_file._pointer, new_entry._entry_p)  # type: ignore # noqa: SLF001
+            for block in entry.get_blocks():
+                libarchive.ffi.write_data(output_file._pointer, block, len(block)) # type: ignore # noqa: SLF001
+            libarchive.ffi.write_finish_entry(output_file._pointer)  # type: ignore  # noqa: SLF001
+
+def log_throughput(path: str, output_path: str, start: float) -> None:
+    elapsed = max(time.monotonic() - start, 1e-6)
+    input_size = os.path.getsize(path) / 1024 / 1024
+    output_size = os.path.getsize(output_path) / 1024 / 1024
+    logging.info(f"Processed {input_size:.1f} MiB into {output_size:.1f} MiB in {elapsed:.1f}s "
+                 f"({input_size / elapsed:.1f} MiB/s)")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("xva", help="input file path")
@@ -69,14 +175,25 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--compression",
-        choices=["zstd", "gzip"],
+        choices=["zstd", "gzip", "none"],
         default="zstd",
-        help="compression mode of new XVA when setting bridge value (default: zstd)",
+        help="compression mode of new XVA when setting bridge value (default: zstd). "
+        "With none, the data members of an uncompressed XVA are copied as is",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of zstd compression threads (default: number of CPUs)",
     )
     parser.add_argument("-o", "--output", help="output file path (must not be the same as input)")
     parser.add_argument("--backup-path", help="backup file path")
     parser.add_argument(
-        "--in-place", action="store_true", help="rename output file to input file; rename input file to backup file"
+        "--in-place",
+        action="store_true",
+        help="rename output file to input file; rename input file to backup file. "
+        "With --compression none, an uncompressed XVA is modified directly when the new header fits, "
+        "after copying it to the backup path if one is given",
     )
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose logging")
     args = parser.parse_args()
@@ -86,52 +203,54 @@ if __name__ == "__main__":
     else:
         logging.getLogger().setLevel(logging.INFO)
 
-    with libarchive.file_reader(args.xva, "tar") as input_file:
-        logging.debug(f"Compression: {', '.join(filter.decode() for filter in input_file.filter_names)}")
+    plain = read_plain_header(args.xva)
+    if plain is not None:
+        logging.debug("Compression: none")
+        header_bytes = plain[1]
+    else:
+        header_bytes = read_header(args.xva)
 
-        entry_iter = iter(input_file)
+    logging.debug(f"Header is {len(header_bytes)} bytes")
 
-        header_entry = next(entry_iter)
-        if header_entry.pathname != "ova.xml":
-            raise ValueError("Unexpected header entry name")
-        with io.BytesIO() as header_writer:
-            for block in header_entry.get_blocks():
-                header_writer.write(block)
-            header_bytes = header_writer.getvalue()
+    header = XvaHeader(header_bytes)
+    bridge = header.get_bridge()
+    logging.info(f"Found bridge {bridge}")
+
+    if args.set_bridge:
+        logging.info(f"Setting bridge to {args.set_bridge}")
+        header.set_bridge(args.set_bridge)
+        new_header_bytes = header.xml.toxml().encode()
 
-        logging.debug(f"Header is {len(header_bytes)} bytes")
+        compression = args.compression
+        logging.debug(f"Using compression {compression}")
 
-        header = XvaHeader(header_bytes)
-        bridge = header.get_bridge()
-        logging.info(f"Found bridge {bridge}")
+        start = time.monotonic()
+        fitting_member = None
+        if plain is not None and compression == "none" and args.in_place:
+            fitting_member = fit_header_member(plain[0], len(plain[1]), new_header_bytes)
 
-        if args.set_bridge:
+        if fitting_member is not None:
+            # Fast path: only the header blocks are rewritten. Without an explicit backup path, no backup is made
+            # as this can be reverted by setting the previous bridge again
+            if args.backup_path:
+                logging.info(f"Copying {args.xva} -> {args.backup_path}")
+                shutil.copyfile(args.xva, args.backup_path)
+            logging.info(f"Rewriting header of {args.xva} in place")
+            rewrite_plain_in_place(args.xva, fitting_member)
+            logging.info(f"Rewrote the {len(fitting_member)} bytes of the header member in "
+                         f"{time.monotonic() - start:.3f}s")
+        else:
             output_path = args.output
             if not output_path:
                 output_path = args.xva + ".new"
             logging.info(f"Output path: {output_path}")
 
-            logging.info(f"Setting bridge to {args.set_bridge}")
-            header.set_bridge(args.set_bridge)
-
-            logging.debug(f"Using compression {args.compression}")
-            with libarchive.file_writer(output_path, "pax_restricted", args.compression) as output_file:
-                new_header_bytes = header.xml.toxml().encode()
-                output_file.add_file_from_memory(
-                    "ova.xml", len(new_header_bytes), new_header_bytes, permission=0o400, uid=0, gid=0
-                )
-
-                for entry in entry_iter:
-                    logging.debug(f"Copying {entry.pathname}: {entry.size} bytes")
-                    new_entry = libarchive.ArchiveEntry(entry.header_codec, perm=0o400, uid=0, gid=0)
-                    for attr in ["filetype", "pathname", "size"]:
-                        setattr(new_entry, attr, getattr(entry, attr))
-
-                    # ArchiveEntry doesn't expose block copying, so write the entry manually via the FFI interface
-                    libarchive.ffi.write_header(output_file._pointer, new_entry._entry_p)  # type: ignore # noqa: SLF001
-                    for block in entry.get_blocks():
-                        libarchive.ffi.write_data(output_file._pointer, block, len(block)) # type: ignore # noqa: SLF001
-                    libarchive.ffi.write_finish_entry(output_file._pointer)  # type: ignore  # noqa: SLF001
+            if plain is not None and compression == "none":
+                # Data members are copied as is, without going through libarchive
+                rewrite_plain(args.xva, output_path, len(plain[1]), new_header_bytes)
+            else:
+                rewrite(args.xva, output_path, new_header_bytes, compression, args.threads)
+            log_throughput(args.xva, output_path, start)
 
             if args.in_place:
                 backup_path = args.backup_path
@@ -9,9 +9,9 @@ import tempfile
 import xml.etree.ElementTree as ET
 
 from data import ARP_SERVER, ISO_IMAGES, ISO_IMAGES_BASE, ISO_IMAGES_CACHE, TEST_SSH_PUBKEY, TOOLS
-from lib import installer, pxe
+from lib import config, installer, pxe
 from lib.commands import local_cmd
-from lib.common import callable_marker, url_download, wait_for
+from lib.common import cached_url_download, callable_marker, wait_for
 from lib.installer import AnswerFile
 
 from typing import TYPE_CHECKING, Any, Generator, Sequence
@@ -91,12 +91,9 @@ def installer_iso(request: pytest.FixtureRequest) -> dict[str, str | bool]:
         assert os.path.exists(iso), f"file not found: {iso}"
         local_iso = iso
     else:
-        cached_iso = os.path.join(ISO_IMAGES_CACHE, os.path.basename(iso))
-        if not os.path.exists(cached_iso):
-            url = iso if ":/" in iso else (ISO_IMAGES_BASE + iso)
-            logging.info("installer_iso: downloading %r into %r", url, cached_iso)
-            url_download(url, cached_iso)
-        local_iso = cached_iso
+        url = iso if ":/" in iso else (ISO_IMAGES_BASE + iso)
+        local_iso = cached_url_download(url, os.path.basename(iso), sha256=ISO_IMAGES[iso_key].get('sha256'),
+                                        cache_dir=ISO_IMAGES_CACHE)
     logging.info("installer_iso: using %r", local_iso)
     return dict(iso=local_iso,
                 unsigned=ISO_IMAGES[iso_key].get('unsigned', False),
@@ -147,8 +144,6 @@ def remastered_iso(installer_iso: dict[str, str | bool], answerfile: AnswerFile
         else:
             logging.info("no answerfile")
 
-        logging.info("Remastering %s to %s", iso_file, remastered_iso)
-
         # generate install.img-patcher script
         with open(img_patcher_script, "xt") as patcher_fd:
             script_contents = f"""#!/bin/bash
@@ -263,13 +258,27 @@ sed -i "${{SED_COMMANDS[@]}}" \
             print(script_contents, file=patcher_fd)
             os.chmod(patcher_fd.fileno(), 0o755)
 
+        cache_key = None
+        if config.remastered_iso_cache is not None:
+            cache_key = installer.remastered_iso_cache_key(
+                iso_file, iso_remaster, [answerfile_xml, img_patcher_script, iso_patcher_script], isotmp)
+            cached_iso = installer.cached_remastered_iso(config.remastered_iso_cache, cache_key)
+            if cached_iso is not None:
+                yield cached_iso
+                return
+
         # do remaster
+        logging.info("Remastering %s to %s", iso_file, remastered_iso)
         local_cmd([iso_remaster,
                    "--install-patcher", img_patcher_script,
                    "--iso-patcher", iso_patcher_script,
                    iso_file, remastered_iso
                    ], cwd=isotmp)
 
+        if cache_key is not None:
+            assert config.remastered_iso_cache is not None
+            remastered_iso = installer.store_remastered_iso(config.remastered_iso_cache, cache_key,
+                                                            remastered_iso, config.remastered_iso_cache_size)
         yield remastered_iso
 
 @pytest.fixture(scope='function')
@@ -284,18 +293,21 @@ def vm_booted_with_installer(host: Host, create_vms: list[VM], remastered_iso: s
 
     remote_iso = None
     try:
-        remote_iso = host.pool.push_iso(iso)
-        host_vm.insert_cd(os.path.basename(remote_iso))
+        if config.remastered_iso_cache is not None:
+            # cached ISOs are shared with other tests and test sessions using the pool: they stay in the SR
+            host_vm.insert_cd(host.pool.push_iso(iso, dedupe=True))
+        else:
+            remote_iso = host.pool.push_iso(iso)
+            host_vm.insert_cd(os.path.basename(remote_iso))
 
         try:
             host_vm.start()
             wait_for(host_vm.is_running, "Wait for host VM running")
 
             # catch host-vm IP address
-            wait_for(lambda: pxe.arp_addresses_for(mac_address),
-                     "Wait for DHCP server to see Host VM in ARP tables",
-                     timeout_secs=10 * 60)
-            ips = pxe.arp_addresses_for(mac_address)
+            ips = pxe.wait_for_arp_addresses(mac_address,
+                                             "Wait for DHCP server to see Host VM in ARP tables",
+                                             timeout_secs=10 * 60)
             logging.info("Host VM has IPs %s", ips)
             assert len(ips) == 1
             host_vm.ip = ips[0]
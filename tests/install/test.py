@@ -186,10 +186,9 @@ class TestNested:
             wait_for(host_vm.is_running, "Wait for host VM running")
 
             # catch host-vm IP address
-            wait_for(lambda: pxe.arp_addresses_for(mac_address),
-                     "Wait for DHCP server to see Host VM in ARP tables",
-                     timeout_secs=10 * 60)
-            ips = pxe.arp_addresses_for(mac_address)
+            ips = pxe.wait_for_arp_addresses(mac_address,
+                                             "Wait for DHCP server to see Host VM in ARP tables",
+                                             timeout_secs=10 * 60)
             logging.info("Host VM has IPs %s", ips)
             assert len(ips) == 1
             host_vm.ip = ips[0]
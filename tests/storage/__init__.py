@@ -1,3 +1,4 @@
+from .scale import ScaleSample, vdi_scale_benchmark
 from .storage import (
     MAX_VDI_SIZE,
     CoalesceOperation,
@@ -3,13 +3,11 @@ import pytest
 import logging
 import os
 import tempfile
-import urllib.request
 from datetime import datetime
 from pathlib import Path
 from urllib.parse import urlparse
-from uuid import uuid4
 
-from lib.common import GiB, PackageManagerEnum
+from lib.common import GiB, PackageManagerEnum, cached_url_download
 from lib.host import Host
 from lib.sr import SR
 from lib.vbd import VBD
@@ -123,9 +121,9 @@ def prev_results(pytestconfig: pytest.Config) -> dict[str, list[FioBenchmarkCSV]
     csv_path = csv_uri
     if urlparse(csv_uri).scheme != "":
         logging.info("Detected CSV path as an url")
-        csv_path = f"/tmp/{uuid4()}.csv"
-        urllib.request.urlretrieve(csv_uri, csv_path)
-        logging.info(f"Fetching CSV file from {csv_uri} to {csv_path}")
+        # previous results may be published again at the same URL
+        csv_path = cached_url_download(csv_uri, revalidate=True)
+        logging.info(f"Fetched CSV file from {csv_uri} to {csv_path}")
     if not os.path.exists(csv_path):
         raise FileNotFoundError(csv_path)
     return load_results_from_csv(csv_path)
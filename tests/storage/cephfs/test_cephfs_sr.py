@@ -4,13 +4,13 @@ import logging
 import time
 
 from lib.commands import SSHCommandFailed
-from lib.common import vm_image, wait_for
+from lib.common import Defer, vm_image, wait_for
 from lib.host import Host
 from lib.pool import Pool
 from lib.sr import SR
 from lib.vdi import VDI
 from lib.vm import VM
-from tests.storage import vdi_is_open
+from tests.storage import vdi_is_open, vdi_scale_benchmark
 
 # Requirements:
 # - one XCP-ng host >= 8.2
@@ -23,6 +23,10 @@ class TestCephFSSR:
     def test_quicktest(self, cephfs_sr: SR) -> None:
         cephfs_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, cephfs_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(cephfs_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_cephfs_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_cephfs_sr)
 
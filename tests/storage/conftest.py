@@ -20,6 +20,20 @@ def pytest_collection_modifyitems(config: pytest.Config, items: list[pytest.Item
             items.remove(item)
             items.insert(0, item)
 
+@pytest.fixture(scope='session')
+def sr_scale_levels(pytestconfig: pytest.Config) -> list[int]:
+    levels = pytestconfig.getoption("sr_scale_levels")
+    assert levels is not None
+    if not levels:
+        levels = ["100", "1000", "2000"]
+    return sorted(int(level) for level in levels)
+
+@pytest.fixture(scope='session')
+def sr_scale_workers(pytestconfig: pytest.Config) -> int:
+    workers = pytestconfig.getoption("sr_scale_workers")
+    assert workers is not None
+    return int(workers)
+
 @pytest.fixture(scope='module')
 def storage_test_vm(running_unix_vm: VM) -> Generator[VM, None, None]:
     install_randstream(running_unix_vm)
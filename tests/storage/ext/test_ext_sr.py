@@ -21,6 +21,7 @@ from tests.storage import (
     try_to_create_sr_with_missing_device,
     vdi_export_import,
     vdi_is_open,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -33,6 +34,10 @@ class TestEXTSR:
     def test_quicktest(self, ext_sr: SR) -> None:
         ext_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, ext_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(ext_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_ext_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_ext_sr)
 
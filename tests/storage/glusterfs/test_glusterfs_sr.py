@@ -3,13 +3,13 @@ import pytest
 import logging
 
 from lib.commands import SSHCommandFailed
-from lib.common import vm_image, wait_for
+from lib.common import Defer, vm_image, wait_for
 from lib.host import Host
 from lib.pool import Pool
 from lib.sr import SR
 from lib.vdi import VDI
 from lib.vm import VM
-from tests.storage import vdi_is_open
+from tests.storage import vdi_is_open, vdi_scale_benchmark
 
 # Requirements:
 # - one XCP-ng host >= 8.2 with an additional unused disk for the SR
@@ -20,6 +20,10 @@ class TestGlusterFSSR:
     def test_quicktest(self, glusterfs_sr: SR) -> None:
         glusterfs_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, glusterfs_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(glusterfs_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_glusterfs_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_glusterfs_sr)
 
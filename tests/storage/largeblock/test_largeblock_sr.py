@@ -2,9 +2,9 @@ from __future__ import annotations
 
 import pytest
 
-from lib.common import vm_image, wait_for
+from lib.common import Defer, vm_image, wait_for
 from lib.vdi import ImageFormat
-from tests.storage import try_to_create_sr_with_missing_device, vdi_is_open
+from tests.storage import try_to_create_sr_with_missing_device, vdi_is_open, vdi_scale_benchmark
 
 from typing import TYPE_CHECKING
 
@@ -23,6 +23,11 @@ class TestLARGEBLOCKSR:
     def test_quicktest(self, largeblock_sr: SR) -> None:
         largeblock_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, largeblock_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int,
+                       defer: Defer) -> None:
+        vdi_scale_benchmark(largeblock_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_largeblock_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_largeblock_sr)
 
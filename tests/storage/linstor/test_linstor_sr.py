@@ -6,13 +6,13 @@ import shlex
 import time
 
 from lib.commands import SSHCommandFailed
-from lib.common import safe_split, vm_image, wait_for
+from lib.common import Defer, safe_split, vm_image, wait_for
 from lib.host import Host
 from lib.pool import Pool
 from lib.sr import SR
 from lib.vdi import VDI
 from lib.vm import VM
-from tests.storage import vdi_is_open
+from tests.storage import vdi_is_open, vdi_scale_benchmark
 
 from .conftest import GROUP_NAME, LINSTOR_PACKAGE
 
@@ -86,6 +86,10 @@ class TestLinstorSR:
             if provisioning_type == "thick":
                 pytest.fail("Expected failure for thick provisioning did not occur (XPASS)")
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, linstor_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(linstor_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_linstor_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_linstor_sr)
 
@@ -21,6 +21,7 @@ from tests.storage import (
     try_to_create_sr_with_missing_device,
     vdi_export_import,
     vdi_is_open,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -34,6 +35,10 @@ class TestLVMSR:
     def test_quicktest(self, lvm_sr: SR) -> None:
         lvm_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, lvm_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(lvm_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_lvm_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_lvm_sr)
 
@@ -14,6 +14,7 @@ from tests.storage import (
     full_vdi_write,
     vdi_export_import,
     vdi_is_open,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -29,6 +30,10 @@ class TestLVMOHBASR:
     def test_quicktest(self, lvmohba_sr):
         lvmohba_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, lvmohba_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(lvmohba_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_lvmohba_sr: VDI):
         assert not vdi_is_open(vdi_on_lvmohba_sr)
 
@@ -15,6 +15,7 @@ from tests.storage import (
     full_vdi_write,
     vdi_export_import,
     vdi_is_open,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -30,6 +31,10 @@ class TestLVMOISCSISR:
     def test_quicktest(self, lvmoiscsi_sr: SR) -> None:
         lvmoiscsi_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, lvmoiscsi_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(lvmoiscsi_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_lvmoiscsi_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_lvmoiscsi_sr)
 
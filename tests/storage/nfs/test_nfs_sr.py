@@ -18,6 +18,7 @@ from tests.storage import (
     full_vdi_write,
     vdi_export_import,
     vdi_is_open,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -38,6 +39,12 @@ class TestNFSSR:
         vdi = dispatch_nfs
         assert not vdi_is_open(vdi)
 
+    @pytest.mark.sr_scale
+    @pytest.mark.parametrize('dispatch_nfs', ['nfs_sr', 'nfs4_sr'], indirect=True)
+    def test_vdi_scale(self, dispatch_nfs: SR, sr_scale_levels: list[int], sr_scale_workers: int,
+                       defer: Defer) -> None:
+        vdi_scale_benchmark(dispatch_nfs, sr_scale_levels, sr_scale_workers, defer)
+
     @pytest.mark.small_vm
     @pytest.mark.usefixtures('hostA2')
     # Make sure this fixture is called before the parametrized one
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import itertools
+import logging
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from lib.common import Defer, MiB, exec_nofail, raise_errors
+from lib.sr import SR
+from lib.vdi import VDI
+
+from typing import Callable, Literal, TypeVar
+
+T = TypeVar("T")
+
+ScaleOperation = Literal['create', 'snapshot', 'scan', 'attach', 'destroy']
+
+# Small enough that thick provisioned SRs can hold thousands of them
+SCALE_VDI_SIZE = 8 * MiB
+# Number of scan, attach, snapshot and destroy operations timed at each population level
+SCALE_SAMPLES = 10
+PERCENTILES = (50, 90, 99)
+
+@dataclass
+class ScaleSample:
+    """ Latencies of one operation, measured at a given SR population (number of VDIs). """
+
+    population: int
+    operation: ScaleOperation
+    latencies: list[float] = field(default_factory=list)
+
+    def percentile(self, p: int) -> float:
+        """ Nearest-rank percentile, in seconds. """
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+def _timed(fn: Callable[[], T]) -> tuple[T, float]:
+    start = time.perf_counter()
+    ret = fn()
+    return ret, time.perf_counter() - start
+
+def _populate(sr: SR, vdis: list[VDI], count: int, workers: int) -> list[float]:
+    """ Create `count` VDIs concurrently, add them to `vdis` and return the creation latencies. """
+    latencies: list[float] = []
+    errors: list[Exception] = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_timed, lambda: sr.create_vdi(virtual_size=SCALE_VDI_SIZE))
+                   for _ in range(count)]
+        for future in futures:
+            try:
+                vdi, latency = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            vdis.append(vdi)
+            latencies.append(latency)
+    raise_errors(errors)
+    return latencies
+
+def _destroy_all(vdis: list[VDI], workers: int) -> None:
+    logging.info("Destroy %d VDIs", len(vdis))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = list(itertools.chain.from_iterable(
+            executor.map(lambda vdi: exec_nofail(vdi.destroy), vdis)
+        ))
+    raise_errors(errors)
+
+def _attach_detach(sr: SR, vdi: VDI) -> None:
+    """ Plug the VDI in the control domain of the SR's main host, then unplug it. """
+    master = sr.pool.master
+    vbd_uuid = master.xe('vbd-create', {
+        'vdi-uuid': vdi.uuid,
+        'vm-uuid': sr.main_host().get_dom0_uuid(),
+        'device': 'autodetect',
+    })
+    try:
+        master.xe('vbd-plug', {'uuid': vbd_uuid})
+        master.xe('vbd-unplug', {'uuid': vbd_uuid})
+    finally:
+        master.xe('vbd-destroy', {'uuid': vbd_uuid})
+
+def log_scaling_curve(samples: list[ScaleSample]) -> None:
+    columns = [f'p{p} (s)' for p in PERCENTILES] + ['max (s)']
+    lines = [f"{'VDIs':>8} {'operation':<10} {'count':>6} " + " ".join(f"{c:>9}" for c in columns)]
+    for sample in sorted(samples, key=lambda s: (s.operation, s.population)):
+        lines.append(
+            f"{sample.population:>8} {sample.operation:<10} {len(sample.latencies):>6} "
+            + " ".join(f"{sample.percentile(p):>9.3f}" for p in PERCENTILES)
+            + f" {sample.percentile(100):>9.3f}"
+        )
+    logging.info("SR scaling curve:\n%s", "\n".join(lines))
+
+def vdi_scale_benchmark(sr: SR, levels: list[int], workers: int, defer: Defer) -> list[ScaleSample]:
+    """
+    Populate an SR up to each population level and measure VDI operation latencies.
+
+    VDIs are created concurrently with at most `workers` xe calls in flight. At each level,
+    snapshot, scan, attach (plug/unplug in dom0) and the destruction of population VDIs are timed
+    `SCALE_SAMPLES` times, then a scaling curve is logged. All VDIs created are destroyed concurrently at teardown.
+    """
+    vdis: list[VDI] = []
+    defer(lambda: _destroy_all(vdis, workers))
+
+    baseline = len(sr.vdi_uuids())
+    samples: list[ScaleSample] = []
+    for level in sorted(levels):
+        logging.info("Populate SR %s up to %d VDIs", sr.uuid, level)
+        samples.append(ScaleSample(level, 'create', _populate(sr, vdis, max(0, level - len(vdis)), workers)))
+
+        sr.scan()
+        assert len(sr.vdi_uuids()) >= baseline + len(vdis), "the SR scan does not report all the created VDIs"
+
+        scan = ScaleSample(level, 'scan')
+        snapshot = ScaleSample(level, 'snapshot')
+        attach = ScaleSample(level, 'attach')
+        destroy = ScaleSample(level, 'destroy')
+        for vdi in random.sample(vdis, min(SCALE_SAMPLES, len(vdis))):
+            scan.latencies.append(_timed(sr.scan)[1])
+            attach.latencies.append(_timed(lambda: _attach_detach(sr, vdi))[1])
+            snap, latency = _timed(vdi.snapshot)
+            snapshot.latencies.append(latency)
+            snap.destroy()
+        # the population is lowered by at most SCALE_SAMPLES, and refilled at the next level
+        for vdi in random.sample(vdis, min(SCALE_SAMPLES, len(vdis))):
+            destroy.latencies.append(_timed(vdi.destroy)[1])
+            vdis.remove(vdi)
+        samples += [scan, snapshot, attach, destroy]
+
+    log_scaling_curve(samples)
+    return samples
@@ -20,6 +20,7 @@ from tests.storage import (
     full_vdi_write,
     vdi_export_import,
     vdi_is_open,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -35,6 +36,10 @@ class TestZFSSR:
     def test_quicktest(self, zfs_sr: SR) -> None:
         zfs_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, zfs_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(zfs_sr, sr_scale_levels, sr_scale_workers, defer)
+
     def test_vdi_is_not_open(self, vdi_on_zfs_sr: VDI) -> None:
         assert not vdi_is_open(vdi_on_zfs_sr)
 
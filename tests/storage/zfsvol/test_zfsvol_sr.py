@@ -19,6 +19,7 @@ from tests.storage import (
     coalesce_integrity,
     full_vdi_write,
     vdi_export_import,
+    vdi_scale_benchmark,
     xva_export_import,
 )
 
@@ -37,6 +38,10 @@ class TestZfsvolVm:
     def test_quicktest(self, zfsvol_sr: SR) -> None:
         zfsvol_sr.run_quicktest()
 
+    @pytest.mark.sr_scale
+    def test_vdi_scale(self, zfsvol_sr: SR, sr_scale_levels: list[int], sr_scale_workers: int, defer: Defer) -> None:
+        vdi_scale_benchmark(zfsvol_sr, sr_scale_levels, sr_scale_workers, defer)
+
     @pytest.mark.small_vm # run with a small VM to test the features
     @pytest.mark.big_vm # and ideally with a big VM to test it scales
     def test_start_and_shutdown_VM(self, vm_on_zfsvol_sr: VM) -> None:
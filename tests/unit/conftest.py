@@ -0,0 +1,8 @@
+from __future__ import annotations
+
+import pytest
+
+def pytest_runtest_setup(item: pytest.Item) -> None:
+    # wall-clock checks depend on the load of the machine, only run them on request
+    if item.get_closest_marker("benchmark") and "benchmark" not in item.config.getoption("markexpr"):
+        pytest.skip("benchmark, run with -m benchmark")
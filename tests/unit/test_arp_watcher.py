@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import pytest
+
+import shlex
+import subprocess
+
+import lib.pxe as pxe
+from lib.pxe import _DUMP_END, _NEIGH_RE, ArpWatcher
+
+from typing import Iterator
+
+MAC = "52:54:00:12:34:56"
+OTHER_MAC = "52:54:00:ab:cd:ef"
+
+@pytest.mark.parametrize("line,groups", [
+    (f"10.0.0.5 dev eth0 lladdr {MAC} REACHABLE", (None, "10.0.0.5", MAC, "REACHABLE")),
+    (f"10.0.0.5 dev eth0 lladdr {MAC} router STALE", (None, "10.0.0.5", MAC, "STALE")),
+    (f"[NEIGH]10.0.0.5 dev eth0 lladdr {MAC} DELAY", (None, "10.0.0.5", MAC, "DELAY")),
+    (f"Deleted 10.0.0.5 dev eth0 lladdr {MAC} STALE", ("Deleted ", "10.0.0.5", MAC, "STALE")),
+    ("10.0.0.6 dev eth0  FAILED", (None, "10.0.0.6", None, "FAILED")),
+    ("fe80::1 dev eth0 lladdr 52:54:00:12:34:57 REACHABLE", (None, "fe80::1", "52:54:00:12:34:57", "REACHABLE")),
+])
+def test_neigh_re(line: str, groups: tuple[str | None, ...]) -> None:
+    m = _NEIGH_RE.match(line)
+    assert m is not None
+    assert m.groups() == groups
+
+def test_neigh_re_ignores_other_lines() -> None:
+    assert _NEIGH_RE.match(_DUMP_END) is None
+    assert _NEIGH_RE.match("") is None
+
+def _watcher(monkeypatch: pytest.MonkeyPatch, script: str) -> Iterator[ArpWatcher]:
+    """ An ArpWatcher on a local shell script standing for `ip monitor neigh & ip neigh show` on the server. """
+    def ssh_stream(server: str, cmd: str) -> subprocess.Popen[bytes]:
+        assert _DUMP_END in cmd
+        return subprocess.Popen(["sh", "-c", script], stdout=subprocess.PIPE)
+    monkeypatch.setattr(pxe, "ssh_stream", ssh_stream)
+    monkeypatch.setattr(ArpWatcher, "DUMP_TIMEOUT_SECS", 5)
+    watcher = ArpWatcher("arp-server")
+    yield watcher
+    watcher.stop()
+
+@pytest.fixture
+def watcher(monkeypatch: pytest.MonkeyPatch) -> Iterator[ArpWatcher]:
+    for watcher in _watcher(monkeypatch, f"echo '{_DUMP_END}'; exec sleep 60"):
+        # the dump is read, so the connection won't reset the neighbours anymore
+        assert watcher.addresses_for(MAC) == []
+        yield watcher
+
+def test_update(watcher: ArpWatcher) -> None:
+    update = watcher._update  # noqa: SLF001
+    update(f"10.0.0.5 dev eth0 lladdr {MAC.upper()} REACHABLE")
+    update(f"10.0.0.7 dev eth0 lladdr {MAC} STALE")
+    assert watcher.neighbours == {MAC: {"10.0.0.5": "REACHABLE", "10.0.0.7": "STALE"}}
+    # only reachable IPs are returned
+    assert watcher.addresses_for(MAC.upper()) == ["10.0.0.5"]
+
+    # the IP moves to another MAC
+    update(f"10.0.0.5 dev eth0 lladdr {OTHER_MAC} REACHABLE")
+    assert watcher.addresses_for(MAC) == []
+    assert watcher.addresses_for(OTHER_MAC) == ["10.0.0.5"]
+
+    # the IP loses its MAC
+    update("10.0.0.5 dev eth0  FAILED")
+    assert watcher.addresses_for(OTHER_MAC) == []
+
+    update(f"10.0.0.7 dev eth0 lladdr {MAC} REACHABLE")
+    assert watcher.addresses_for(MAC) == ["10.0.0.7"]
+    update(f"Deleted 10.0.0.7 dev eth0 lladdr {MAC} REACHABLE")
+    assert watcher.addresses_for(MAC) == []
+
+    update("unrelated line")
+    assert watcher.neighbours == {MAC: {}, OTHER_MAC: {}}
+
+def test_first_lookup_waits_for_dump(monkeypatch: pytest.MonkeyPatch) -> None:
+    neighbours = f"10.0.0.5 dev eth0 lladdr {MAC} REACHABLE\n"
+    script = f"sleep 0.5; printf %s {shlex.quote(neighbours)}; echo '{_DUMP_END}'; exec sleep 60"
+    for watcher in _watcher(monkeypatch, script):
+        assert watcher.addresses_for(MAC) == ["10.0.0.5"]
+
+def test_wait_for_addresses(monkeypatch: pytest.MonkeyPatch) -> None:
+    script = (f"echo '{_DUMP_END}'; sleep 0.5; echo '10.0.0.5 dev eth0 lladdr {MAC} REACHABLE'; exec sleep 60")
+    for watcher in _watcher(monkeypatch, script):
+        assert watcher.wait_for_addresses(MAC, timeout_secs=5) == ["10.0.0.5"]
+        with pytest.raises(TimeoutError):
+            watcher.wait_for_addresses(OTHER_MAC, timeout_secs=0.1)
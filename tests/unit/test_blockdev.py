@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import pytest
+
+import json
+import re
+import time
+from unittest.mock import MagicMock
+
+from lib.blockdev import BlockDeviceGraph
+from lib.host import Host
+from tests.unit import test_rescan_block_devices_info as fixtures
+
+# Time budget, in seconds, to list the devices of SYNTHETIC_LUNS multipath LUNs: linear in the number of devices,
+# where looking devices up in the list of lsblk rows was quadratic, 1.4s for 2000 LUNs and rising
+RESCAN_BUDGET = 1.0
+SYNTHETIC_LUNS = 2000
+
+LSBLK_OUTPUTS = {name: value for name, value in vars(fixtures).items() if name.startswith("LSBLK_")}
+
+def pairs_to_json(output: str) -> str:
+    """ The `lsblk --json --tree` output of util-linux >= 2.33 for the same devices as an `lsblk --pairs` output. """
+    roots: list[dict[str, object]] = []
+    # the rows are the tree walked depth first: the branch to the current row
+    branch: list[dict[str, object]] = []
+    for line in output.strip().splitlines():
+        row: dict[str, object] = {k.lower(): v.strip('"') or None for k, v in re.findall(r'(\S+)=(".*?"|\S+)', line)}
+        row["size"] = int(str(row["size"]))
+        row["log-sec"] = int(str(row["log-sec"]))
+        while branch and branch[-1]["kname"] != row["pkname"]:
+            branch.pop()
+        if branch:
+            children = branch[-1].setdefault("children", [])
+            assert isinstance(children, list)
+            children.append(row)
+        else:
+            roots.append(row)
+        branch.append(row)
+    return json.dumps({"blockdevices": roots}, indent=3)
+
+def synthetic_lsblk(luns: int, paths: int = 4, volumes: int = 3) -> str:
+    """
+    `lsblk --pairs` output of a host with a local disk and `luns` multipath LUNs of `paths` paths each, every other
+    LUN holding an LVM SR of `volumes` volumes, as with lvmohba or lvmoiscsi SRs.
+    """
+    lines = ['NAME="nvme0n1" KNAME="nvme0n1" PKNAME="" SIZE="1000204886016" LOG-SEC="512" TYPE="disk" '
+             'MOUNTPOINT="" WWN="eui.0025388b91b4b9a1"']
+    for path in range(paths):
+        for lun in range(luns):
+            disk = f"sd{path}_{lun}"
+            mpath = f"3600a098038303053453f463045{lun:06x}"
+            lines.append(f'NAME="{disk}" KNAME="{disk}" PKNAME="" SIZE="{(lun + 1) << 30}" LOG-SEC="512" '
+                         f'TYPE="disk" MOUNTPOINT="" WWN="0x600a098038303053{lun:016x}"')
+            lines.append(f'NAME="{mpath}" KNAME="dm-{lun}" PKNAME="{disk}" SIZE="{(lun + 1) << 30}" LOG-SEC="512" '
+                         f'TYPE="mpath" MOUNTPOINT="" WWN=""')
+            for volume in range(volumes if lun % 2 else 0):
+                lines.append(f'NAME="VG_XenStorage--{lun}-{volume}" KNAME="dm-{luns + lun * volumes + volume}" '
+                             f'PKNAME="dm-{lun}" SIZE="4194304" LOG-SEC="512" TYPE="lvm" '
+                             f'MOUNTPOINT="" WWN=""')
+    return "\n".join(lines) + "\n"
+
+def _by_name(devices: list[Host.BlockDeviceInfo], name: str) -> Host.BlockDeviceInfo:
+    return next(d for d in devices if d.name == name)
+
+def _rescan(lsblk_output: str, host: MagicMock | None = None, device: str | None = None) -> MagicMock:
+    host = host or MagicMock(spec=Host)
+    host.ssh.return_value = lsblk_output
+    Host.rescan_block_devices_info(host, device)
+    return host
+
+@pytest.mark.parametrize("name", LSBLK_OUTPUTS)
+def test_json_same_as_pairs(name: str) -> None:
+    output = LSBLK_OUTPUTS[name]
+    assert _rescan(pairs_to_json(output)).block_devices_info == _rescan(output).block_devices_info
+
+def test_graph_has_each_device_once() -> None:
+    graph = BlockDeviceGraph.from_lsblk(fixtures.LSBLK_FULL)
+    assert graph.devices["dm-8"].parents == {"sdo", "sds", "sdi", "sda"}
+    assert graph.devices["dm-8"].children == {"dm-9"}
+    assert graph.wwns["0x600507638081046d"] == {"sdo", "sds", "sdi", "sda"}
+    assert graph.descendants("sdo") == ["sdo", "dm-8", "dm-9"]
+
+def test_refresh_device() -> None:
+    sdf = ('NAME="sdf" KNAME="sdf" PKNAME="" SIZE="21990232555520" LOG-SEC="512" TYPE="disk" MOUNTPOINT="" '
+           'WWN="0x6005076813810286"\n')
+    host = _rescan(fixtures.LSBLK_FULL)
+    full = host.block_devices_info
+    # the first path of a LUN without multipath gets a partition, which becomes a PV
+    sdf_lvm = sdf + ('NAME="sdf1" KNAME="sdf1" PKNAME="sdf" SIZE="21990232555520" LOG-SEC="512" TYPE="part" '
+                     'MOUNTPOINT="" WWN="0x6005076813810286"\n'
+                     'NAME="VG_XenStorage-1" KNAME="dm-10" PKNAME="sdf1" SIZE="21990232555520" LOG-SEC="512" '
+                     'TYPE="lvm" MOUNTPOINT="" WWN=""\n')
+    _rescan(pairs_to_json(sdf_lvm), host, "sdf")
+    assert "/dev/sdf" in host.ssh.call_args.args[0]
+    assert host.block_devices.descendants("sdf") == ["sdf", "sdf1", "dm-10"]
+    assert [d for d in host.block_devices_info if d.name != "sdf"] == [d for d in full if d.name != "sdf"]
+    assert not _by_name(host.block_devices_info, "sdf").available
+
+    _rescan(sdf, host, "sdf")
+    assert "dm-10" not in host.block_devices.devices
+    assert host.block_devices_info == full
+
+def test_refresh_multipath_path() -> None:
+    host = _rescan(fixtures.LSBLK_FULL)
+    full = host.block_devices_info
+    sdo = "".join(line + "\n" for line in fixtures.LSBLK_FULL.splitlines()[1:4])
+    # the path disappears: the multipath device is still built on the other paths
+    _rescan("", host, "sdo")
+    assert "sdo" not in host.block_devices.devices
+    assert host.block_devices.devices["dm-8"].parents == {"sds", "sdi", "sda"}
+    # the LUN is now listed through its next path
+    assert sorted(d.name for d in host.block_devices_info) == sorted(d.name.replace("sdo", "sds") for d in full)
+    # and comes back
+    _rescan(pairs_to_json(sdo), host, "sdo")
+    assert host.block_devices.devices["dm-8"].parents == {"sdo", "sds", "sdi", "sda"}
+    assert sorted(d.name for d in host.block_devices_info) == sorted(d.name for d in full)
+
+def test_refresh_multipath_device() -> None:
+    host = _rescan(fixtures.LSBLK_FULL)
+    # the SR on the multipath device is mounted: a tree rooted at dm-8 only lists one of its paths as PKNAME
+    dm8 = fixtures.LSBLK_FULL.splitlines()[2:4]
+    dm8[1] = dm8[1].replace('MOUNTPOINT=""', 'MOUNTPOINT="/run/sr-mount/aed646f9"')
+    _rescan(pairs_to_json("\n".join(dm8)), host, "dm-8")
+    assert host.block_devices.devices["dm-8"].parents == {"sdo", "sds", "sdi", "sda"}
+    assert not _by_name(host.block_devices_info, "dm-8").available
+
+@pytest.mark.parametrize("output_format", ["pairs", "json"])
+def test_rescan_many_multipath_luns(output_format: str) -> None:
+    output = synthetic_lsblk(SYNTHETIC_LUNS)
+    if output_format == "json":
+        output = pairs_to_json(output)
+    devices = _rescan(output).block_devices_info
+    mpaths = [d for d in devices if d.type == "mpath"]
+    assert len(mpaths) == SYNTHETIC_LUNS
+    assert sum(d.available for d in mpaths) == SYNTHETIC_LUNS // 2
+    # one entry per LUN for its paths, plus the local disk
+    disks = [d for d in devices if d.type == "disk"]
+    assert len(disks) == SYNTHETIC_LUNS + 1
+    assert [d.name for d in disks if d.available] == ["nvme0n1"]
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("output_format", ["pairs", "json"])
+def test_rescan_time(output_format: str) -> None:
+    output = synthetic_lsblk(SYNTHETIC_LUNS)
+    if output_format == "json":
+        output = pairs_to_json(output)
+    start = time.monotonic()
+    _rescan(output).block_devices_info
+    duration = time.monotonic() - start
+    assert duration <= RESCAN_BUDGET, f"rescan of {SYNTHETIC_LUNS} LUNs took {duration:.2f}s"
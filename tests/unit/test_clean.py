@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import pytest
+
+from unittest.mock import MagicMock
+
+import lib.tools.tasks.clean as clean
+from lib.common import parse_xe_records
+from lib.pool import Pool
+from lib.tools.tasks.clean import CleanupAction, clean_pool, plan_pool_cleanup
+
+from typing import Any, Callable
+
+LOCAL_SR = "local-sr"
+SHARED_SR = "shared-sr"
+
+# Output of `xe vm-list is-control-domain=false params=...`
+XE_VM_LIST = """\
+uuid ( RO)              : vm-running
+        name-label ( RW): running VM
+       power-state ( RO): running
+     is-a-template ( RW): false
+     is-a-snapshot ( RO): false
+
+
+uuid ( RO)              : vm-halted
+        name-label ( RW): halted VM
+       power-state ( RO): halted
+     is-a-template ( RW): false
+     is-a-snapshot ( RO): false
+
+
+uuid ( RO)              : snap
+        name-label ( RW): snapshot of running VM
+       power-state ( RO): halted
+     is-a-template ( RW): true
+     is-a-snapshot ( RO): true
+
+
+uuid ( RO)              : template
+        name-label ( RW): custom template
+       power-state ( RO): halted
+     is-a-template ( RW): true
+     is-a-snapshot ( RO): false
+"""
+
+def _records(records: list[dict[str, str]]) -> str:
+    """ The output of a xe *-list command with `params=...` for these records. """
+    return "\n\n\n".join("\n".join(f"{key} ( RO): {value}" for key, value in r.items()) for r in records) + "\n"
+
+class FakeMaster:
+    """ A pool master answering the xe commands of the cleanup from its objects. """
+
+    def __init__(self) -> None:
+        self.vms = parse_xe_records(XE_VM_LIST)
+        self.vbds = [
+            {"vm-uuid": "vm-running", "vdi-uuid": "vm-disk"},
+            {"vm-uuid": "vm-running", "vdi-uuid": "shared-disk"},
+            # a disk attached to two VMs is destroyed once
+            {"vm-uuid": "vm-halted", "vdi-uuid": "vm-disk"},
+            {"vm-uuid": "vm-halted", "vdi-uuid": "<not in database>"},
+            {"vm-uuid": "snap", "vdi-uuid": "snap-disk"},
+            {"vm-uuid": "template", "vdi-uuid": "template-disk"},
+            {"vm-uuid": "template", "vdi-uuid": "shared-template-disk"},
+        ]
+        self.srs = [{"uuid": LOCAL_SR, "shared": "false"}, {"uuid": SHARED_SR, "shared": "true"}]
+        self.vdis = [
+            {"uuid": "vm-disk", "name-label": "VM disk", "sr-uuid": LOCAL_SR, "is-a-snapshot": "false"},
+            {"uuid": "shared-disk", "name-label": "shared", "sr-uuid": SHARED_SR, "is-a-snapshot": "false"},
+            {"uuid": "snap-disk", "name-label": "snapshot", "sr-uuid": LOCAL_SR, "is-a-snapshot": "true"},
+            {"uuid": "template-disk", "name-label": "template", "sr-uuid": LOCAL_SR, "is-a-snapshot": "false"},
+            {"uuid": "shared-template-disk", "name-label": "template", "sr-uuid": SHARED_SR,
+             "is-a-snapshot": "false"},
+            {"uuid": "orphan", "name-label": "orphan", "sr-uuid": LOCAL_SR, "is-a-snapshot": "false"},
+            {"uuid": "orphan-snap", "name-label": "orphan snapshot", "sr-uuid": LOCAL_SR, "is-a-snapshot": "true"},
+            {"uuid": "shared-orphan", "name-label": "orphan", "sr-uuid": SHARED_SR, "is-a-snapshot": "false"},
+        ]
+        self.calls: list[tuple[str, str]] = []
+
+    def xe(self, action: str, args: dict[str, Any] = {}, *, minimal: bool = False, **kwargs: Any) -> str:
+        if action == "vm-list":
+            return _records(self.vms)
+        if action == "vbd-list":
+            return _records(self.vbds)
+        if action == "sr-list":
+            return _records(self.srs)
+        if action == "vdi-list" and minimal:
+            return ",".join(vdi["sr-uuid"] for vdi in self.vdis)
+        if action == "vdi-list":
+            return _records(self.vdis)
+        self.calls.append((action, args["uuid"]))
+        if action == "vdi-destroy":
+            self.vdis = [vdi for vdi in self.vdis if vdi["uuid"] != args["uuid"]]
+        elif action == "vm-destroy":
+            self.vms = [vm for vm in self.vms if vm["uuid"] != args["uuid"]]
+        return ""
+
+def _pool(master: FakeMaster) -> MagicMock:
+    pool = MagicMock(spec=Pool)
+    pool.master = master
+    return pool
+
+def test_parse_xe_records() -> None:
+    records = parse_xe_records(XE_VM_LIST)
+    assert [r["uuid"] for r in records] == ["vm-running", "vm-halted", "snap", "template"]
+    assert records[0] == {"uuid": "vm-running", "name-label": "running VM", "power-state": "running",
+                          "is-a-template": "false", "is-a-snapshot": "false"}
+    # map parameters, empty values, and values with colons
+    assert parse_xe_records(
+        "uuid ( RO)            : a\n"
+        "     other-config (MRW): key: value; other: 1\n"
+        "       name-label ( RW): \n"
+    ) == [{"uuid": "a", "other-config": "key: value; other: 1", "name-label": ""}]
+    assert parse_xe_records("") == []
+    assert parse_xe_records("\n\n") == []
+
+def test_plan_pool_cleanup() -> None:
+    stages = plan_pool_cleanup(_pool(FakeMaster()))
+    assert stages == [
+        [CleanupAction("snapshot", "snap", "snapshot of running VM", vdi_uuids=["snap-disk"])],
+        [
+            CleanupAction("VM", "vm-running", "running VM", shutdown=True, vdi_uuids=["vm-disk", "shared-disk"]),
+            CleanupAction("VM", "vm-halted", "halted VM"),
+        ],
+        [CleanupAction("VDI", "orphan-snap", "orphan snapshot", vdi_uuids=["orphan-snap"])],
+        # the templates are kept, not their disks on local SRs
+        [
+            CleanupAction("VDI", "template-disk", "template", vdi_uuids=["template-disk"]),
+            CleanupAction("VDI", "orphan", "orphan", vdi_uuids=["orphan"]),
+        ],
+    ]
+
+def test_clean_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+    def wait_for_not(fn: Callable[[], bool], msg: str | None = None) -> None:
+        # no VDI is left on local SRs once the cleanup is done
+        assert not fn(), msg
+    monkeypatch.setattr(clean, "wait_for_not", wait_for_not)
+    master = FakeMaster()
+
+    assert clean_pool(_pool(master), dry_run=True) == 0
+    assert not master.calls
+
+    assert clean_pool(_pool(master), dry_run=False, jobs=2) == 0
+    # the snapshot is destroyed before its VM, the orphan VDI snapshot before the other VDIs
+    assert master.calls[:2] == [("vdi-destroy", "snap-disk"), ("vm-destroy", "snap")]
+    assert master.calls[-3:-2] == [("vdi-destroy", "orphan-snap")]
+    assert [vm["uuid"] for vm in master.vms] == ["template"]
+    assert [vdi["uuid"] for vdi in master.vdis] == ["shared-template-disk", "shared-orphan"]
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from unittest.mock import MagicMock
+
+from lib.cpu_policy import (
+    NO_SUBLEAF,
+    CpuidDifference,
+    CpuidRegisters,
+    CpuPolicy,
+    HostCpuPolicy,
+    MsrDifference,
+    diff_cpu_policies,
+)
+from lib.host import Host
+
+# Output of `xen-cpuid -p`, trimmed
+XEN_CPUID_POLICY = """\
+Raw policy: 4 leaves, 2 MSRs
+ CPUID:
+  leaf     subleaf  -> eax      ebx      ecx      edx
+  00000000:ffffffff -> 0000000d:756e6547:6c65746e:49656e69
+  00000001:ffffffff -> 000906ea:00100800:7ffafbff:bfebfbff
+  00000004:00000000 -> 1c004121:01c0003f:0000003f:00000000
+  00000004:00000001 -> 1c004122:01c0003f:0000003f:00000000
+ MSRs:
+  index    -> value
+  000000ce -> 0000000080000000
+  0000010a -> 000000000c000c6b
+Host policy: 3 leaves, 1 MSRs
+ CPUID:
+  leaf     subleaf  -> eax      ebx      ecx      edx
+  00000001:ffffffff -> 000906ea:00100800:77fafbff:bfebfbff
+  00000000:ffffffff -> 0000000d:756e6547:6c65746e:49656e69
+  00000007:00000000 -> 00000000:009c6fbd:00000000:9c000400
+ MSRs:
+  index    -> value
+  0000010a -> 000000000c000c6b
+PV Default policy: 0 leaves, 0 MSRs
+ CPUID:
+  leaf     subleaf  -> eax      ebx      ecx      edx
+ MSRs:
+  index    -> value
+"""
+
+def _host_policy(output: str) -> HostCpuPolicy:
+    host = MagicMock(spec=Host)
+    host.ssh.return_value = output
+    return HostCpuPolicy(host)
+
+def test_parse_host_policies() -> None:
+    policies = _host_policy(XEN_CPUID_POLICY).policies
+    assert list(policies) == ["Raw", "Host", "PV Default"]
+
+    raw = policies["Raw"]
+    assert raw.cpuid == {
+        (0, NO_SUBLEAF): CpuidRegisters(0x0000000d, 0x756e6547, 0x6c65746e, 0x49656e69),
+        (1, NO_SUBLEAF): CpuidRegisters(0x000906ea, 0x00100800, 0x7ffafbff, 0xbfebfbff),
+        (4, 0): CpuidRegisters(0x1c004121, 0x01c0003f, 0x0000003f, 0),
+        (4, 1): CpuidRegisters(0x1c004122, 0x01c0003f, 0x0000003f, 0),
+    }
+    assert raw.msr == {0xce: 0x80000000, 0x10a: 0xc000c6b}
+    # leaves are sorted, whatever their order in the output
+    assert list(policies["Host"].cpuid) == [(0, NO_SUBLEAF), (1, NO_SUBLEAF), (7, 0)]
+    assert not policies["PV Default"].cpuid and not policies["PV Default"].msr
+
+def test_parse_matches_constructor() -> None:
+    cpuid = {(7, 0): CpuidRegisters(1, 2, 3, 4), (1, NO_SUBLEAF): CpuidRegisters(5, 6, 7, 8)}
+    policy = CpuPolicy.parse("00000007:00000000 -> 00000001:00000002:00000003:00000004\n"
+                             "00000001:ffffffff -> 00000005:00000006:00000007:00000008\n"
+                             "00000010 -> 0000000000000001\n")
+    assert policy.cpuid == CpuPolicy(cpuid, {0x10: 1}).cpuid
+    assert policy.msr == {0x10: 1}
+    assert not policy.diff(CpuPolicy(cpuid, {0x10: 1}))
+
+def test_policy_diff() -> None:
+    policies = _host_policy(XEN_CPUID_POLICY).policies
+    diff = policies["Raw"].diff(policies["Host"])
+    registers = ("eax", "ebx", "ecx", "edx")
+    assert diff.cpuid == [
+        CpuidDifference(1, NO_SUBLEAF, "ecx", 0x7ffafbff, 0x77fafbff),
+        *(CpuidDifference(4, 0, r, v, None) for r, v in zip(registers, (0x1c004121, 0x01c0003f, 0x3f, 0))),
+        *(CpuidDifference(4, 1, r, v, None) for r, v in zip(registers, (0x1c004122, 0x01c0003f, 0x3f, 0))),
+        *(CpuidDifference(7, 0, r, None, v) for r, v in zip(registers, (0, 0x009c6fbd, 0, 0x9c000400))),
+    ]
+    assert diff.msr == [MsrDifference(0xce, 0x80000000, None)]
+    assert not policies["Raw"].diff(policies["Raw"])
+
+def test_diff_cpu_policies() -> None:
+    reference = _host_policy(XEN_CPUID_POLICY)
+    same = _host_policy(XEN_CPUID_POLICY)
+    other = _host_policy(XEN_CPUID_POLICY.replace("0000010a -> 000000000c000c6b\nPV",
+                                                  "0000010a -> 000000000c000c6f\nPV"))
+    diffs = diff_cpu_policies([reference, same, other])
+    # only the hosts with differences, and only their differing policies
+    assert list(diffs) == [other.host]
+    assert list(diffs[other.host]) == ["Host"]
+    assert diffs[other.host]["Host"].msr == [MsrDifference(0x10a, 0xc000c6b, 0xc000c6f)]
+    assert not diffs[other.host]["Host"].cpuid
+    # a policy missing on the other host differs by all its entries
+    missing = _host_policy(XEN_CPUID_POLICY.split("Host policy")[0])
+    assert list(diff_cpu_policies([reference, missing], names=["Host"])[missing.host]) == ["Host"]
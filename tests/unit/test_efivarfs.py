@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import pytest
+
+import os
+import subprocess
+import tarfile
+from pathlib import Path
+
+import lib.efi as efi
+from lib.efi import EFI_AT_ATTRS_BYTES, GUID, EfiVariable, global_variable_guid, image_security_database_guid
+
+GLOBAL = global_variable_guid.as_str()
+IMAGE_SECURITY = image_security_database_guid.as_str()
+
+def test_parse_efivarfs_dump() -> None:
+    output = (
+        f"PK-{GLOBAL} 2700000001020304\n"
+        "\n"
+        f"db-{IMAGE_SECURITY} 07000000\n"
+        # names can contain dashes, the GUID is always the last 36 characters
+        f"Boot-Order-{GLOBAL} 0600000000000100\n"
+    )
+    assert efi.parse_efivarfs_dump(output) == {
+        ("PK", global_variable_guid): EfiVariable(b"\x27\0\0\0", b"\x01\x02\x03\x04"),
+        ("db", image_security_database_guid): EfiVariable(b"\x07\0\0\0", b""),
+        ("Boot-Order", global_variable_guid): EfiVariable(b"\x06\0\0\0", b"\0\0\x01\0"),
+    }
+
+@pytest.fixture
+def efivarfs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """ A directory standing for efivarfs, with a `chattr` logging the files it is called on, in order. """
+    efivars = tmp_path / "efivars"
+    efivars.mkdir()
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    chattr = bin_dir / "chattr"
+    chattr.write_text(f'#!/bin/sh\necho "$2" >> {tmp_path / "chattr.log"}\n')
+    chattr.chmod(0o755)
+    monkeypatch.setattr(efi, "EFIVARFS_DIR", str(efivars))
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return efivars
+
+def _apply(tmp_path: Path, changes: dict[tuple[str, GUID], EfiVariable | None]) -> str:
+    archive = tmp_path / "efivars.tar"
+    remote_archive = tmp_path / "remote.tar"
+    script = efi.write_efivarfs_changes(changes, str(archive), str(remote_archive))
+    archive.rename(remote_archive)
+    subprocess.run(["sh", "-c", script], check=True)
+    assert not remote_archive.exists()
+    return script
+
+def test_write_efivarfs_changes_archive(tmp_path: Path) -> None:
+    archive = tmp_path / "efivars.tar"
+    efi.write_efivarfs_changes({
+        ("PK", global_variable_guid): EfiVariable(EFI_AT_ATTRS_BYTES, b"pk"),
+        ("KEK", global_variable_guid): None,
+    }, str(archive), "/tmp/remote.tar")
+    with tarfile.open(archive) as tar:
+        # deleted variables are not in the archive
+        assert tar.getnames() == [f"PK-{GLOBAL}"]
+        member = tar.extractfile(f"PK-{GLOBAL}")
+        assert member is not None
+        assert member.read() == EFI_AT_ATTRS_BYTES + b"pk"
+
+def test_write_efivarfs_changes_in_order(tmp_path: Path, efivarfs: Path) -> None:
+    for name in ["PK", "KEK", "db"]:
+        (efivarfs / f"{name}-{GLOBAL}").write_bytes(b"old")
+    changes: dict[tuple[str, GUID], EfiVariable | None] = {
+        ("db", global_variable_guid): None,
+        ("PK", global_variable_guid): EfiVariable(EFI_AT_ATTRS_BYTES, b"new PK"),
+        ("KEK", global_variable_guid): None,
+        ("dbx", global_variable_guid): EfiVariable(EFI_AT_ATTRS_BYTES, b"new dbx"),
+    }
+    script = _apply(tmp_path, changes)
+    assert script.splitlines()[-4:] == [f"delete db-{GLOBAL}", f"write PK-{GLOBAL}", f"delete KEK-{GLOBAL}",
+                                        f"write dbx-{GLOBAL}"]
+    # chattr is only called on the existing files, in the order of the changes
+    assert (tmp_path / "chattr.log").read_text().split() == [f"db-{GLOBAL}", f"PK-{GLOBAL}", f"KEK-{GLOBAL}"]
+    assert sorted(os.listdir(efivarfs)) == [f"PK-{GLOBAL}", f"dbx-{GLOBAL}"]
+    assert (efivarfs / f"PK-{GLOBAL}").read_bytes() == EFI_AT_ATTRS_BYTES + b"new PK"
+
+def test_write_efivarfs_changes_stops_at_first_failure(tmp_path: Path, efivarfs: Path) -> None:
+    # a directory can't be written as a file, as efivarfs refuses writes with a bad signature
+    (efivarfs / f"PK-{GLOBAL}").mkdir()
+    changes: dict[tuple[str, GUID], EfiVariable | None] = {
+        ("PK", global_variable_guid): EfiVariable(EFI_AT_ATTRS_BYTES, b"bad PK"),
+        ("KEK", global_variable_guid): EfiVariable(EFI_AT_ATTRS_BYTES, b"KEK"),
+    }
+    with pytest.raises(subprocess.CalledProcessError):
+        _apply(tmp_path, changes)
+    assert not (efivarfs / f"KEK-{GLOBAL}").exists()
+
+def test_efivarfs_dump_round_trip(tmp_path: Path, efivarfs: Path) -> None:
+    changes: dict[tuple[str, GUID], EfiVariable | None] = {
+        ("PK", global_variable_guid): EfiVariable(EFI_AT_ATTRS_BYTES, bytes(range(256))),
+        ("db", image_security_database_guid): EfiVariable(EFI_AT_ATTRS_BYTES, b""),
+    }
+    _apply(tmp_path, changes)
+    output = subprocess.run(["sh", "-c", efi.efivarfs_dump_cmd()], check=True, capture_output=True, text=True)
+    assert efi.parse_efivarfs_dump(output.stdout) == changes
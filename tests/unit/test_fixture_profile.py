@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import pytest
+
+from pathlib import Path
+
+from lib.commands import count_remote_call
+from lib.fixture_profile import FixtureProfiler
+
+pytest_plugins = ["pytester"]
+
+TESTS = """
+import pytest
+import time
+
+from lib.commands import count_remote_call
+
+@pytest.fixture(scope="module", params=["vhd", "qcow2"])
+def image_format(request):
+    return request.param
+
+@pytest.fixture(scope="module")
+def sr(image_format):
+    count_remote_call()
+    time.sleep(0.05)
+    yield
+    count_remote_call()
+    count_remote_call()
+
+@pytest.fixture(scope="module")
+def vm(sr):
+    time.sleep(0.1)
+
+@pytest.mark.parametrize("i", [1, 2])
+def test_a(vm, i):
+    time.sleep(0.02)
+"""
+
+def test_profile(pytester: pytest.Pytester, tmp_path: Path) -> None:
+    count_remote_call()  # calls before the run aren't counted
+    pytester.makepyfile(test_x=TESTS)
+    profile = tmp_path / "profile.folded"
+    profiler = FixtureProfiler(str(profile))
+    result = pytester.runpytest_inprocess(plugins=[profiler])
+    result.assert_outcomes(passed=4)
+
+    sr = profiler.fixtures[("sr", "test_x.py")]
+    assert (sr.instantiations, sr.rebuilds, sr.remote_calls) == (2, 1, 6)
+    assert dict(sr.rebuild_causes) == {"image_format": 1}
+    assert sr.setup >= 0.1 and sr.teardown < 0.05
+    vm = profiler.fixtures[("vm", "test_x.py")]
+    # without the setup time of sr
+    assert 0.2 <= vm.setup < 0.3
+    assert vm.remote_calls == 0
+    result.stdout.fnmatch_lines(["*fixture profile*", "*  sr (module, test_x.py) rebuilt for: image_format (1)"])
+
+    stacks = dict(line.rsplit(" ", 1) for line in profile.read_text().splitlines())
+    root = f"session;{pytester.path.name};test_x.py"
+    # both instantiations
+    assert 200 <= int(stacks[f"{root};setup vm"]) < 300
+    assert 100 <= int(stacks[f"{root};setup sr"]) < 200
+    assert 20 <= int(stacks[f"{root};test_a[vhd-1];call"]) < 100
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import pytest
+
+from pathlib import Path
+
+from lib import history
+from lib.history import TestHistory, TestHistoryPlugin, TestStats, base_nodeid
+
+pytest_plugins = ["pytester"]
+
+TESTS = """
+import pytest
+import time
+
+@pytest.fixture(scope="module")
+def slow_fixture():
+    yield
+    time.sleep(0.05)
+
+def test_a(slow_fixture):
+    pass
+
+@pytest.mark.parametrize("i", [1, 2])
+def test_b(i):
+    assert i == 1
+"""
+
+def run(pytester: pytest.Pytester, path: Path, *args: str) -> pytest.RunResult:
+    plugin = TestHistoryPlugin(str(path))
+    result = pytester.runpytest_inprocess(*args, plugins=[plugin])
+    plugin.pytest_unconfigure()
+    return result
+
+# ---------------------------------------------------------------------------
+# TestHistory
+# ---------------------------------------------------------------------------
+
+def test_base_nodeid() -> None:
+    assert base_nodeid("tests/a/test_a.py::TestA::test_a[vhd-1]") == "tests/a/test_a.py::TestA::test_a"
+    assert base_nodeid("tests/a/test_a.py::test_a") == "tests/a/test_a.py::test_a"
+
+def test_stats(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(history, "HISTORY_DEPTH", 3)
+    db = TestHistory(str(tmp_path / "history.sqlite"))
+    for duration, outcome in [(100, "failed"), (1, "passed"), (2, "failed"), (3, "passed"), (50, "skipped")]:
+        run = db.start_run([])
+        db.record_test(run, "test_a.py::test_a[1]", 0.5, duration, 0.5, outcome)
+        db.record_test(run, "test_a.py::test_a[2]", 0, 10, 0, "passed")
+    stats = db.test_stats()
+    # only the last 3 runs that weren't skipped
+    assert stats["test_a.py::test_a[1]"] == TestStats(3.0, 3, 1)
+    assert stats["test_a.py::test_a[1]"].failure_rate == pytest.approx(1 / 3)
+    assert db.base_durations() == {"test_a.py::test_a": 13.0}
+    db.close()
+
+# ---------------------------------------------------------------------------
+# TestHistoryPlugin
+# ---------------------------------------------------------------------------
+
+def test_record(pytester: pytest.Pytester, tmp_path: Path) -> None:
+    pytester.makepyfile(test_x=TESTS)
+    path = tmp_path / "history.sqlite"
+    run(pytester, path).assert_outcomes(passed=2, failed=1)
+
+    db = TestHistory(str(path))
+    outcomes = dict(db.db.execute("SELECT nodeid, outcome FROM tests"))
+    assert outcomes == {"test_x.py::test_a": "passed", "test_x.py::test_b[1]": "passed",
+                        "test_x.py::test_b[2]": "failed"}
+    (setup, teardown), = db.db.execute("SELECT setup, teardown FROM fixtures WHERE name = 'slow_fixture'")
+    assert setup < 0.05 <= teardown
+    db.close()
+
+    # the second run predicts its duration from the first one
+    result = run(pytester, path)
+    result.stdout.fnmatch_lines(["predicted duration: 0:00:00 (3/3 tests with history)"])
+
+class OrderPlugin:
+    def __init__(self, plugin: TestHistoryPlugin, order: str):
+        self.plugin = plugin
+        self.order = order
+
+    def pytest_collection_modifyitems(self, items: list[pytest.Item]) -> None:
+        # all the tests are in the same package
+        items[:] = self.plugin.order_packages([items], self.order)[0]
+
+@pytest.mark.parametrize("order,expected", [
+    ("collection", ["test_1.py::test_slow", "test_2.py::test_flaky", "test_3.py::test_fast"]),
+    ("cheap-first", ["test_3.py::test_fast", "test_2.py::test_flaky", "test_1.py::test_slow"]),
+    ("flaky-first", ["test_2.py::test_flaky", "test_1.py::test_slow", "test_3.py::test_fast"]),
+])
+def test_order(pytester: pytest.Pytester, tmp_path: Path, order: str, expected: list[str]) -> None:
+    pytester.makepyfile(
+        test_1="import time\ndef test_slow():\n    time.sleep(0.2)\n",
+        test_2="import time\ndef test_flaky():\n    time.sleep(0.1)\n    assert False\n",
+        test_3="def test_fast():\n    pass\n",
+    )
+    path = tmp_path / "history.sqlite"
+    run(pytester, path)
+
+    plugin = TestHistoryPlugin(str(path))
+    result = pytester.runpytest_inprocess("--collect-only", "-q", plugins=[plugin, OrderPlugin(plugin, order)])
+    assert [line for line in result.outlines if "::" in line] == expected
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import pytest
+
+import os
+import subprocess
+import sys
+
+# Modules slow to import, which must only be loaded by the code that needs them
+HEAVY_MODULES = ["cryptography", "git", "passlib", "pydantic", "requests"]
+# Cumulative import time budget, in microseconds, as measured by `python -X importtime`
+IMPORT_TIME_BUDGETS = {
+    "lib.pool": 300_000,
+    "lib.tools.cli": 400_000,
+    "conftest": 800_000,
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# User configuration files, which may import anything
+USER_MODULES = ["data", "vm_data"]
+
+def import_times(module: str) -> list[tuple[str, int, int]]:
+    """
+    Import `module` in a new interpreter, and return the name, nesting level and cumulative import time of each
+    module it loaded, in the order of `python -X importtime`: a module comes after the modules it imported.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = []
+    # Example: "import time:       369 |     117436 |   lib.pool"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times.append((name.strip(), len(name) - len(name.lstrip()), int(cumulative)))
+    return times
+
+def loaded_modules(module: str) -> set[str]:
+    """ The top-level packages loaded when importing `module`, except the ones loaded by user modules. """
+    loaded = set()
+    user_module_level = None
+    for name, level, _ in reversed(import_times(module)):
+        if user_module_level is not None and level > user_module_level:
+            continue
+        user_module_level = level if name in USER_MODULES else None
+        loaded.add(name.split(".")[0])
+    return loaded
+
+@pytest.mark.parametrize("module", IMPORT_TIME_BUDGETS)
+def test_heavy_modules_are_lazy(module: str) -> None:
+    assert not loaded_modules(module) & set(HEAVY_MODULES)
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("module,budget", IMPORT_TIME_BUDGETS.items())
+def test_import_time_budget(module: str, budget: int) -> None:
+    # best of 3, to ignore the cold start of the first run
+    times = min(
+        ({name: cumulative for name, _, cumulative in import_times(module)} for _ in range(3)),
+        key=lambda t: t[module],
+    )
+    slowest = sorted(times.items(), key=lambda item: -item[1])[:10]
+    assert times[module] <= budget, f"import {module} took {times[module]}us, slowest modules: {slowest}"
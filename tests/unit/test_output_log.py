@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import pytest
+
+import gzip
+import logging
+from pathlib import Path
+
+import lib.config as config
+from lib import commands
+from lib.commands import _ellide_log_lines, local_cmd
+
+# the output of `seq 100000`
+OUTPUT = "".join(f"{i}\n" for i in range(1, 100_001))
+
+@pytest.fixture
+def output_log_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(config, "ssh_output_log_dir", str(tmp_path))
+    return tmp_path
+
+def test_ellide_log_lines(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "ssh_output_max_lines", 3)
+    assert _ellide_log_lines(b"") == ""
+    assert _ellide_log_lines(b"a\nb\nc\n") == "\na\nb\nc"
+    assert _ellide_log_lines(b"a\nb\nc\nd\n", "log.gz") == "\na\nb\n(...)\n(full output in log.gz)"
+    monkeypatch.setattr(config, "ssh_output_max_lines", 0)
+    assert _ellide_log_lines(b"a\nb\nc\nd") == "\na\nb\nc\nd"
+
+def test_output_log(output_log_dir: Path, caplog: pytest.LogCaptureFixture) -> None:
+    with caplog.at_level(logging.DEBUG):
+        local_cmd(["seq", "100000"])
+        local_cmd(["echo", "second"])
+    # named after the current test
+    log = output_log_dir / "local" / "tests_unit_test_output_log.py_test_output_log.log.gz"
+    # one gzip member per command
+    lines = gzip.decompress(log.read_bytes()).decode().splitlines()
+    assert lines[0].endswith("seq 100000 (exit code 0)")
+    assert lines[1:100_001] == OUTPUT.splitlines()
+    assert lines[-2].endswith("echo second (exit code 0)") and lines[-1] == "second"
+    # only a summary in the debug log
+    assert len(caplog.text) < 10_000
+    assert f"(full output in {log})" in caplog.text
+
+def test_no_work_when_disabled(monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture) -> None:
+    def fail(*args: object) -> str:
+        raise AssertionError("the output should not be processed")
+    monkeypatch.setattr(commands, "_ellide_log_lines", fail)
+    caplog.set_level(logging.INFO)
+    assert local_cmd(["seq", "100000"]).stdout == OUTPUT
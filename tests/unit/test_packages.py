@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import pytest
+
+from pathlib import Path
+
+from lib.tools.packages import PackageInventory, PackageTable
+
+from typing import TYPE_CHECKING, cast
+
+if TYPE_CHECKING:
+    from lib.host import Host
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+class FakeHost:
+    """A host answering the inventory command, with a checksum that changes with its packages."""
+
+    def __init__(self, hostname_or_ip: str, packages: list[str]):
+        self.hostname_or_ip = hostname_or_ip
+        self.packages = packages
+        self.listed = 0
+
+    def __repr__(self) -> str:
+        return self.hostname_or_ip
+
+    def ssh(self, cmd: str) -> str:
+        checksum = f"{hash(tuple(self.packages)) & 0xffffffff:032x}"
+        if cmd.startswith("repoquery"):
+            return "\n".join(p for p in ALL_PACKAGES if not p.startswith("gpg-pubkey-"))
+        if f"!= '{checksum}'" in cmd:
+            return checksum
+        self.listed += 1
+        return "\n".join([checksum] + [f"{p.split('-')[0]} {p}" for p in self.packages])
+
+def host(name: str, packages: list[str]) -> Host:
+    return cast("Host", FakeHost(name, packages))
+
+ALL_PACKAGES = ["bash-0:5.1-1.x86_64", "kernel-0:4.19-1.x86_64", "xapi-0:25.1-1.x86_64"]
+BASE = ["bash-0:5.1-1.x86_64", "gpg-pubkey-0:abc-1.(none)", "kernel-0:4.19-1.x86_64"]
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+def test_table() -> None:
+    table = PackageTable()
+    a = table.add([("bash", "bash-0:5.1-1.x86_64"), ("kernel", "kernel-0:4.19-1.x86_64")])
+    b = table.add([("kernel", "kernel-0:4.19-1.x86_64"), ("xapi", "xapi-0:25.1-1.x86_64")])
+    # each package is stored once
+    assert len(table.nevras) == 3
+    assert table.packages(a & b) == ["kernel-0:4.19-1.x86_64"]
+    assert table.packages(a & ~b) == ["bash-0:5.1-1.x86_64"]
+    assert table.package_names(a | b) == ["bash", "kernel", "xapi"]
+    assert table.lookup(["xapi-0:25.1-1.x86_64", "unknown-0:1-1.noarch"]) == b & ~a
+
+def test_set_algebra() -> None:
+    inventory = PackageInventory()
+    h1, h2 = host("h1", BASE), host("h2", BASE + ["xapi-0:25.1-1.x86_64"])
+    before = inventory.collect([h1, h2])
+    assert inventory.table.packages(inventory.common(list(before.values()))) == [
+        "bash-0:5.1-1.x86_64", "kernel-0:4.19-1.x86_64"
+    ]
+    assert {h: inventory.table.packages(p) for h, p in inventory.differences(before).items()} == {
+        h2: ["xapi-0:25.1-1.x86_64"]
+    }
+
+    cast(FakeHost, h1).packages = ["bash-0:5.1-1.x86_64", "kernel-0:4.19-2.x86_64"]
+    after = inventory.collect([h1, h2])
+    assert {h: inventory.table.packages(p) for h, p in inventory.changed(before, after).items()} == {
+        h1: ["kernel-0:4.19-2.x86_64"], h2: []
+    }
+    available = inventory.available(h1)
+    assert {h: inventory.table.packages(p) for h, p in inventory.unavailable(after, available).items()} == {
+        h1: ["kernel-0:4.19-2.x86_64"]
+    }
+
+@pytest.mark.parametrize("persistent", [False, True])
+def test_cache(tmp_path: Path, persistent: bool) -> None:
+    cache_dir = tmp_path / "packages" if persistent else None
+    h1, h2 = FakeHost("h1", BASE), FakeHost("h2", BASE)
+    hosts = [cast("Host", h) for h in (h1, h2)]
+    inventory = PackageInventory(cache_dir)
+    inventory.collect(hosts)
+    assert (h1.listed, h2.listed, inventory.fetched) == (1, 1, 2)
+
+    # only the hosts whose packages changed list them again
+    h2.packages = BASE + ["xapi-0:25.1-1.x86_64"]
+    if persistent:
+        inventory = PackageInventory(cache_dir)
+    packages = inventory.collect(hosts)
+    assert (h1.listed, h2.listed) == (1, 2)
+    assert inventory.table.packages(packages[hosts[0]]) == sorted(BASE)
+    assert inventory.table.packages(packages[hosts[1]]) == sorted(h2.packages)
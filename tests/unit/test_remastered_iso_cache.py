@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import pytest
+
+import os
+from pathlib import Path
+
+from lib.installer import cached_remastered_iso, remastered_iso_cache_key, store_remastered_iso
+
+@pytest.fixture
+def sources(tmp_path: Path) -> tuple[Path, Path, Path]:
+    """ A source ISO, an iso-remaster tool, and a working directory with an answerfile referencing it. """
+    iso = tmp_path / "source.iso"
+    iso.write_bytes(b"iso")
+    tool = tmp_path / "iso-remaster"
+    tool.write_bytes(b"tool")
+    workdir = tmp_path / "work1"
+    workdir.mkdir()
+    (workdir / "answerfile.xml").write_text(f"<installation><script>{workdir}/post.sh</script></installation>")
+    return iso, tool, workdir
+
+def _key(iso: Path, tool: Path, workdir: Path) -> str:
+    inputs = [str(workdir / "answerfile.xml"), str(workdir / "patcher.sh")]
+    return remastered_iso_cache_key(str(iso), str(tool), inputs, str(workdir))
+
+def test_key_ignores_workdir(sources: tuple[Path, Path, Path], tmp_path: Path) -> None:
+    iso, tool, workdir = sources
+    other_workdir = tmp_path / "work2"
+    other_workdir.mkdir()
+    (other_workdir / "answerfile.xml").write_text(
+        (workdir / "answerfile.xml").read_text().replace(str(workdir), str(other_workdir)))
+    assert _key(iso, tool, workdir) == _key(iso, tool, workdir)
+    assert _key(iso, tool, workdir) == _key(iso, tool, other_workdir)
+
+def test_key_depends_on_inputs(sources: tuple[Path, Path, Path]) -> None:
+    iso, tool, workdir = sources
+    keys = {_key(iso, tool, workdir)}
+
+    # an empty input is not the same as a missing one
+    (workdir / "patcher.sh").write_text("")
+    keys.add(_key(iso, tool, workdir))
+    (workdir / "patcher.sh").write_text("echo patched")
+    keys.add(_key(iso, tool, workdir))
+    (workdir / "answerfile.xml").write_text("<installation/>")
+    keys.add(_key(iso, tool, workdir))
+    # the source ISO and the tool are identified by size and modification time, not content
+    st = iso.stat()
+    os.utime(iso, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    keys.add(_key(iso, tool, workdir))
+    tool.write_bytes(b"new tool")
+    keys.add(_key(iso, tool, workdir))
+    assert len(keys) == 6
+
+def _store(cache: Path, tmp_path: Path, key: str, size: int, max_size: int, mtime: int) -> str:
+    iso = tmp_path / f"{key}.src"
+    iso.write_bytes(b"x" * size)
+    cached = store_remastered_iso(str(cache), key, str(iso), max_size)
+    os.utime(cached, (mtime, mtime))
+    return cached
+
+def test_cached_remastered_iso(tmp_path: Path) -> None:
+    cache = tmp_path / "cache"
+    assert cached_remastered_iso(str(cache), "a") is None
+    cached = _store(cache, tmp_path, "a", 10, 100, mtime=1000)
+    assert cached == str(cache / "a.iso")
+    assert Path(cached).read_bytes() == b"x" * 10
+    # a hit marks the ISO as recently used
+    assert cached_remastered_iso(str(cache), "a") == cached
+    assert os.stat(cached).st_mtime > 1000
+    # no temporary file is left
+    assert os.listdir(cache) == ["a.iso"]
+
+def test_eviction_order_and_size(tmp_path: Path) -> None:
+    cache = tmp_path / "cache"
+    _store(cache, tmp_path, "a", 40, 100, mtime=1000)
+    _store(cache, tmp_path, "b", 30, 100, mtime=3000)
+    _store(cache, tmp_path, "c", 20, 100, mtime=2000)
+    assert sorted(os.listdir(cache)) == ["a.iso", "b.iso", "c.iso"]
+
+    # 40 + 30 + 20 + 25 > 100: the least recently used ISO is evicted, not the largest or the oldest stored
+    _store(cache, tmp_path, "d", 25, 100, mtime=4000)
+    assert sorted(os.listdir(cache)) == ["b.iso", "c.iso", "d.iso"]
+
+    # files which are not cached ISOs neither count nor get evicted
+    (cache / ".e.part").write_bytes(b"x" * 1000)
+    # 30 + 20 + 25 + 60 > 100: evict until the total fits, c then b
+    _store(cache, tmp_path, "e", 60, 100, mtime=5000)
+    assert sorted(os.listdir(cache)) == [".e.part", "d.iso", "e.iso"]
+
+def test_eviction_keeps_new_iso(tmp_path: Path) -> None:
+    cache = tmp_path / "cache"
+    _store(cache, tmp_path, "a", 40, 100, mtime=1000)
+    # an ISO larger than the cache is still returned, evicting all the others
+    cached = _store(cache, tmp_path, "b", 150, 100, mtime=500)
+    assert os.listdir(cache) == ["b.iso"]
+    assert os.path.getsize(cached) == 150
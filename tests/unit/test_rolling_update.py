@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import pytest
+
+import argparse
+import json
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from lib.host import Host
+from lib.pool import Pool
+from lib.tools.cli import _positive_int
+from lib.tools.inventory import HostConfig
+from lib.tools.tasks.update import UpdateProgress, _rolling_update_pool
+
+from typing import cast
+
+CONFIG = cast(HostConfig, {"repositories": [], "disabled_repositories": []})
+
+class Events:
+    """The updates and reboots of hosts, in the order they happen."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.events: list[tuple[str, str]] = []
+
+    def add(self, event: str, host: str) -> None:
+        with self.lock:
+            self.events.append((event, host))
+
+    def of(self, event: str) -> list[str]:
+        return [h for e, h in self.events if e == event]
+
+def _pool(names: list[str], events: Events, updated: set[str] = set()) -> MagicMock:
+    """A pool of hosts whose `yum update` updates packages, unless they are in `updated`."""
+    hosts = []
+    for name in names:
+        host = MagicMock(spec=Host)
+        host.hostname_or_ip = name
+        host.uuid = f"uuid-{name}"
+        cast(MagicMock, host.__str__).return_value = name
+
+        def yum_update(name: str = name, **kwargs: object) -> str:
+            events.add("update", name)
+            return "No packages marked for update" if name in updated else "Complete!"
+
+        def reboot(name: str = name, **kwargs: object) -> None:
+            events.add("reboot", name)
+        host.yum_update.side_effect = yum_update
+        host.reboot.side_effect = reboot
+        hosts.append(host)
+    pool = MagicMock(spec=Pool)
+    pool.hosts = hosts
+    pool.master = hosts[0]
+    return pool
+
+@pytest.mark.parametrize("max_unavailable,batches", [
+    (1, [["m"], ["h1"], ["h2"], ["h3"], ["h4"]]),
+    (2, [["m"], ["h1", "h2"], ["h3", "h4"]]),
+    (10, [["m"], ["h1", "h2", "h3", "h4"]]),
+    (None, [["m", "h1", "h2", "h3", "h4"]]),
+])
+def test_batches(max_unavailable: int | None, batches: list[list[str]]) -> None:
+    events = Events()
+    pool = _pool(["m", "h1", "h2", "h3", "h4"], events)
+    progress = UpdateProgress()
+    _rolling_update_pool(pool, CONFIG, progress, reboot=True, evacuate=True, max_unavailable=max_unavailable)
+
+    # a batch is updated and rebooted before the next one starts
+    batch_of = {h: n for n, batch in enumerate(batches) for h in batch}
+    assert [batch_of[h] for _, h in events.events] == sorted(batch_of[h] for _, h in events.events)
+    for batch in batches:
+        hosts = [h for _, h in events.events if h in batch]
+        assert sorted(hosts[:len(batch)]) == sorted(batch)
+        assert sorted(hosts[len(batch):]) == sorted(batch)
+    assert all(progress.state(h) == UpdateProgress.DONE for h in pool.hosts)
+
+    xe_calls = [(c.args[0], c.args[1]["host"]) for c in pool.master.xe.call_args_list]
+    if max_unavailable is None:
+        # no host left to evacuate to
+        assert xe_calls == []
+    else:
+        # the hosts of a batch are all disabled before being evacuated
+        for batch in batches:
+            uuids = [f"uuid-{h}" for h in batch]
+            calls = [c for c in xe_calls if c[1] in uuids]
+            assert calls == [("host-disable", u) for u in uuids] + [("host-evacuate", u) for u in uuids]
+
+def test_no_reboot_without_updates() -> None:
+    events = Events()
+    pool = _pool(["m", "h1"], events, updated={"h1"})
+    progress = UpdateProgress()
+    _rolling_update_pool(pool, CONFIG, progress, reboot=True, evacuate=True, max_unavailable=1)
+    assert events.of("reboot") == ["m"]
+    assert progress.state(pool.hosts[1]) == UpdateProgress.DONE
+
+def test_resume(tmp_path: Path) -> None:
+    state_file = tmp_path / "update.json"
+    state_file.write_text(json.dumps({
+        "m": {"state": UpdateProgress.DONE, "reboot": False},
+        # interrupted after the update of the packages: already up to date, but must still be rebooted
+        "h1": {"state": UpdateProgress.UPDATED, "reboot": True},
+        "h2": {"state": UpdateProgress.FAILED, "error": "reboot timed out"},
+    }))
+    events = Events()
+    pool = _pool(["m", "h1", "h2", "h3"], events, updated={"h1"})
+    progress = UpdateProgress(state_file)
+    _rolling_update_pool(pool, CONFIG, progress, reboot=True, evacuate=True, max_unavailable=1)
+
+    assert events.of("update") == ["h1", "h2", "h3"]
+    assert events.of("reboot") == ["h1", "h2", "h3"]
+    # the progress is saved after each step
+    saved = json.loads(state_file.read_text())
+    assert {h: entry["state"] for h, entry in saved.items()} == dict.fromkeys(saved, UpdateProgress.DONE)
+    assert list(saved) == ["m", "h1", "h2", "h3"]
+    assert not any(entry["reboot"] for entry in saved.values())
+
+def test_resume_without_reboot(tmp_path: Path) -> None:
+    state_file = tmp_path / "update.json"
+    state_file.write_text(json.dumps({"m": {"state": UpdateProgress.UPDATED, "reboot": True}}))
+    events = Events()
+    pool = _pool(["m"], events, updated={"m"})
+    _rolling_update_pool(pool, CONFIG, UpdateProgress(state_file), reboot=False, evacuate=True, max_unavailable=1)
+    assert events.of("reboot") == []
+
+@pytest.mark.parametrize("value", ["0", "-1", "one"])
+def test_max_unavailable_must_be_positive(value: str) -> None:
+    with pytest.raises(argparse.ArgumentTypeError):
+        _positive_int(value)
+    assert _positive_int("3") == 3
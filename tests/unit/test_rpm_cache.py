@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import pytest
+
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import requests
+
+from lib.host import Host
+from lib.rpm_cache import RpmCacheProxy, is_cacheable
+
+from typing import Generator
+
+FILES = {
+    "/repo/Packages/foo-1.0-1.x86_64.rpm": b"foo package" * 1000,
+    "/repo/repodata/repomd.xml": b"<repomd/>",
+    "/repo/repodata/" + "a" * 64 + "-primary.xml.gz": b"primary",
+}
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+class MirrorServer(ThreadingHTTPServer):
+    # paths of the GET requests received
+    requests: list[str]
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    server: MirrorServer
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)
+        content = FILES.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+@pytest.fixture
+def mirror() -> Generator[MirrorServer, None, None]:
+    server = MirrorServer(("127.0.0.1", 0), MirrorHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def proxy(tmp_path: Path) -> Generator[RpmCacheProxy, None, None]:
+    proxy = RpmCacheProxy(str(tmp_path / "cache"))
+    proxy.allow("127.0.0.1")
+    yield proxy
+    proxy.stop()
+
+def get(proxy: RpmCacheProxy, mirror: MirrorServer, path: str) -> requests.Response:
+    host, port = mirror.server_address[:2]
+    proxy_url = f"http://127.0.0.1:{proxy.port}"
+    return requests.get(f"http://{host!s}:{port}{path}", proxies={"http": proxy_url}, timeout=10)
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+def test_is_cacheable() -> None:
+    assert is_cacheable("/8/8.3/base/x86_64/Packages/foo-1.0-1.xcpng8.3.x86_64.rpm")
+    assert is_cacheable("/8/8.3/base/x86_64/repodata/" + "0123456789abcdef" * 4 + "-primary.sqlite.bz2")
+    assert not is_cacheable("/8/8.3/base/x86_64/repodata/repomd.xml")
+    assert not is_cacheable("/8/8.3/base/x86_64/repodata/primary.xml.gz")
+    assert not is_cacheable("/mirrorlist")
+
+def test_packages_are_cached(proxy: RpmCacheProxy, mirror: MirrorServer) -> None:
+    path = "/repo/Packages/foo-1.0-1.x86_64.rpm"
+    for _ in range(3):
+        response = get(proxy, mirror, path)
+        assert response.status_code == 200
+        assert response.content == FILES[path]
+    assert mirror.requests == [path]
+    assert (proxy.stats.hits, proxy.stats.misses) == (2, 1)
+    assert proxy.stats.hit_ratio == pytest.approx(2 / 3)
+
+def test_concurrent_requests_download_once(proxy: RpmCacheProxy, mirror: MirrorServer) -> None:
+    path = "/repo/Packages/foo-1.0-1.x86_64.rpm"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(lambda _: get(proxy, mirror, path), range(8)))
+    assert all(r.content == FILES[path] for r in responses)
+    assert mirror.requests == [path]
+
+def test_metadata(proxy: RpmCacheProxy, mirror: MirrorServer) -> None:
+    checksummed = "/repo/repodata/" + "a" * 64 + "-primary.xml.gz"
+    for _ in range(2):
+        assert get(proxy, mirror, "/repo/repodata/repomd.xml").content == FILES["/repo/repodata/repomd.xml"]
+        assert get(proxy, mirror, checksummed).content == FILES[checksummed]
+    # repomd.xml always comes from the mirror, to see updates of the repository
+    assert mirror.requests == ["/repo/repodata/repomd.xml", checksummed, "/repo/repodata/repomd.xml"]
+    assert proxy.stats.forwarded == 2
+
+def test_missing_package(proxy: RpmCacheProxy, mirror: MirrorServer) -> None:
+    assert get(proxy, mirror, "/repo/Packages/missing-1.0-1.x86_64.rpm").status_code == 404
+    assert not any(Path(proxy.cache_dir).rglob("*.rpm"))
+
+def test_only_allowed_clients(tmp_path: Path, mirror: MirrorServer) -> None:
+    proxy = RpmCacheProxy(str(tmp_path / "cache"))
+    try:
+        with pytest.raises(requests.ConnectionError):
+            get(proxy, mirror, "/repo/repodata/repomd.xml")
+        # IPv4 clients of the dual-stack socket are matched by their IPv4
+        proxy.allow("::ffff:127.0.0.1")
+        assert get(proxy, mirror, "/repo/repodata/repomd.xml").status_code == 200
+    finally:
+        proxy.stop()
+    assert mirror.requests == ["/repo/repodata/repomd.xml"]
+
+def _connect(proxy: RpmCacheProxy, target: str) -> bytes:
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=10) as sock:
+        sock.sendall(f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+        return sock.makefile("rb").readline()
+
+def test_connect_only_to_https(proxy: RpmCacheProxy, mirror: MirrorServer) -> None:
+    host, port = mirror.server_address[:2]
+    assert _connect(proxy, f"{host!s}:{port}").split()[1] == b"403"
+    assert _connect(proxy, f"{host!s}").split()[1] == b"403"
+    assert not mirror.requests
+    assert proxy.stats.forwarded == 0
+
+@pytest.mark.parametrize("ssh_connection,url,client", [
+    ("10.0.0.1 51000 10.0.0.2 22", "http://10.0.0.1:{port}", "10.0.0.2"),
+    ("2001:db8::1 51000 2001:db8::2 22", "http://[2001:db8::1]:{port}", "2001:db8::2"),
+])
+def test_configure(proxy: RpmCacheProxy, ssh_connection: str, url: str, client: str) -> None:
+    host = MagicMock(spec=Host)
+    host.ssh.return_value = ssh_connection
+    assert proxy.url_for(host) == url.format(port=proxy.port)
+    proxy.configure(host)
+    host.set_yum_proxy.assert_called_once_with(url.format(port=proxy.port))
+    assert client in proxy.allowed_clients
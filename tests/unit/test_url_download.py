@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import pytest
+
+import hashlib
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from lib import common
+from lib.common import DownloadError, cached_url_download, url_download
+
+from typing import Generator
+
+CONTENT = bytes(range(256)) * 1000 + b"tail"
+CHUNK_SIZE = 10000
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+class FileServer(ThreadingHTTPServer):
+    content = CONTENT
+    etag = '"v1"'
+    ranges = True
+    # Range headers of the GET requests received
+    requests: list[str | None]
+
+class FileHandler(BaseHTTPRequestHandler):
+    server: FileServer
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    def _headers(self, status: int, length: int, extra: dict[str, str] = {}) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", self.server.etag)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        for key, value in extra.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self) -> None:
+        self._headers(200, len(self.server.content))
+
+    def do_GET(self) -> None:
+        content = self.server.content
+        range_header = self.headers.get("Range")
+        self.server.requests.append(range_header)
+        if self.server.ranges and range_header is not None:
+            m = re.fullmatch(r"bytes=(\d+)-(\d+)", range_header)
+            assert m is not None
+            start, end = int(m.group(1)), int(m.group(2))
+            self._headers(206, end - start + 1, {"Content-Range": f"bytes {start}-{end}/{len(content)}"})
+            self.wfile.write(content[start:end + 1])
+        else:
+            self._headers(200, len(content))
+            self.wfile.write(content)
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> Generator[FileServer, None, None]:
+    monkeypatch.setattr(common, "DOWNLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    server = FileServer(("127.0.0.1", 0), FileHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def url(server: FileServer, path: str = "/dir/file.iso") -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host!s}:{port}{path}"
+
+# ---------------------------------------------------------------------------
+# url_download
+# ---------------------------------------------------------------------------
+
+def test_parallel_range_download(server: FileServer, tmp_path: Path) -> None:
+    dest = tmp_path / "file.iso"
+    url_download(url(server), str(dest), sha256=hashlib.sha256(CONTENT).hexdigest())
+    assert dest.read_bytes() == CONTENT
+    assert len(server.requests) == -(-len(CONTENT) // CHUNK_SIZE)
+    assert all(r is not None for r in server.requests)
+    assert sorted(os.listdir(tmp_path)) == [".file.iso.lock", "file.iso"]
+
+def test_download_without_range_support(server: FileServer, tmp_path: Path) -> None:
+    server.ranges = False
+    dest = tmp_path / "file.iso"
+    url_download(url(server), str(dest))
+    assert dest.read_bytes() == CONTENT
+    assert server.requests == [None]
+
+def test_resume_partial_download(server: FileServer, tmp_path: Path) -> None:
+    dest = tmp_path / "file.iso"
+    part = tmp_path / "file.iso.part"
+    # first 3 chunks already downloaded by a previous, interrupted, call
+    part.write_bytes(CONTENT[:3 * CHUNK_SIZE])
+    (tmp_path / "file.iso.part.json").write_text(json.dumps(dict(
+        url=url(server), size=len(CONTENT), validator=server.etag, chunk_size=CHUNK_SIZE, done=[0, 1, 2],
+    )))
+    url_download(url(server), str(dest))
+    assert dest.read_bytes() == CONTENT
+    assert f"bytes=0-{CHUNK_SIZE - 1}" not in server.requests
+    assert len(server.requests) == -(-len(CONTENT) // CHUNK_SIZE) - 3
+
+def test_no_resume_when_remote_file_changed(server: FileServer, tmp_path: Path) -> None:
+    dest = tmp_path / "file.iso"
+    (tmp_path / "file.iso.part").write_bytes(b"x" * len(CONTENT))
+    (tmp_path / "file.iso.part.json").write_text(json.dumps(dict(
+        url=url(server), size=len(CONTENT), validator='"v0"', chunk_size=CHUNK_SIZE, done=[0, 1, 2],
+    )))
+    url_download(url(server), str(dest))
+    assert dest.read_bytes() == CONTENT
+
+def test_checksum_mismatch(server: FileServer, tmp_path: Path) -> None:
+    dest = tmp_path / "file.iso"
+    with pytest.raises(DownloadError, match="checksum mismatch"):
+        url_download(url(server), str(dest), sha256="0" * 64)
+    assert not dest.exists()
+    assert not (tmp_path / "file.iso.part").exists()
+
+# ---------------------------------------------------------------------------
+# cached_url_download
+# ---------------------------------------------------------------------------
+
+def test_cache_hit(server: FileServer, tmp_path: Path) -> None:
+    path = cached_url_download(url(server), "file.iso", cache_dir=str(tmp_path))
+    count = len(server.requests)
+    assert cached_url_download(url(server), "file.iso", cache_dir=str(tmp_path)) == path
+    assert len(server.requests) == count
+    index = json.loads((tmp_path / "index.json").read_text())
+    assert index[url(server)]["sha256"] == hashlib.sha256(CONTENT).hexdigest()
+
+def test_cache_revalidate(server: FileServer, tmp_path: Path) -> None:
+    path = cached_url_download(url(server), cache_dir=str(tmp_path), revalidate=True)
+    assert os.path.basename(path).endswith("-file.iso")
+    server.content = CONTENT[::-1]
+    server.etag = '"v2"'
+    assert cached_url_download(url(server), cache_dir=str(tmp_path)) == path
+    assert Path(path).read_bytes() == CONTENT
+    cached_url_download(url(server), cache_dir=str(tmp_path), revalidate=True)
+    assert Path(path).read_bytes() == CONTENT[::-1]
+
+def test_cache_adopts_unindexed_file(server: FileServer, tmp_path: Path) -> None:
+    (tmp_path / "file.iso").write_bytes(b"provided manually")
+    path = cached_url_download(url(server), "file.iso", cache_dir=str(tmp_path))
+    assert Path(path).read_bytes() == b"provided manually"
+    assert server.requests == []
+    # ... unless it does not have the expected checksum
+    cached_url_download(url(server), "file.iso", cache_dir=str(tmp_path),
+                        sha256=hashlib.sha256(CONTENT).hexdigest())
+    assert Path(path).read_bytes() == CONTENT
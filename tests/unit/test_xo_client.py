@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import pytest
+
+import base64
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from pathlib import Path
+
+from lib import xo
+from lib.commands import LocalCommandFailed, LocalCommandResult
+from lib.xo import XoClient, XoError
+
+from typing import Any, Generator
+
+TOKEN = "secret-token"
+
+# ---------------------------------------------------------------------------
+# Stub XO-server: JSON-RPC over WebSocket
+# ---------------------------------------------------------------------------
+
+class StubXoServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StubXoHandler)
+        self.objects: dict[str, dict[str, Any]] = {
+            "host-1": {"id": "host-1", "uuid": "host-1", "type": "host"},
+        }
+        self.calls: list[str] = []
+        self.handlers: list[StubXoHandler] = []
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def notify(self, event_type: str, items: dict[str, Any]) -> None:
+        for handler in self.handlers:
+            handler.send_json({"jsonrpc": "2.0", "method": "all", "params": {"type": event_type, "items": items}})
+
+class StubXoHandler(socketserver.StreamRequestHandler):
+    server: StubXoServer
+
+    def send_json(self, message: Any) -> None:
+        payload = json.dumps(message).encode()
+        # server frames are not masked, split in 2 fragments to exercise reassembly
+        half = len(payload) // 2
+        self.wfile.write(bytes([0x01, 126]) + struct.pack("!H", half) + payload[:half])
+        self.wfile.write(bytes([0x80, 126]) + struct.pack("!H", len(payload) - half) + payload[half:])
+        self.wfile.flush()
+
+    def recv_json(self) -> Any:
+        first, second = self.rfile.read(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack("!H", self.rfile.read(2))
+        mask = self.rfile.read(4)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(length)))
+        if first & 0x0F == 0x8:
+            return None
+        return json.loads(payload)
+
+    def handle(self) -> None:
+        headers = {}
+        self.rfile.readline()
+        while (line := self.rfile.readline().decode().strip()):
+            name, _, value = line.partition(":")
+            headers[name.lower()] = value.strip()
+        accept = base64.b64encode(
+            hashlib.sha1((headers["sec-websocket-key"] + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest()
+        ).decode()
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        self.server.handlers.append(self)
+        signed_in = False
+        while (request := self.recv_json()) is not None:
+            method, params = request["method"], request["params"]
+            self.server.calls.append(method)
+            response: dict[str, Any] = {"jsonrpc": "2.0", "id": request["id"]}
+            if method == "session.signIn" and params == {"token": TOKEN}:
+                signed_in = True
+                response["result"] = {"id": "user"}
+            elif not signed_in:
+                response["error"] = {"code": 3, "message": "not authenticated"}
+            elif method == "xo.getAllObjects":
+                wanted = params.get("filter", {}).items()
+                response["result"] = {k: v for k, v in self.server.objects.items() if wanted <= v.items()}
+            elif method == "server.add":
+                response["result"] = "server-id"
+            elif method == "server.getAll":
+                response["result"] = [{"id": "server-id", "host": params.get("host", "h"), "status": "connected"}]
+            else:
+                response["error"] = {"code": -32601, "message": f"method not found: {method}"}
+            self.send_json(response)
+        self.server.handlers.remove(self)
+
+@pytest.fixture
+def server() -> Generator[StubXoServer, None, None]:
+    server = StubXoServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(server: StubXoServer) -> Generator[XoClient, None, None]:
+    client = XoClient(server.url, TOKEN)
+    yield client
+    client.close()
+
+# ---------------------------------------------------------------------------
+# XoClient
+# ---------------------------------------------------------------------------
+
+def test_call(client: XoClient, server: StubXoServer) -> None:
+    assert client.call("server.add", {"host": "h"}) == "server-id"
+    assert server.calls == ["session.signIn", "server.add"]
+
+def test_call_error(client: XoClient) -> None:
+    with pytest.raises(XoError, match="method not found") as exc_info:
+        client.call("no.such.method")
+    assert exc_info.value.code == -32601
+
+def test_bad_token(server: StubXoServer) -> None:
+    with pytest.raises(XoError, match="not authenticated"):
+        XoClient(server.url, "bad-token")
+
+def test_batch(client: XoClient) -> None:
+    results = client.batch([("server.add", {}), ("no.such.method", {}), ("server.getAll", {"host": "x"})])
+    assert results[0] == "server-id"
+    assert isinstance(results[1], XoError)
+    assert results[2] == [{"id": "server-id", "host": "x", "status": "connected"}]
+
+def test_object_events(client: XoClient, server: StubXoServer) -> None:
+    assert client.object_exists("host-1")
+    assert not client.object_exists("vm-1")
+
+    def add_vm() -> None:
+        time.sleep(0.2)
+        server.notify("enter", {"vm-1": {"id": "vm-1", "uuid": "vm-1", "type": "VM"}})
+    threading.Thread(target=add_vm).start()
+    client.wait_for_object("vm-1", timeout_secs=5)
+    # no call was needed to wait for the object
+    assert server.calls == ["session.signIn", "xo.getAllObjects"]
+
+    server.notify("exit", {"host-1": {"id": "host-1", "uuid": "host-1", "type": "host"}})
+    with pytest.raises(TimeoutError):
+        client.wait_for_object("host-1", timeout_secs=0.5)
+
+def test_connection_closed(client: XoClient, server: StubXoServer) -> None:
+    server.shutdown()
+    for handler in list(server.handlers):
+        handler.connection.shutdown(socket.SHUT_RDWR)
+    with pytest.raises(XoError):
+        client.call("server.add")
+
+# ---------------------------------------------------------------------------
+# xo_cli compatibility
+# ---------------------------------------------------------------------------
+
+def _register(url: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> list[list[str]]:
+    """ Register xo-cli to `url`, and return the list of the xo-cli commands run instead of using the client. """
+    (tmp_path / "xo-cli").mkdir(exist_ok=True)
+    (tmp_path / "xo-cli" / "config.json").write_text(json.dumps({"server": url, "token": TOKEN}))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    monkeypatch.setattr(xo, "_client", None)
+    monkeypatch.setattr(xo, "_xo_cli_tool", lambda: None)
+    commands: list[list[str]] = []
+
+    def local_cmd(cmd: list[str], check: bool = True) -> LocalCommandResult:
+        commands.append(cmd)
+        if check:
+            raise LocalCommandFailed(1, "xo-cli failed", " ".join(cmd))
+        return LocalCommandResult(1, "xo-cli output")
+    monkeypatch.setattr(xo, "local_cmd", local_cmd)
+    return commands
+
+def test_xo_cli_uses_registration(server: StubXoServer, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    commands = _register(server.url, tmp_path, monkeypatch)
+
+    assert xo.xo_cli("server.add", {"host": "h"}) == "server-id"
+    assert xo.xo_cli("server.getAll", {"host": "h"}, use_json=True) == [
+        {"id": "server-id", "host": "h", "status": "connected"}
+    ]
+    assert xo.xo_cli("list-objects", {"type": "host"}, use_json=True) == [
+        {"id": "host-1", "uuid": "host-1", "type": "host"}
+    ]
+    assert xo.xo_object_exists("host-1")
+    assert not commands
+    # one connection and session for all the calls
+    assert server.calls.count("session.signIn") == 1
+    xo.xo_client().close()  # type: ignore[union-attr]
+
+def test_xo_cli_failure_without_check(server: StubXoServer, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    commands = _register(server.url, tmp_path, monkeypatch)
+    with pytest.raises(XoError, match="method not found"):
+        xo.xo_cli("no.such.method")
+    # the caller gets the error message, as in the output of a failed xo-cli
+    assert xo.xo_cli("no.such.method", {"a": "b"}, check=False) == "method not found: no.such.method"
+    assert xo.xo_cli("no.such.method", check=False, use_json=True) is None
+
+    # the connection is lost after the call was sent: the action, which may have run, is not run again by xo-cli
+    client = xo.xo_client()
+    assert client is not None
+
+    def call(method: str, params: dict[str, Any] | None = None) -> Any:
+        raise XoError(f"connection to {server.url} lost")
+    monkeypatch.setattr(client, "call", call)
+    assert xo.xo_cli("server.add", check=False) == f"connection to {server.url} lost"
+    assert not commands
+    client.close()
+
+def test_xo_cli_connection_failure(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    commands = _register(f"ws://127.0.0.1:{port}", tmp_path, monkeypatch)
+    # nothing could be sent to XO-server: xo-cli runs the action
+    with pytest.raises(LocalCommandFailed):
+        xo.xo_cli("server.add")
+    assert xo.xo_cli("server.add", check=False) == "xo-cli output"
+    assert commands == [["xo-cli", "server.add"], ["xo-cli", "server.add"]]
+
+def test_xo_cli_configured_tool(server: StubXoServer, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    commands = _register(server.url, tmp_path, monkeypatch)
+    monkeypatch.setattr(xo, "_xo_cli_tool", lambda: "/opt/xo-cli/wrapper")
+    # the xo-cli set by the user is run, even though it is registered
+    assert xo.xo_cli("server.add", check=False) == "xo-cli output"
+    assert commands == [["/opt/xo-cli/wrapper", "server.add"]]
+    assert xo.xo_client() is None
+    assert not server.calls
@@ -2,7 +2,7 @@ import pytest
 
 import logging
 
-from lib.cpu_policy import NO_SUBLEAF, HostCpuPolicy
+from lib.cpu_policy import NO_SUBLEAF, HostCpuPolicy, collect_cpu_policies, diff_cpu_policies
 from lib.host import Host
 
 # Xen CPU Policy gathering test
@@ -27,3 +27,28 @@ class TestCpuPolicy:
 
             for (msr, val) in policy.msr.items():
                 logging.info(f"MSR  [{name}]: {msr:08x} -> {val:016x}")
+
+    def test_cpu_policy_pool_diff(self, host: Host) -> None:
+        """
+        Collect the CPU policies of all the hosts of the pool in parallel and log how they differ from the
+        policies of the master. Differences are not errors, as pools can be heterogeneous, but every host must
+        report the same, non-empty, set of policies.
+        """
+        policies = collect_cpu_policies(host.pool.hosts)
+
+        assert [p.host for p in policies] == host.pool.hosts
+        for policy in policies:
+            assert list(policy.policies) == list(policies[0].policies), f"{policy.host} reports other policies"
+            assert any(p.cpuid for p in policy.policies.values()), f"{policy.host} reports no CPUID leaf"
+        assert not diff_cpu_policies([policies[0], policies[0]])
+
+        diffs = diff_cpu_policies(policies)
+        assert set(diffs) <= set(host.pool.hosts[1:])
+        for pool_host, host_diffs in diffs.items():
+            for name, diff in host_diffs.items():
+                assert diff
+                for d in diff.cpuid:
+                    logging.info(f"CPUID[{name}] {pool_host} differs: {d.leaf:08x}:{d.subleaf:08x} {d.register} "
+                                 f"master={d.left} host={d.right}")
+                for m in diff.msr:
+                    logging.info(f"MSR  [{name}] {pool_host} differs: {m.index:08x} master={m.left} host={m.right}")